@@ -0,0 +1,539 @@
+"""Throughput of generation, the oracle and the buffers, as JSON.
+
+    python -m amplification.benchmark --out before.json
+    ... change something ...
+    python -m amplification.benchmark --out after.json
+    python -m amplification.benchmark --compare before.json after.json
+
+Every measurement is one record like
+
+    {"benchmark": "answers", "task": "SumTask(length=10, modulus=None)",
+     "difficulty": 10, "value": 120000.0, "unit": "questions/s"}
+
+and records from two runs are matched on everything but value. Nothing here
+needs TensorFlow except the transcripts, the asker, the answerer and the answer
+server, which are skipped without it.
+"""
+
+import argparse
+import json
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from amplification.buffer import Buffer
+from amplification.environments import EnvironmentPool
+from amplification.tasks import EqualsTask, EvalSumTask, EvalTask, GraphTask, IterTask
+from amplification.tasks import SatTask, SumTask
+from amplification.tasks.core import Task, recursive_run, recursive_run_generators
+from amplification.tasks.core import recursive_run_steps
+from amplification.tasks.graph import floyd_warshall
+from amplification.validation import make_validation_set
+from amplification.workers import GenerationPool
+
+#the tasks of core.all_tasks, and larger versions of some
+TASKS = [
+    (GraphTask, {}), (GraphTask, {"nchars": 16}),
+    (EqualsTask, {}), (EqualsTask, {"nchars": 16}),
+    (IterTask, {}),
+    (EvalSumTask, {}), (EvalSumTask, {"modulus": None}),
+    (EvalTask, {}), (EvalTask, {"nchars": 16}),
+    (SumTask, {}), (SumTask, {"modulus": None}), (SumTask, {"length": 10, "modulus": None}),
+    (SatTask, {}), (SatTask, {"nvars": 10}),
+]
+DIFFICULTIES = (0, 10, 50, float('inf'))
+
+
+def task_name(cls, kwargs):
+    return "{}({})".format(cls.__name__, ", ".join(
+        "{}={!r}".format(k, v) for k, v in sorted(kwargs.items())))
+
+
+#the average time of a call to f, after one call to warm up
+def seconds_per_call(f, repeats):
+    f()
+    t0 = time.time()
+    for _ in range(repeats):
+        f()
+    return (time.time() - t0) / repeats
+
+
+def record(benchmark, value, unit, **params):
+    for k, v in params.items():
+        if v == float('inf'): params[k] = "inf"
+    return dict(benchmark=benchmark, value=float(value), unit=unit, **params)
+
+
+def benchmark_task(task, name, difficulties=DIFFICULTIES, nbatch=50, nqs=50, repeats=3):
+    """Environments or questions per second through each part of get_batch,
+    classify_questions and both ways to run recursive_answer."""
+    results = []
+    for difficulty in difficulties:
+        def add(benchmark, seconds, n, unit):
+            results.append(record(benchmark, n / seconds, unit, task=name, difficulty=difficulty))
+        facts, fast_dbs = task.make_dbs_batch(nbatch, difficulty=difficulty)
+        Qs = task.make_qs_batch(nqs, fast_dbs)
+        add("make_dbs_batch", seconds_per_call(
+            lambda: task.make_dbs_batch(nbatch, difficulty=difficulty), repeats),
+            nbatch, "environments/s")
+        #Task's make_dbs_batch makes one environment at a time
+        add("make_dbs", seconds_per_call(
+            lambda: Task.make_dbs_batch(task, nbatch, difficulty=difficulty), repeats),
+            nbatch, "environments/s")
+        add("make_qs_batch", seconds_per_call(
+            lambda: task.make_qs_batch(nqs, fast_dbs), repeats), nbatch * nqs, "questions/s")
+        add("answers", seconds_per_call(
+            lambda: [task.answers(Q, fast_db) for Q, fast_db in zip(Qs, fast_dbs)], repeats),
+            nbatch * nqs, "questions/s")
+        add("classify_questions", seconds_per_call(
+            lambda: [task.classify_questions(Q, fast_db) for Q, fast_db in zip(Qs, fast_dbs)],
+            repeats), nbatch * nqs, "questions/s")
+        #sub-questions are answered with the ground truth
+        flat_Qs = np.reshape(Qs, (-1, task.question_length)).astype(np.int32)
+        def answerer(flat_subQs):
+            subQs = np.reshape(flat_subQs, Qs.shape)
+            return np.concatenate([task.answers(Q, fast_db)
+                                   for Q, fast_db in zip(subQs, fast_dbs)])
+        runs = [("recursive_run_generators", recursive_run_generators)]
+        if hasattr(task, "recursive_step"):
+            runs.append(("recursive_run_steps", recursive_run_steps))
+        for benchmark, run in runs:
+            add(benchmark, seconds_per_call(lambda: run(task, flat_Qs, answerer), repeats),
+                len(flat_Qs), "questions/s")
+    return results
+
+
+def benchmark_tasks(tasks=TASKS, **kwargs):
+    results = []
+    for cls, task_kwargs in tasks:
+        name = task_name(cls, task_kwargs)
+        print(name, file=sys.stderr)
+        results.extend(benchmark_task(cls(**task_kwargs), name, **kwargs))
+    return results
+
+
+def benchmark_floyd_warshall(sizes=({}, {"nchars": 16}), difficulties=DIFFICULTIES,
+                             nbatch=50, repeats=3):
+    """GraphTask's distances by Floyd–Warshall over all vertices, to compare
+    with make_dbs_batch, which only expands from the used ones."""
+    results = []
+    for kwargs in sizes:
+        task = GraphTask(**kwargs)
+        for difficulty in difficulties:
+            facts, fast_dbs = task.make_dbs_batch(nbatch, difficulty)
+            length = task.length
+            edges = task.indices(np.stack([facts[:, :, :length], facts[:, :, length:]], axis=2))
+            seconds = seconds_per_call(
+                lambda: floyd_warshall(edges, task.size, 2 * task.size), repeats)
+            results.append(record("floyd_warshall", nbatch / seconds, "environments/s",
+                                  task=task_name(GraphTask, kwargs), difficulty=difficulty))
+    return results
+
+
+def answerer_buffer(task, capacity=10000, dtype=np.int32):
+    return Buffer(capacity,
+        {"facts": [0, task.fact_length],
+         "Qs": [0, task.question_length],
+         "targets": [0, task.answer_length],
+         "truth": [0, task.answer_length]},
+        validation_fraction=0.1, dtype=dtype)
+
+
+def answerer_batch(task, nbatch, difficulty):
+    facts, fast_dbs, Qs, As = task.get_batch(nbatch, difficulty=difficulty)
+    return {"facts": facts, "Qs": Qs, "targets": As, "truth": As}
+
+
+def benchmark_buffer(task=None, nbatch=50, difficulties=(0, 50), repeats=100):
+    """Items per second into and out of an answerer buffer, sampling into a
+    fresh batch and into one reused batch."""
+    task = task or IterTask()
+    name = task_name(type(task), {})
+    results = []
+    for difficulty in difficulties:
+        batch = answerer_batch(task, nbatch, difficulty)
+        extendible = {x: [1] for x in batch}
+        buffer = answerer_buffer(task)
+        seconds = seconds_per_call(lambda: buffer.extend(batch, extendible=extendible), repeats)
+        results.append(record("buffer_extend", nbatch / seconds, "items/s",
+                              task=name, difficulty=difficulty))
+        out = buffer.empty_batch(nbatch)
+        for benchmark, sample in [("buffer_sample", lambda: buffer.sample(nbatch)),
+                                  ("buffer_sample_reused", lambda: buffer.sample(nbatch, out=out))]:
+            seconds = seconds_per_call(sample, repeats)
+            results.append(record(benchmark, nbatch / seconds, "items/s",
+                                  task=name, difficulty=difficulty))
+    return results
+
+
+def contention(buffer, make_batch, nbatch=50, nreaders=2, seconds=5.0,
+               write_interval=0.0, reuse=True):
+    """Mimic generate_answerer_data and train_answerer on one buffer.
+
+    One thread extends the buffer with batches from make_batch(i), sleeping
+    write_interval seconds in between as a stand-in for get_interactions,
+    while nreaders threads sample nbatch items from it as fast as they can.
+    Returns (extends per second, samples per second over all readers).
+    """
+    extendible = {x: [1] for x in buffer.keys()}
+    while not buffer.has(10 * nbatch):
+        buffer.extend(make_batch(0), extendible=extendible)
+
+    stop = threading.Event()
+    counts = defaultdict(int)
+
+    def write():
+        i = 0
+        while not stop.is_set():
+            buffer.extend(make_batch(i), extendible=extendible)
+            counts["extend"] += 1
+            i += 1
+            if write_interval: time.sleep(write_interval)
+
+    def read(name):
+        out = buffer.empty_batch(nbatch) if reuse else None
+        while not stop.is_set():
+            if reuse:
+                buffer.sample(nbatch, out=out)
+            else:
+                buffer.sample(nbatch)
+            counts[name] += 1
+
+    threads = [threading.Thread(target=write)]
+    threads.extend(threading.Thread(target=read, args=("sample{}".format(i),))
+                   for i in range(nreaders))
+    start = time.time()
+    for thread in threads: thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads: thread.join()
+    elapsed = time.time() - start
+    nsamples = sum(v for k, v in counts.items() if k.startswith("sample"))
+    return counts["extend"] / elapsed, nsamples / elapsed
+
+
+def benchmark_contention(seconds=5.0, settings=((0, False), (0, True), (0.01, False), (0.01, True))):
+    """Extends and samples per second with a writer and two readers on one
+    buffer, as the curriculum widens the batches."""
+    task = IterTask()
+    batches = [answerer_batch(task, 50, d) for d in range(0, 60, 4)]
+    def make_batch(i):
+        return batches[min(i // 20, len(batches) - 1)]
+    results = []
+    for write_interval, reuse in settings:
+        extends, samples = contention(answerer_buffer(task), make_batch, seconds=seconds,
+                                      write_interval=write_interval, reuse=reuse)
+        params = dict(task=task_name(IterTask, {}), write_interval=write_interval, reuse=reuse)
+        results.append(record("contention_extend", extends, "batches/s", **params))
+        results.append(record("contention_sample", samples, "batches/s", **params))
+    return results
+
+
+def memory(task, dtype, buffer_size=10000, asker_data_limit=100000, nbatch=50,
+           difficulty=56):
+    """Bytes in the buffers of train(), and bytes fed per answerer step.
+
+    The answerer buffer is sized for batches at the given difficulty.
+    """
+    batch = answerer_batch(task, nbatch, difficulty)
+    buffer = answerer_buffer(task, buffer_size, dtype)
+    buffer.extend(batch, extendible={x: [1] for x in batch})
+    asker_buffer = Buffer(asker_data_limit,
+        {"transcripts": [task.transcript_length],
+         "token_types": [task.transcript_length]},
+        validation_fraction=0.1, dtype=dtype)
+    total = 0
+    for b in [buffer, asker_buffer]:
+        for storage in [b, b._validation_buffer]:
+            total += sum(x.nbytes for x in storage.buffer.values())
+    fed = sum(x.astype(dtype).nbytes for x in batch.values())
+    return total, fed
+
+
+def benchmark_memory(tasks=TASKS):
+    results = []
+    for cls, kwargs in tasks:
+        task = cls(**kwargs)
+        for dtype in [np.int32, task.token_dtype]:
+            total, fed = memory(task, dtype)
+            params = dict(task=task_name(cls, kwargs), dtype=np.dtype(dtype).name)
+            results.append(record("buffer_bytes", total, "bytes", **params))
+            results.append(record("fed_bytes_per_step", fed, "bytes", **params))
+    return results
+
+
+def benchmark_transcripts(tasks=TASKS, difficulty=10, nbatch=50, nqs=50, repeats=3):
+    """Transcripts per second through make_transcript, as generate_asker_data
+    builds them from real interactions."""
+    try:
+        from amplification.models.asker import make_transcript
+    except ImportError as e:
+        print("Skipping the transcripts: {}".format(e), file=sys.stderr)
+        return []
+    results = []
+    for cls, kwargs in tasks:
+        task = cls(**kwargs)
+        facts, fast_dbs, Qs, truth = task.get_batch(nbatch, nqs=nqs, difficulty=difficulty)
+        answerer = lambda Qss: np.array([task.answers(Qs, fast_db)
+                                         for Qs, fast_db in zip(Qss, fast_dbs)])
+        As, subQs, subAs = recursive_run(task, Qs, answerer)
+        def make_transcripts():
+            transcripts, tokens = zip(*[
+                make_transcript(Qs[b, q], subQs[b, q], subAs[b, q], As[b, q])
+                for b, q in enumerate(np.random.randint(nqs, size=nbatch))])
+            return np.array(transcripts), np.array(tokens)
+        seconds = seconds_per_call(make_transcripts, repeats)
+        results.append(record("make_transcript", nbatch / seconds, "transcripts/s",
+                              task=task_name(cls, kwargs), difficulty=difficulty))
+    return results
+
+
+def benchmark_workers(nbatch=50, nbatches=40, nworkers=(0, 1, 2, 4), difficulty=10,
+                      real_interactions=True):
+    """Batches per second from the calling thread and from GenerationPools."""
+    task = IterTask()
+    results = []
+    for n in nworkers:
+        if n == 0:
+            def get():
+                facts, fast_dbs, Qs, truth = task.get_batch(nbatch, difficulty=difficulty)
+                if real_interactions:
+                    answerer = lambda Qss: np.array([task.answers(Qs, fast_db)
+                                                     for Qs, fast_db in zip(Qss, fast_dbs)])
+                    recursive_run(task, Qs, answerer)
+        else:
+            pool = GenerationPool(task, nbatch, n, difficulty=difficulty,
+                                  real_interactions=real_interactions)
+            get = pool.interactions if real_interactions else pool
+        # Don't count the start-up of the workers.
+        seconds = seconds_per_call(get, nbatches)
+        if n > 0:
+            pool.close()
+        results.append(record("generation_workers", 1 / seconds, "batches/s",
+                              task=task_name(IterTask, {}), difficulty=difficulty, nworkers=n))
+    return results
+
+
+def benchmark_environments(tasks=((GraphTask, {"nchars": 16}), (SatTask, {"nvars": 10})),
+                           reuses=(1, 4, 16), difficulty=50, nbatch=50, repeats=5):
+    """Batches per second from EnvironmentPools that reuse each environment
+    in about reuse batches."""
+    results = []
+    for cls, kwargs in tasks:
+        task = cls(**kwargs)
+        for reuse in reuses:
+            environments = EnvironmentPool(task, reuse=reuse)
+            seconds = seconds_per_call(
+                lambda: environments.get_batch(nbatch, difficulty=difficulty), repeats)
+            results.append(record("environment_reuse", 1 / seconds, "batches/s",
+                                  task=task_name(cls, kwargs), difficulty=difficulty,
+                                  reuse=reuse))
+    return results
+
+
+def benchmark_validation(tasks=((GraphTask, {"nchars": 16}), (SatTask, {"nvars": 10})),
+                         nworkers=(0, 4)):
+    """Validation sets of train per second, made in worker processes or not,
+    and loaded from the cache."""
+    results = []
+    for cls, kwargs in tasks:
+        task = cls(**kwargs)
+        with tempfile.TemporaryDirectory() as cache:
+            for n in nworkers:
+                t0 = time.time()
+                make_validation_set(task, nworkers=n, cache=cache if n == nworkers[-1] else None)
+                results.append(record("validation_set", 1 / (time.time() - t0), "sets/s",
+                                      task=task_name(cls, kwargs), nworkers=n))
+            t0 = time.time()
+            make_validation_set(task, cache=cache)
+            results.append(record("validation_set_cached", 1 / (time.time() - t0), "sets/s",
+                                  task=task_name(cls, kwargs)))
+    return results
+
+
+def benchmark_asker(interaction_lengths=(3, 9), nbatch=50, repeats=5, **model_args):
+    """Seconds to build the graph of AttentionSequenceModel.sample, and
+    interactions per second from it with a stand-in answerer."""
+    try:
+        import tensorflow as tf
+        from amplification.models.asker import AttentionSequenceModel
+    except ImportError as e:
+        print("Skipping the asker: {}".format(e), file=sys.stderr)
+        return []
+    results = []
+    for interaction_length in interaction_lengths:
+        task = IterTask()
+        task.interaction_length = interaction_length
+        params = dict(task=task_name(IterTask, {}), interaction_length=interaction_length)
+        with tf.Graph().as_default():
+            t0 = time.time()
+            Qs = tf.placeholder(tf.int32, [None, task.question_length])
+            asker = AttentionSequenceModel(task=task, **model_args)
+            targets = asker.sample(Qs, interaction_length,
+                                   lambda subQs: subQs[:, :task.answer_length])
+            results.append(record("asker_graph_build", 1 / (time.time() - t0), "graphs/s",
+                                  **params))
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                facts, fast_dbs, Q_batch, truth = task.get_batch(nbatch, nqs=1)
+                feed = {Qs: Q_batch[:, 0]}
+                seconds = seconds_per_call(lambda: sess.run(targets, feed), repeats)
+        results.append(record("asker_sample", nbatch / seconds, "interactions/s", **params))
+    return results
+
+
+def benchmark_answerer(tasks=((IterTask, {}), (GraphTask, {})), difficulty=10, nbatch=50, nqs=50,
+                       repeats=5, **model_args):
+    """Training steps per second of AttentionAnswerer, at the default nh=512
+    and depth=6, and batches of answers sampled per second without targets."""
+    try:
+        import tensorflow as tf
+        from amplification.models.answerer import AttentionAnswerer
+    except ImportError as e:
+        print("Skipping the answerer: {}".format(e), file=sys.stderr)
+        return []
+    results = []
+    for cls, kwargs in tasks:
+        task = cls(**kwargs)
+        params = dict(task=task_name(cls, kwargs), difficulty=difficulty)
+        with tf.Graph().as_default():
+            facts = tf.placeholder(tf.int32, [None, None, task.fact_length])
+            Qs = tf.placeholder(tf.int32, [None, None, task.question_length])
+            targets = tf.placeholder(tf.int32, [None, None, task.answer_length])
+            is_training = tf.placeholder(tf.bool, [])
+            answerer = AttentionAnswerer(task=task, **model_args)
+            ops = answerer.build(facts, Qs, targets, is_training)
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                fact_batch, fast_dbs, Q_batch, truth = task.get_batch(
+                    nbatch, nqs=nqs, difficulty=difficulty)
+                # What train.py fetches for a training step.
+                fetches = [ops[k] for k in ["loss", "losses", "predictions", "train"]]
+                feed = {facts: fact_batch, Qs: Q_batch, targets: truth, is_training: True}
+                step = seconds_per_call(lambda: sess.run(fetches, feed), repeats)
+                feed = {facts: fact_batch, Qs: Q_batch, is_training: False}
+                sample = seconds_per_call(lambda: sess.run(ops["As"], feed), repeats)
+        results.append(record("answerer_step", 1 / step, "steps/s", **params))
+        results.append(record("answerer_sample", 1 / sample, "batches/s", **params))
+    return results
+
+
+def build_asker_and_answerer(task, answerer=None, asker=None):
+    """Builds an AskerAndAnswerer in the default graph, fed through
+    placeholders, whose simple answerers answer nothing.
+
+    Returns the placeholders, by the names of model.build's arguments, and the
+    ops."""
+    import tensorflow as tf
+    from amplification.models.asker import AskerAndAnswerer
+
+    inputs = {
+        "facts": tf.placeholder(tf.int32, [None, None, task.fact_length]),
+        "Qs": tf.placeholder(tf.int32, [None, None, task.question_length]),
+        "targets": tf.placeholder(tf.int32, [None, None, task.answer_length]),
+        "transcripts": tf.placeholder(tf.int32, [None, None]),
+        "token_types": tf.placeholder(tf.int32, [None, None]),
+        "facts_key": tf.placeholder(tf.int64, []),
+    }
+
+    def never_simple(Qs):
+        shape = tf.shape(Qs)
+        return (tf.zeros(shape[:-1], tf.bool),
+                tf.zeros(tf.concat([shape[:-1], [task.answer_length]], 0), tf.int32))
+
+    model = AskerAndAnswerer(task=task, answerer=answerer, asker=asker)
+    ops = model.build(inputs["facts"], inputs["Qs"], inputs["targets"], inputs["transcripts"],
+                      inputs["token_types"], tf.constant(False), never_simple,
+                      inputs["facts_key"], never_simple)
+    return inputs, ops
+
+
+def benchmark_answer_server(tasks=((IterTask, {}), (GraphTask, {})), difficulty=10, nbatch=50,
+                            nqs=50, repeats=10, **model_args):
+    """Rounds of teacher answers per second, feeding the facts every round
+    (teacher_or_simple) and feeding only the questions, about facts kept in
+    the session (cached/teacher_or_simple). The simple answerer answers
+    nothing, so that both measure the dispatch and the teacher."""
+    try:
+        import tensorflow as tf
+    except ImportError as e:
+        print("Skipping the answer server: {}".format(e), file=sys.stderr)
+        return []
+    results = []
+    for cls, kwargs in tasks:
+        task = cls(**kwargs)
+        params = dict(task=task_name(cls, kwargs), difficulty=difficulty)
+        with tf.Graph().as_default():
+            inputs, ops = build_asker_and_answerer(task, answerer=model_args, asker=model_args)
+            facts, Qs, facts_key = inputs["facts"], inputs["Qs"], inputs["facts_key"]
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                fact_batch, fast_dbs, Q_batch, truth = task.get_batch(
+                    nbatch, nqs=nqs, difficulty=difficulty)
+                fed = seconds_per_call(lambda: sess.run(
+                    ops["teacher_or_simple"], {facts: fact_batch, Qs: Q_batch}), repeats)
+                sess.run(ops["teacher_state"]["store"], {facts: fact_batch, facts_key: 0})
+                served = seconds_per_call(lambda: sess.run(
+                    ops["cached"]["teacher_or_simple"], {Qs: Q_batch, facts_key: 0}), repeats)
+                sess.run(ops["teacher_state"]["remove"], {facts_key: 0})
+        results.append(record("answer_round", 1 / fed, "rounds/s", server=False, **params))
+        results.append(record("answer_round", 1 / served, "rounds/s", server=True, **params))
+    return results
+
+
+BENCHMARKS = {
+    "tasks": benchmark_tasks,
+    "floyd_warshall": benchmark_floyd_warshall,
+    "buffer": benchmark_buffer,
+    "contention": benchmark_contention,
+    "memory": benchmark_memory,
+    "transcripts": benchmark_transcripts,
+    "workers": benchmark_workers,
+    "environments": benchmark_environments,
+    "validation": benchmark_validation,
+    "asker": benchmark_asker,
+    "answerer": benchmark_answerer,
+    "answer_server": benchmark_answer_server,
+}
+
+
+def key(result):
+    return tuple(sorted((k, v) for k, v in result.items() if k != "value"))
+
+
+def compare(before, after):
+    """after / before for every measurement in both, worst first."""
+    before = {key(r): r["value"] for r in before}
+    ratios = [(r["value"] / before[key(r)], r) for r in after
+              if key(r) in before and before[key(r)] > 0]
+    for ratio, r in sorted(ratios, key=lambda x: x[0]):
+        params = ", ".join("{}={}".format(k, v) for k, v in sorted(r.items())
+                           if k not in ["benchmark", "value", "unit"])
+        print("{:6.2f}x  {} ({}) {:.3g} {}".format(ratio, r["benchmark"], params,
+                                                   r["value"], r["unit"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--out", help="where to write the JSON, default stdout")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS),
+                        default=sorted(BENCHMARKS))
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    args = parser.parse_args()
+    if args.compare:
+        before, after = [json.load(open(path)) for path in args.compare]
+        compare(before, after)
+    else:
+        results = []
+        for name in args.only:
+            print("Benchmarking {}".format(name), file=sys.stderr)
+            results.extend(BENCHMARKS[name]())
+        if args.out:
+            with open(args.out, "w") as f:
+                json.dump(results, f, indent=1)
+        else:
+            json.dump(results, sys.stdout, indent=1)
@@ -1,23 +1,165 @@
+import json
 import numpy as np
 from collections import defaultdict
+import os
 import threading
+import time
+
+class SumTree:
+    """Priorities of capacity items, for sampling proportionally to them.
+
+    A complete binary tree in an array: node i has children 2i and 2i+1, the
+    leaves start at self.size and the root is node 1. Both update and sample
+    are O(log capacity) per item and vectorized over items.
+    """
+    def __init__(self, capacity):
+        self.size = 1
+        while self.size < capacity:
+            self.size *= 2
+        self.tree = np.zeros(2 * self.size)
+
+    def total(self):
+        return self.tree[1]
+
+    def update(self, indexes, priorities):
+        nodes = np.asarray(indexes) + self.size
+        self.tree[nodes] = priorities
+        for _ in range(self.size.bit_length() - 1):
+            # Duplicate parents just get the same sum twice.
+            nodes = nodes // 2
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def sample(self, n):
+        targets = np.random.uniform(0, self.total(), size=n)
+        nodes = np.ones(n, dtype=np.int64)
+        for _ in range(self.size.bit_length() - 1):
+            left = self.tree[2 * nodes]
+            go_right = targets >= left
+            targets -= left * go_right
+            nodes = 2 * nodes + go_right
+        return nodes - self.size
 
 class Buffer:
-    def __init__(self, capacity, shapes, validation_fraction=0):
+    """A ring buffer of integer arrays, written by one thread and read by many.
+
+    Storage is preallocated. The logical size of an extendible dimension grows
+    with the data, but the storage behind it is only reallocated when it runs
+    out, and then to at least twice its size.
+
+    Readers don't take a lock. The writer makes self.version odd while it
+    touches the storage and even again when it is done, and sample retries if
+    the version changed while it was copying.
+
+    If prioritized, items are sampled proportionally to priority ** alpha.
+    New items get the largest priority seen so far, so that each gets sampled
+    soon, and update_priorities sets them from the losses of the learner.
+    Items are numbered in the order they are written, and the item numbered i
+    is in slot i % capacity until capacity more have been written. sample
+    returns these numbers, so that update_priorities can skip the items that
+    were overwritten in the meantime.
+    The validation buffer is always sampled uniformly.
+
+    If path is given, the arrays are memory-mapped .npy files in that
+    directory and the rest of the state goes to state.json after every write.
+    A Buffer created on a path that holds a store picks up where it left off,
+    if the store has the same capacity, dtype and fixed dimensions.
+    Priorities aren't stored; on reopening, all items get the same.
+    """
+    def __init__(self, capacity, shapes, validation_fraction=0, prioritized=False, alpha=0.6,
+                 dtype=np.int32, path=None):
         self.capacity = capacity
         self.used = 0
         self.index = 0
-        self.shapes = shapes
-        self.buffer = {name:np.ones([capacity] + list(shape), dtype=np.int32) * 7 for name, shape in shapes.items()}
+        self.dtype = dtype
+        self.path = path
+        # Logical shapes; the storage in self.buffer may be larger.
+        self.shapes = {name: list(shape) for name, shape in shapes.items()}
+        self.buffer = {}
+        self.regions = {}
+        self.total_data = 0
         self.validation_fraction = validation_fraction
         self.validate = (validation_fraction > 0)
-        self.total_data = 0
+        self.validation_owed = 0
+        if path is not None and os.path.exists(self._state_file()):
+            self._reopen()
+        else:
+            if path is not None:
+                os.makedirs(path, exist_ok=True)
+            for name, shape in self.shapes.items():
+                self._install(name, self._allocate(name, [capacity] + shape))
+            self._save_state()
+        self.version = 0
+        self.written = self.index + (self.capacity if self.used == self.capacity else 0)
+        self.prioritized = prioritized
+        if prioritized:
+            self.alpha = alpha
+            self.max_priority = 1.0
+            self.priorities = SumTree(capacity)
+            if self.used:
+                self.priorities.update(np.arange(self.used), 1.0)
+        # Only serializes writers, sample never takes it.
         self.lock = threading.RLock()
         if self.validate:
-            self.validation_owed = 0
-            self._validation_buffer = Buffer(int(capacity * validation_fraction), shapes)
+            self._validation_buffer = Buffer(
+                int(capacity * validation_fraction), shapes, dtype=dtype,
+                path=None if path is None else os.path.join(path, "validation"))
             #no one should acquire _validation_buffer.lock without acquiring self.lock first
 
+    def _state_file(self):
+        return os.path.join(self.path, "state.json")
+
+    def _array_file(self, k):
+        return os.path.join(self.path, k + ".npy")
+
+    def _save_state(self):
+        if self.path is None:
+            return
+        state = {"capacity": self.capacity, "used": self.used, "index": self.index,
+                 "total_data": self.total_data, "shapes": self.shapes,
+                 "validation_owed": self.validation_owed}
+        with open(self._state_file() + ".new", "w") as f:
+            json.dump(state, f)
+        os.replace(self._state_file() + ".new", self._state_file())
+
+    def _reopen(self):
+        with open(self._state_file()) as f:
+            state = json.load(f)
+        if state["capacity"] != self.capacity or set(state["shapes"]) != set(self.shapes):
+            raise ValueError("{} holds a buffer of a different layout".format(self.path))
+        for k, shape in self.shapes.items():
+            # Dimensions of size 0 grow with the data, the others are fixed.
+            stored = state["shapes"][k]
+            if len(stored) != len(shape) or any(n != 0 and n != m for n, m in zip(shape, stored)):
+                raise ValueError("{} holds {} of shape {}, not {}".format(
+                    self.path, k, stored, shape))
+        for k in self.shapes:
+            array = np.load(self._array_file(k), mmap_mode="r+")
+            if array.dtype != self.dtype:
+                raise ValueError("{} holds {}, not {}".format(
+                    self._array_file(k), array.dtype, np.dtype(self.dtype)))
+            self.buffer[k] = array
+        for k in ["used", "index", "total_data", "shapes", "validation_owed"]:
+            setattr(self, k, state[k])
+        for k in self.shapes:
+            self._update_region(k)
+
+    def _allocate(self, k, shape):
+        # Untouched pages of a fresh array don't take up memory, whether it
+        # lives in a file or not.
+        if self.path is None:
+            return np.zeros(shape, dtype=self.dtype)
+        return np.lib.format.open_memmap(self._array_file(k) + ".new", mode="w+",
+                                         dtype=self.dtype, shape=tuple(shape))
+
+    def _install(self, k, array):
+        if self.path is not None:
+            # Only now does the array replace the old one on disk, so the store
+            # stays valid if we are interrupted.
+            array.flush()
+            os.replace(self._array_file(k) + ".new", self._array_file(k))
+        self.buffer[k] = array
+        self._update_region(k)
+
     def keys(self):
         return list(self.buffer)
 
@@ -53,60 +195,143 @@ class Buffer:
             item_size = list(stuff.values())[0].shape[0]
             if item_size > self.capacity:
                 stuff = {name:val[-self.capacity:] for name, val in stuff.items()}
+                item_size = self.capacity
 
-            if self.index + item_size <= self.capacity:
-                for n in self.buffer:
-                    self.buffer[n][self.index : self.index + item_size] = stuff[n]
-                self.index += item_size
-                if self.index > self.used:
-                    self.used = self.index
-            else:
-                space_at_end = self.capacity - self.index
-                for n in self.buffer:
-                    self.buffer[n][self.index:] = stuff[n][:space_at_end]
-                    self.buffer[n][:item_size - space_at_end] = stuff[n][space_at_end:]
+            self.version += 1
+            try:
+                if self.prioritized:
+                    written = (self.index + np.arange(item_size)) % self.capacity
+                    self.priorities.update(written, self.max_priority ** self.alpha)
+                if self.index + item_size <= self.capacity:
+                    for n in self.buffer:
+                        self._write(n, self.index, stuff[n])
+                    self.index += item_size
+                    if self.index > self.used:
+                        self.used = self.index
+                else:
+                    space_at_end = self.capacity - self.index
+                    for n in self.buffer:
+                        self._write(n, self.index, stuff[n][:space_at_end])
+                        self._write(n, 0, stuff[n][space_at_end:])
+
+                    self.index = item_size - space_at_end
+                    self.used = self.capacity
+                self.written += item_size
+                self._save_state()
+            finally:
+                self.version += 1
+
+    def _write(self, k, start, values):
+        rows = self.buffer[k][start:start + values.shape[0]]
+        if self.regions[k] is None and values.shape == rows.shape:
+            rows[...] = values
+            return
+        if list(values.shape[1:]) != self.shapes[k]:
+            # Narrower than the buffer: pad with zeros, like grow does.
+            rows[self._region(k)] = 0
+        rows[(slice(None),) + tuple(slice(0, s) for s in values.shape[1:])] = values
+
+    def _region(self, k):
+        return (slice(None),) + tuple(slice(0, s) for s in self.shapes[k])
 
-                self.index = (item_size + self.used) % self.capacity
-                self.used = self.capacity
+    def _update_region(self, k):
+        # None if the logical shape fills the storage, so no view is needed.
+        full = list(self.buffer[k].shape[1:]) == self.shapes[k]
+        self.regions[k] = None if full else self._region(k)
 
     def grow(self, k, index, newsize):
         with self.lock:
-            old = self.buffer[k]
-            oldsize = old.shape[index]
-            if newsize != oldsize:
-                assert newsize > oldsize
-                to_set = [slice(0, s) for s in old.shape]
-                shape = list(old.shape)
-                shape[index] = newsize
-                self.buffer[k] = np.zeros(shape, dtype=np.int32)
-                self.buffer[k][to_set] = old
+            oldsize = self.shapes[k][index - 1]
+            if newsize > oldsize:
+                self.version += 1
+                try:
+                    old = self.buffer[k]
+                    if newsize > old.shape[index]:
+                        shape = list(old.shape)
+                        shape[index] = max(newsize, 2 * old.shape[index])
+                        new = self._allocate(k, shape)
+                        new[self._region(k)] = old[self._region(k)]
+                        self._install(k, new)
+                    else:
+                        # Rows written before may have left data past oldsize.
+                        stale = list(self._region(k))
+                        stale[index] = slice(oldsize, newsize)
+                        old[tuple(stale)] = 0
+                    self.shapes[k][index - 1] = newsize
+                    self._update_region(k)
+                    self._save_state()
+                finally:
+                    self.version += 1
             if self.validate:
                 self._validation_buffer.grow(k, index, newsize)
 
+    def empty_batch(self, n):
+        """Arrays that sample can fill with n items without allocating."""
+        return {k: np.empty((n,) + v.shape[1:], dtype=v.dtype)
+                for k, v in self.buffer.items()}
 
-    def sample(self, n, validation=False):
+    def update_priorities(self, indexes, priorities):
+        """Set the priorities of the items that sample returned indexes for,
+        unless they have been overwritten since."""
+        indexes = np.asarray(indexes)
+        priorities = np.asarray(priorities, dtype=np.float64) + 1e-6
         with self.lock:
-            if validation:
-                return self._validation_buffer.sample(n)
+            current = indexes >= self.written - self.capacity
+            if not np.any(current):
+                return
+            priorities = priorities[current]
+            self.max_priority = max(self.max_priority, np.max(priorities))
+            self.priorities.update(indexes[current] % self.capacity, priorities ** self.alpha)
 
-            if n > self.used:
+    def sample(self, n, validation=False, out=None, return_indexes=False):
+        """Sample n items with replacement.
+
+        If out is given (see empty_batch), the items are copied into it and
+        the result consists of views into out. Entries of out that no longer
+        match the storage are replaced.
+
+        If return_indexes, return the numbers of the items as well, for
+        update_priorities.
+        """
+        if validation:
+            return self._validation_buffer.sample(n, out=out, return_indexes=return_indexes)
+
+        while True:
+            version = self.version
+            if version % 2 == 1:
+                # The writer is busy. Let it finish.
+                time.sleep(0)
+                continue
+
+            used = self.used
+            written = self.written
+            if n > used:
                 raise IndexError("You're requesting more items than exist in the buffer")
 
-            indexes = np.random.randint(0, self.used, size=n)
+            if self.prioritized:
+                # A concurrent update_priorities can make the descent stray.
+                indexes = np.minimum(self.priorities.sample(n), used - 1)
+            else:
+                indexes = np.random.randint(0, used, size=n)
+
+            result = {}
+            for k, storage in self.buffer.items():
+                region = self.regions[k]
+                if out is None:
+                    result[k] = storage[indexes] if region is None else storage[region][indexes]
+                    continue
+                if out[k].shape != (n,) + storage.shape[1:]:
+                    out[k] = np.empty((n,) + storage.shape[1:], dtype=storage.dtype)
+                # Taking whole rows is much faster than taking from a strided
+                # view. Past the logical shape the storage is all zeros.
+                storage.take(indexes, axis=0, out=out[k], mode='clip')
+                result[k] = out[k] if region is None else out[k][region]
 
-            return {n:self.buffer[n][indexes] for n in self.buffer}
+            if self.version == version:
+                if not return_indexes:
+                    return result
+                # The last item written to each slot.
+                return result, written - 1 - (written - 1 - indexes) % self.capacity
 
     def has(self, n):
         return n <= self.used
-
-if __name__ == '__main__':
-    b = Buffer(5, [[0, 2], [0, 2]])
-    b.extend([np.ones((3, 2, 2)) * 5, np.ones((3, 3, 2)) * 11])
-    print(b.buffer)
-
-    # b.extend([np.asarray([[4, 5], [6, 7], [8, 9]])])
-    # print(b.buffer)
-    print("Sampling")
-    print(b.sample(2))
-    # print(b.sample(3))
-    # print(b.sample(3))
@@ -0,0 +1,52 @@
+"""Environments that are asked about in several batches before they're replaced."""
+from collections import OrderedDict
+import threading
+
+import numpy as np
+
+
+class EnvironmentPool():
+    """A stand-in for task.get_batch that reuses environments.
+
+    For some tasks making the environments is most of the cost of a batch
+    (the shortest paths of GraphTask, the satisfying assignments of SatTask).
+    The pool keeps the environments of the last batch at each difficulty, and
+    each call replaces the oldest 1/reuse of them with new ones, so an
+    environment is in about reuse batches before it's evicted. The questions
+    are new every time.
+
+    Only the environments of the max_levels most recently used difficulties
+    are kept. With reuse=1 get_batch is just task.get_batch.
+    """
+    def __init__(self, task, reuse=1, max_levels=4):
+        self.task = task
+        self.reuse = reuse
+        self.max_levels = max_levels
+        # By difficulty, least recently used first: facts and fast_dbs, oldest
+        # environment first.
+        self.levels = OrderedDict()
+        self.generated = 0
+        self.lock = threading.Lock()
+
+    def make_dbs_batch(self, nbatch, difficulty=float('inf')):
+        with self.lock:
+            facts, fast_dbs = self.levels.pop(difficulty, (None, []))
+            # Smaller batches take the newest environments and leave the rest.
+            size = max(nbatch, len(fast_dbs))
+            nfresh = max(-(-nbatch // self.reuse), nbatch - len(fast_dbs))
+            fresh_facts, fresh_fast_dbs = self.task.make_dbs_batch(nfresh, difficulty=difficulty)
+            self.generated += nfresh
+            if facts is not None:
+                fresh_facts = np.concatenate([facts, fresh_facts])
+                fresh_fast_dbs = fast_dbs + fresh_fast_dbs
+            self.levels[difficulty] = fresh_facts[-size:], fresh_fast_dbs[-size:]
+            facts, fast_dbs = fresh_facts[-nbatch:], fresh_fast_dbs[-nbatch:]
+            while len(self.levels) > self.max_levels:
+                self.levels.popitem(last=False)
+        return facts, fast_dbs
+
+    def get_batch(self, nbatch, nqs=None, difficulty=float('inf')):
+        if self.reuse == 1:
+            return self.task.get_batch(nbatch, nqs=nqs, difficulty=difficulty)
+        facts, fast_dbs = self.make_dbs_batch(nbatch, difficulty)
+        return self.task.ask_batch(facts, fast_dbs, nqs)
@@ -9,11 +9,20 @@ class AttentionAnswerer(AttentionModel):
     def build(self,
               facts,
               Qs,
-              targets,
+              targets=None,
               is_training=tf.constant(True),
               learning_rate=1e-5):
+        """Without targets, builds only the answers, which run free: each
+        word is sampled given the ones sampled before it. With targets, also
+        the training ops, from a separate decode where each word is given the
+        target words before it. Its predictions are those words, so they are
+        teacher-forced and more often right than As.
+        """
         state = self.run(facts, is_training)
-        As, losses = self.answer(
+        As = self.answer(state, facts, Qs, is_training=is_training)
+        if targets is None:
+            return {"As": As, "state": state}
+        predictions, losses = self.answer(
             state, facts, Qs, is_training=is_training, targets=targets)
         loss = tf.reduce_mean(losses)
 
@@ -23,10 +32,12 @@ class AttentionAnswerer(AttentionModel):
                 self.context,
                 clip_grads=1.0,
                 context=self.context["train"],
-                optimizer_args=dict(learning_rate=learning_rate, beta2=0.98))
+                optimizer_args=dict(learning_rate=learning_rate, beta2=0.98),
+                loss_scale=self.loss_scale())
 
         train_op = tf.cond(is_training, make_train, lambda: tf.no_op())
-        return {"loss": loss, "train": train_op, "As": As, 'losses': losses}
+        return {"loss": loss, "train": train_op, "As": As, 'losses': losses,
+                "predictions": predictions, "state": state}
 
 
 class AnswererWithTarget(tf_utils.Model):
@@ -72,11 +83,11 @@ class AnswererWithTarget(tf_utils.Model):
                 targets,
                 is_training=is_training,
                 learning_rate=self.learning_rate)
+        # The teacher only answers, so it gets no targets.
         with self.teacher_device():
             teacher_ops = self.teacher.build(
                 facts,
                 Qs,
-                targets,
                 is_training=tf.constant(False),
                 learning_rate=self.learning_rate)
         ops = {"student": student_ops, "teacher": teacher_ops}
@@ -85,9 +96,24 @@ class AnswererWithTarget(tf_utils.Model):
         ops["train"] = update_ema
         return ops
 
-    def answer_fn(self, facts, simple_answerer, unflatten=None):
+    # The teacher's encoding of facts. The teacher's ops from build already
+    # have it, so the other ops on the same facts should reuse it.
+    def teacher_state(self, facts):
+        with self.teacher_device():
+            return self.teacher.run(facts, tf.constant(False))
+
+    def state_cache(self, key, facts, state):
+        """Keeps facts and state, the teacher's encoding of them, in the
+        session under key, so that the teacher can answer several batches of
+        questions about the same facts without them being fed or encoded
+        again. See tf_utils.session_store.
+        """
         with self.teacher_device():
-            state = self.teacher.run(facts, tf.constant(False))
+            return tf_utils.session_store(key, [facts, state])
+
+    def answer_fn(self, facts, simple_answerer, unflatten=None, state=None):
+        if state is None:
+            state = self.teacher_state(facts)
 
         def answer(Qs):
             if unflatten is not None:
@@ -29,7 +29,8 @@ class AttentionSequenceModel(tf_utils.Model):
                    depth=4,
                    p_drop=0.1,
                    universal_transformer=False,
-                   learning_rate=1e-5):
+                   learning_rate=1e-5,
+                   compute_dtype="float32"):
         self.nvocab = task.nvocab
         self.max_length = task.transcript_length
         self.nheads = nheads
@@ -39,6 +40,7 @@ class AttentionSequenceModel(tf_utils.Model):
         self.alength = task.answer_length
         self.universal_transformer = universal_transformer
         self.learning_rate = learning_rate
+        self.set_compute_dtype(compute_dtype)
 
     def encode(self,
                ws,
@@ -64,80 +66,91 @@ class AttentionSequenceModel(tf_utils.Model):
             self.max_length + 1,
             self.nh,
             context=context["position"])
-        result = word_embeddings + token_type_embeddings + position_embeddings
+        result = self.compute(
+            word_embeddings + token_type_embeddings + position_embeddings)
         return tf_utils.dropout(
             result, p_drop=self.p_drop, do_dropout=is_training)
 
-    # ys appear to be the encoded ws.
+    # Preallocated room for the attention of each layer, and for the copying,
+    # over a whole transcript. See run.
+    def empty_caches(self, nbatch):
+        length = self.max_length + 1
+        headsize = self.nh // self.nheads
+        layer_shape = (nbatch, self.nheads, length, headsize)
+        caches = [tf_utils.AttentionCache.empty(layer_shape, layer_shape,
+                                                values_dtype=self.compute_dtype,
+                                                keys_dtype=self.compute_dtype)
+                  for i in range(self.depth)]
+        # The keys of the copying and the words they copy.
+        caches.append(tf_utils.AttentionCache.empty(
+            (nbatch, length, self.nh), (nbatch, length, 1),
+            values_dtype=tf.int32, keys_dtype=self.compute_dtype))
+        return caches
+
+    # The tensors of caches, to pass them through a tf.while_loop, and back.
+    def cache_tensors(self, caches):
+        return [t for cache in caches for t in cache.tensors()]
+
+    def caches_from(self, tensors):
+        return [tf_utils.AttentionCache(*tensors[i:i + 3]) for i in range(0, len(tensors), 3)]
+
     def run(self,
             ws,
             token_types,
             context=None,
-            prev_ys=None,
+            caches=None,
             is_training=tf.constant(False)):
+        """Without caches, ws are whole transcripts. With caches from
+        empty_caches, ws continue the transcripts that are in the caches, and
+        are added to them. The first ws of a transcript then have to start
+        with the start token, see with_start_token."""
         if context is None: context = self.context["run"]
-        nbatch = tf.shape(ws)[0]
-        if prev_ys is None:
-            ws = tf.concat(
-                [ints((nbatch, 1), 0), ws],
-                axis=1)  #prepend ? as a start token
-            token_types = tf.concat(
-                [ints((nbatch, 1), TokenTypes.mainQ), token_types], axis=1)
-        # Start after the prev_ys.
-        start_position = tf.constant(0) if prev_ys is None else tf.shape(
-            prev_ys[0])[1]
+        if caches is None:
+            ws, token_types = self.with_start_token(ws, token_types)
+            start_position = tf.constant(0)
+            layer_caches = [None] * self.depth
+        else:
+            start_position = caches[0].position
+            layer_caches = caches[:-1]
         inputs = self.encode(
             ws,
             token_types,
             start_position=start_position,
             context=context["encode"],
             is_training=is_training)
+        attention_args = {'mask': True, 'mask_offset': start_position}
         if self.universal_transformer:
-            new_ys = [inputs]
             value = inputs
             for i in range(self.depth):
-                y = tf.concat(
-                    [prev_ys[i], value], axis=1) if prev_ys else value
                 value = tf_utils.transformer_cell(
                     value,
                     self.nheads,
-                    y,
+                    value,
                     training=is_training,
                     p_drop=self.p_drop,
-                    attention_args={
-                        'mask': True,
-                        'mask_offset': start_position
-                    },
+                    attention_args=attention_args,
+                    cache=layer_caches[i],
                     context=context["universal_transformer"])
-                new_ys.append(value)
             cells = value
         else:
-            new_ys = [inputs]
             cells = context.sequential(inputs)
             for i in range(self.depth):
-                y = tf.concat(
-                    [prev_ys[i], cells.value],
-                    axis=1) if prev_ys else cells.value
                 cells.transformer_cell(
                     self.nheads,
-                    y,
+                    cells.value,
                     training=is_training,
                     p_drop=self.p_drop,
-                    attention_args={
-                        'mask': True,
-                        'mask_offset': start_position
-                    })
-                new_ys.append(cells.value)
+                    attention_args=attention_args,
+                    cache=layer_caches[i])
             cells = cells.value
 
         Q = tf_utils.fully_connected(cells, (self.nh, ), context=context["Q"])
         K = tf_utils.fully_connected(cells, (self.nh, ), context=context["K"])
-        onehot_ws = tf.one_hot(ws, depth=self.nvocab)
-        new_ys.append(K)
-        new_ys.append(onehot_ws)
-        if prev_ys is not None:
-            K = tf.concat([prev_ys[-2], K], axis=1)
-            onehot_ws = tf.concat([prev_ys[-1], onehot_ws], axis=1)
+        copied_ws = ws
+        if caches is not None:
+            K, copied_ws = caches[-1].write(K, tf.expand_dims(ws, -1))
+            copied_ws = copied_ws[:, :, 0]
+        onehot_ws = tf.one_hot(copied_ws, depth=self.nvocab)
         w_logits = (onehot_ws - 1) * 1e9
         copy_logits = tf_utils.attention(
             Q, K, w_logits, True, mask_offset=start_position, logits=True)
@@ -149,83 +162,95 @@ class AttentionSequenceModel(tf_utils.Model):
                 (self.nh, )).relu().fully_connected((self.nvocab, ))).value
         logits = tf_utils.soft_combine(copy_logits, output_logits, should_copy)
         logits, next_logits = logits[:, :-1], logits[:, -1]
-        return logits, next_logits, new_ys
+        next_logits.set_shape([None, self.nvocab])
+        return logits, next_logits, caches
+
+    def with_start_token(self, ws, token_types):
+        nbatch = tf.shape(ws)[0]
+        ws = tf.concat(
+            [ints((nbatch, 1), 0), ws],
+            axis=1)  #prepend ? as a start token
+        token_types = tf.concat(
+            [ints((nbatch, 1), TokenTypes.mainQ), token_types], axis=1)
+        return ws, token_types
+
+    # Samples length words of token_type after next_logits, one at a time in
+    # a tf.while_loop. Returns them with the logits they were sampled from,
+    # the logits of the word after them and the caches with them added.
+    # Sampling never trains, so the asker runs without dropout here.
+    def decode(self, length, token_type, next_logits, caches, context):
+        def body(j, ws, all_logits, next_logits, *cache_tensors):
+            w = tf.expand_dims(multinomial(next_logits), -1)
+            ws = ws.write(j, w[:, 0])
+            all_logits = all_logits.write(j, next_logits)
+            _, next_logits, caches = self.run(
+                w,
+                token_types=ints_like(w, token_type),
+                context=context,
+                caches=self.caches_from(cache_tensors),
+                is_training=False)
+            return (j + 1, ws, all_logits, next_logits) + tuple(self.cache_tensors(caches))
+
+        _, ws, all_logits, next_logits, *cache_tensors = tf.while_loop(
+            lambda j, *_: j < length,
+            body,
+            (tf.constant(0),
+             tf.TensorArray(tf.int32, size=length),
+             tf.TensorArray(tf.float32, size=length),
+             next_logits) + tuple(self.cache_tensors(caches)),
+            back_prop=False)
+        ws = tf.transpose(ws.stack(), [1, 0])
+        all_logits = tf.transpose(all_logits.stack(), [1, 0, 2])
+        # The stacks don't know their length, and the answerer needs it.
+        ws.set_shape([None, length])
+        all_logits.set_shape([None, length, self.nvocab])
+        return ws, all_logits, next_logits, self.caches_from(cache_tensors)
 
     def sample_next(self, ws, token_types, length=1, context=None):
-        _, next_logits, ys = self.run(
-            ws, token_types=token_types, context=context)
-
-        def append_to_ys(ys, new_ys):
-            return [
-                tf.concat([y, new_y], axis=1) for y, new_y in zip(ys, new_ys)
-            ]
-
-        ws = []
-        all_logits = []
-        for j in range(length):
-            w = multinomial(next_logits)
-            w = tf.expand_dims(w, -1)
-            ws.append(w)
-            all_logits.append(next_logits)
-            if j < length:
-                _, next_logits, new_ys = self.run(
-                    w,
-                    token_types=ints_like(w, TokenTypes.subQ),
-                    context=context,
-                    prev_ys=ys)
-                ys = append_to_ys(ys, new_ys)
-        return tf.concat(ws, axis=1), tf.stack(all_logits, axis=1)
+        if context is None: context = self.context["run"]
+        ws, token_types = self.with_start_token(ws, token_types)
+        _, next_logits, caches = self.run(
+            ws, token_types=token_types, context=context,
+            caches=self.empty_caches(tf.shape(ws)[0]), is_training=False)
+        ws, all_logits, _, _ = self.decode(
+            length, TokenTypes.subQ, next_logits, caches, context)
+        return ws, all_logits
 
     def sample(self, Q, rounds, answerer, context=None):
         qlength = int(Q.shape[1])
         if context is None: context = self.context["run"]
-        _, next_logits, ys = self.run(
-            Q, token_types=ints_like(Q, TokenTypes.mainQ), context=context)
-
-        def append_to_ys(ys, new_ys):
-            return [
-                tf.concat([y, new_y], axis=1) for y, new_y in zip(ys, new_ys)
-            ]
-
-        subQs = []
-        subAs = []
-        for i in range(rounds):
-            ws = []
-            for j in range(qlength):
-                w = multinomial(
-                    next_logits)  #happens to be expanded already...
-                w = tf.expand_dims(w, -1)
-                ws.append(w)
-                _, next_logits, new_ys = self.run(
-                    w,
-                    token_types=ints_like(w, TokenTypes.subQ),
-                    context=context,
-                    prev_ys=ys)
-                ys = append_to_ys(ys, new_ys)
-            subQ = tf.concat(ws, axis=1)
-            subQs.append(subQ)
+        ws, token_types = self.with_start_token(Q, ints_like(Q, TokenTypes.mainQ))
+        _, next_logits, caches = self.run(
+            ws, token_types=token_types, context=context,
+            caches=self.empty_caches(tf.shape(Q)[0]), is_training=False)
+
+        def interact(i, subQs, subAs, next_logits, *cache_tensors):
+            subQ, _, next_logits, caches = self.decode(
+                qlength, TokenTypes.subQ, next_logits,
+                self.caches_from(cache_tensors), context)
             subA = answerer(subQ)
-            subAs.append(subA)
-            _, next_logits, new_ys = self.run(
+            _, next_logits, caches = self.run(
                 subA,
                 token_types=ints_like(subA, TokenTypes.subA),
                 context=context,
-                prev_ys=ys)
-            ys = append_to_ys(ys, new_ys)
-        ws = []
-        for i in range(self.alength):
-            w = multinomial(next_logits)
-            w = tf.expand_dims(w, -1)
-            ws.append(w)
-            _, next_logits, new_ys = self.run(
-                w,
-                token_types=ints_like(w, TokenTypes.mainA),
-                context=context,
-                prev_ys=ys)
-            ys = append_to_ys(ys, new_ys)
-        A = tf.concat(ws, axis=1)
-        subQs = tf.stack(subQs, axis=1)
-        subAs = tf.stack(subAs, axis=1)
+                caches=caches,
+                is_training=False)
+            return ((i + 1, subQs.write(i, subQ), subAs.write(i, subA), next_logits)
+                    + tuple(self.cache_tensors(caches)))
+
+        _, subQs, subAs, next_logits, *cache_tensors = tf.while_loop(
+            lambda i, *_: i < rounds,
+            interact,
+            (tf.constant(0),
+             tf.TensorArray(tf.int32, size=rounds),
+             tf.TensorArray(tf.int32, size=rounds),
+             next_logits) + tuple(self.cache_tensors(caches)),
+            back_prop=False)
+        A, _, _, _ = self.decode(
+            self.alength, TokenTypes.mainA, next_logits,
+            self.caches_from(cache_tensors), context)
+        subQs = tf.transpose(subQs.stack(), [1, 0, 2])
+        subAs = tf.transpose(subAs.stack(), [1, 0, 2])
         return subQs, subAs, A
 
     def build(self, ws, token_types, is_training=tf.constant(True)):
@@ -247,7 +272,8 @@ class AttentionSequenceModel(tf_utils.Model):
             self.context,
             clip_grads=1.0,
             context=self.context["train"],
-            optimizer_args=dict(learning_rate=self.learning_rate, beta2=0.98))
+            optimizer_args=dict(learning_rate=self.learning_rate, beta2=0.98),
+            loss_scale=self.loss_scale())
 
         with tf.name_scope("asker/accuracy"):
             predictions = tf.arg_max(
@@ -289,14 +315,28 @@ class AskerAndAnswerer(tf_utils.Model):
                          else "/device:CPU:0")
 
     # In order to understand token_types, have a look at make_transcript.
+    # facts_key names facts and the teacher's encoding of them while they're
+    # kept in the session, see the teacher_state and cached ops. The cached
+    # ops get their simple answers from stored_simple_answerer, which should
+    # also read what it needs from under facts_key.
     def build(self, facts, Qs, targets, transcripts, token_types, is_training,
-              simple_answerer):
+              simple_answerer, facts_key, stored_simple_answerer):
         answerer_ops = self.answerer.build(
             facts=facts, Qs=Qs, targets=targets, is_training=is_training)
+        # Everything that runs the teacher over facts shares one encoding.
+        state = answerer_ops["teacher"]["state"]
         flat_Qs, unflatten = flatten_first(Qs)
         answerer = self.answerer.answer_fn(
-            facts, simple_answerer, unflatten=unflatten)
-        batch_answerer = self.answerer.answer_fn(facts, simple_answerer)
+            facts, simple_answerer, unflatten=unflatten, state=state)
+        batch_answerer = self.answerer.answer_fn(
+            facts, simple_answerer, state=state)
+        store_state, (cached_facts, cached_state), remove_state = \
+            self.answerer.state_cache(facts_key, facts, state)
+        cached_answerer = self.answerer.answer_fn(
+            cached_facts, stored_simple_answerer, state=cached_state)
+        with self.answerer.teacher_device():
+            cached_teacher_As = self.answerer.teacher.answer(
+                cached_state, cached_facts, Qs, is_training=tf.constant(False))
         subQs, subAs, As = self.asker.sample(flat_Qs, self.rounds, answerer)
         with self.asker_device():
             asker_ops = self.asker.build(
@@ -309,7 +349,18 @@ class AskerAndAnswerer(tf_utils.Model):
             "targets": unflatten(As),
             "teacher_or_simple": batch_answerer(Qs),
             "subQs": unflatten(subQs),
-            "subAs": unflatten(subAs)
+            "subAs": unflatten(subAs),
+            "teacher_state": {
+                "store": store_state,
+                "cached": cached_state,
+                "remove": remove_state
+            },
+            # The same as teacher_or_simple and answerer/teacher/As, about
+            # the facts stored under facts_key. Only Qs are fed.
+            "cached": {
+                "teacher_or_simple": cached_answerer(Qs),
+                "teacher_As": cached_teacher_As
+            }
         }
 
 
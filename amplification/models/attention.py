@@ -15,7 +15,8 @@ class AttentionModel(tf_utils.Model):
                    answer_depth=3,
                    scale_weights=True,
                    p_drop=0.1,
-                   universal_transformer=False):
+                   universal_transformer=False,
+                   compute_dtype="float32"):
         self.nvocab = task.nvocab
         self.nheads = nheads
         self.ne = ne
@@ -26,11 +27,12 @@ class AttentionModel(tf_utils.Model):
         self.p_drop = p_drop
         self.alength = task.answer_length
         self.universal_transformer = universal_transformer
+        self.set_compute_dtype(compute_dtype)
 
     def encode(self, ws, context=None):
         if context is None: context = self.context["encode"]
-        encoding = tf_utils.embed(
-            ws, self.nvocab, self.ne, context=context["embed"])
+        encoding = self.compute(tf_utils.embed(
+            ws, self.nvocab, self.ne, context=context["embed"]))
         return tf_utils.fully_connected(
             encoding, (self.nh, ), in_axes=2, context=context["fc"])
 
@@ -68,6 +70,10 @@ class AttentionModel(tf_utils.Model):
             state = state.value
         return state
 
+    # Samples the answers one word at a time. With targets, each word is
+    # given the target words before it instead of the sampled ones, and the
+    # losses of the targets come from the same logits as the samples, so one
+    # decode gives both.
     def generate_output(self,
                         state,
                         Q_encodings,
@@ -83,7 +89,15 @@ class AttentionModel(tf_utils.Model):
             fact_logits,
             [0, 2, 1, 3])  #batch, words within facts, facts, vocab
         losses = tf.zeros((nbatch, nqs), dtype=tf.float32)
-        for i in range(self.alength):
+        Ks = [
+            tf.transpose(
+                tf_utils.fully_connected(
+                    state, (flength, self.nh), context=context[i]["K"]),
+                [0, 2, 1, 3])  #batch, words within facts, facts, hidden
+            for i in range(self.alength)
+        ]
+
+        def next_logits(i, As):
             if i > 0:
                 A_encodings = self.encode_many(
                     As, is_training, context=context[i]["encoding"])
@@ -93,15 +107,10 @@ class AttentionModel(tf_utils.Model):
             Q = tf_utils.fully_connected(
                 Q_and_A, (flength, self.nh), context=context[i]["Q"])
             #batch, questions, words within facts, hidden
-            K = tf_utils.fully_connected(
-                state, (flength, self.nh), context=context[i]["K"])
-            #batch, facts, words within facts, hidden
             Q = tf.transpose(
                 Q, [0, 2, 1, 3])  #batch, words within facts, questions, hidden
-            K = tf.transpose(
-                K, [0, 2, 1, 3])  #batch, words within facts, facts, hidden
             copy_logits_by_index = tf_utils.attention(
-                Q, K, fact_logits, mask=False, logits=True)
+                Q, Ks[i], fact_logits, mask=False, logits=True)
             #batch, words within facts, questions, vocab
             copy_logits_by_index = tf.transpose(copy_logits_by_index,
                                                 [0, 2, 1, 3])
@@ -117,21 +126,22 @@ class AttentionModel(tf_utils.Model):
                         self.nvocab,
                     ))).value  #batch, questions, 1, vocab
             logits_to_mix = tf.concat(
-                [copy_logits_by_index, output_logits], axis=2)
+                [copy_logits_by_index, tf_utils.widen(output_logits)], axis=2)
             #batch, questions, words within facts + 1, vocab
-            logits = tf_utils.mix_logits(
+            return tf_utils.mix_logits(
                 mix_logits, logits_to_mix)  #batch, questions, vocab
-            if targets is None:
-                next_w = multinomial(logits)
-            else:
-                next_w = targets[:, :, i]
-                losses = losses + tf.nn.sparse_softmax_cross_entropy_with_logits(
-                    logits=logits, labels=next_w)
+
+        for i in range(self.alength):
+            logits = next_logits(i, As if targets is None else targets[:, :, :i])
+            next_w = multinomial(logits)
             As = tf.concat([As, tf.expand_dims(next_w, axis=2)], axis=2)
+            if targets is not None:
+                losses = losses + tf.nn.sparse_softmax_cross_entropy_with_logits(
+                    logits=logits, labels=targets[:, :, i])
         if targets is None:
             return As
         else:
-            return losses
+            return As, losses
 
     def answer(self,
                state,
@@ -170,19 +180,10 @@ class AttentionModel(tf_utils.Model):
         onehot_facts = tf.one_hot(
             facts, depth=self.nvocab)  #batch, facts, words within facts, vocab
         fact_logits = (onehot_facts - 1) * 1e9
-        As = self.generate_output(
+        return self.generate_output(
             state,
             Q_encodings,
             is_training,
             fact_logits,
+            targets=targets,
             context=context["decode"])
-        if targets is not None:
-            losses = self.generate_output(
-                state,
-                Q_encodings,
-                is_training,
-                fact_logits,
-                targets=targets,
-                context=context["decode"])
-            return As, losses
-        return As
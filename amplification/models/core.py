@@ -29,3 +29,19 @@ def multinomial(logits):
     flat_result = tf.squeeze(tf.multinomial(flat_logits, 1), axis=[-1])
     result = unflatten(flat_result)
     return tf.cast(result, tf.int32)
+
+# In-graph counterpart of answer_if_simple_py in train.py for tasks with
+# simple answer tables (see tasks.core.simple_answer_table). Qs are
+# batch x questions x question length, tables batch x keys x answer length.
+def lookup_simple_answers(Qs, tables, token_mask, digits, strides):
+    nvocab = token_mask.shape[1]
+    flat_indices = Qs + nvocab * tf.range(int(Qs.shape[-1]))
+    is_simple = tf.reduce_all(
+        tf.gather(tf.constant(token_mask.reshape(-1)), flat_indices), axis=-1)
+    Q_digits = tf.gather(tf.constant(digits.reshape(-1)), flat_indices)
+    keys = tf.where(tf.reduce_all(Q_digits >= 0, axis=-1),
+                    tf.reduce_sum(Q_digits * tf.constant(strides), axis=-1),
+                    (tf.shape(tables)[1] - 1) * tf.ones(tf.shape(Qs)[:-1], dtype=tf.int32))
+    batch_indices = tf.expand_dims(tf.range(tf.shape(Qs)[0]), 1) + tf.zeros_like(keys)
+    As = tf.gather_nd(tables, tf.stack([batch_indices, keys], axis=-1))
+    return is_simple, As
@@ -0,0 +1,104 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Profiler():
+    """Where the threads of train spend their wall time.
+
+        with profiler.section("sess_run"):
+            ...
+
+    accumulates the time spent in the block for the current thread. Sections
+    may nest; a section is only charged for the time not spent in the sections
+    inside it. items() gives the fraction of wall time each thread spent in
+    each section since the previous call, plus the gauges, for the Logger.
+    Sections that are still open when items() is called are charged up to
+    then, and the rest of their time goes to the next call.
+
+    After trace_to(path), every section is also written to path as an event
+    in the Chrome trace format (chrome://tracing or ui.perfetto.dev). The file
+    is a JSON array that is never closed, which the format allows, so it can
+    be read while training is still going.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = defaultdict(float)
+        # By thread ident: the thread's name, its open sections as [name,
+        # start], and when the innermost one was last charged.
+        self.stacks = {}
+        self.threads = set()
+        self.gauges = {}
+        self.last_reset = time.time()
+        self.trace = None
+
+    def trace_to(self, path):
+        with self.lock:
+            self.trace = open(path, "w")
+            self.trace.write("[\n")
+
+    def _charge(self, ident, now):
+        thread, stack, since = self.stacks[ident]
+        if stack:
+            self.totals[thread, stack[-1][0]] += now - since
+        self.stacks[ident][2] = now
+
+    @contextmanager
+    def section(self, name):
+        ident = threading.get_ident()
+        start = time.time()
+        with self.lock:
+            if ident not in self.stacks:
+                thread = threading.current_thread().name
+                self.threads.add(thread)
+                self.stacks[ident] = [thread, [], start]
+            thread, stack, _ = self.stacks[ident]
+            self._charge(ident, start)
+            stack.append([name, start])
+        try:
+            yield
+        finally:
+            end = time.time()
+            with self.lock:
+                self._charge(ident, end)
+                stack.pop()
+                if self.trace is not None:
+                    self._write_event({"name": name, "ph": "X", "pid": 0, "tid": thread,
+                                       "ts": start * 1e6, "dur": (end - start) * 1e6})
+
+    def sleep(self, seconds):
+        with self.section("sleep"):
+            time.sleep(seconds)
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+            if self.trace is not None:
+                self._write_event({"name": name, "ph": "C", "pid": 0,
+                                   "ts": time.time() * 1e6, "args": {name: value}})
+
+    def _write_event(self, event):
+        self.trace.write(json.dumps(event))
+        self.trace.write(",\n")
+
+    def items(self):
+        now = time.time()
+        with self.lock:
+            for ident in self.stacks:
+                self._charge(ident, now)
+            elapsed = now - self.last_reset
+            self.last_reset = now
+            result = {}
+            for thread in self.threads:
+                result["time/{}/other".format(thread)] = 1.0
+            for (thread, name), total in self.totals.items():
+                result["time/{}/{}".format(thread, name)] = total / elapsed
+                result["time/{}/other".format(thread)] -= total / elapsed
+            for name, value in self.gauges.items():
+                result["fill/{}".format(name)] = float(value)
+            self.totals.clear()
+            if self.trace is not None:
+                self.trace.flush()
+        return result
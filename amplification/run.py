@@ -130,11 +130,15 @@ def main_cmd():
             'train.asker_data_limit', 'train.adjust_drift_epsilon',
             'train.initial_drift_epsilon', 'train.stub', 'train.just_asker',
             'train.supervised', 'train.learn_human_model', 'train.warmup_time',
-            'train.error_probability',
+            'train.error_probability', 'train.prioritized_replay',
+            'train.asker_buffer_path', 'train.prefetch', 'train.trace',
+            'train.generation_workers', 'train.environment_reuse',
+            'train.validation_cache',
             'model.joint.depth', 'model.answerer.depth',
             'model.answerer.answer_depth', 'model.asker.depth',
             'model.joint.nh', 'model.asker.nh', 'model.answerer.nh',
             'model.joint.universal_transformer', 'model.joint.learning_rate',
+            'model.joint.compute_dtype',
             'tiny'
     ]:
         parser.add_argument('--{}'.format(c))
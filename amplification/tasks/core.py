@@ -25,9 +25,12 @@ def sample(x, peak=False):
         return np.random.choice(len(x), p=x / psum)
 
 
+#compares along the last axis
 def lexless(a, b):
-    return np.any(a < b) and (np.all(a <= b) or
-                              (np.argmin(a < b) < np.argmin(b < a)))
+    a = np.asarray(a)
+    b = np.asarray(b)
+    return np.any(a < b, axis=-1) & (np.all(a <= b, axis=-1) |
+                                     (np.argmin(a < b, axis=-1) < np.argmin(b < a, axis=-1)))
 
 
 def sample_known(x):
@@ -48,30 +51,80 @@ def combos(alphabets):
         yield ()
 
 
+#the smallest dtype that holds the integers 0, ..., n-1
+def smallest_dtype(n):
+    for dtype in [np.uint8, np.uint16]:
+        if n <= np.iinfo(dtype).max + 1:
+            return dtype
+    return np.int32
+
+
+#returns: (nbatch, k) array, each row k distinct elements of range(n)
+#the batched analogue of random.sample(range(n), k)
+#when k is small next to n, draws rows of k elements and redraws the rows
+#with repeats, rather than shuffling all of range(n)
+def random_subsets(nbatch, n, k):
+    if k * k > n:
+        return np.argsort(np.random.random((nbatch, n)), axis=-1)[:, :k]
+    result = np.random.randint(n, size=(nbatch, k))
+    while True:
+        ordered = np.sort(result, axis=-1)
+        repeats = np.any(ordered[:, 1:] == ordered[:, :-1], axis=-1)
+        if not np.any(repeats):
+            return result
+        result[repeats] = np.random.randint(n, size=(np.sum(repeats), k))
+
+
+#like np.random.choice(alphabet, shape), but with between 1 and shape[-1]
+#randomly positioned wildcards along the last axis
+def random_wildcards(alphabet, shape, wild):
+    result = np.random.choice(alphabet, shape)
+    num_wilds = np.random.randint(1, shape[-1] + 1, size=shape[:-1] + (1, ))
+    ranks = np.argsort(np.random.random(shape), axis=-1).argsort(axis=-1)
+    result[ranks < num_wilds] = wild
+    return result
+
+
 class Task():
     interaction_length = 10
 
     def get_batch(self, nbatch, nqs=None, **kwargs):
-        facts, fast_dbs, Qs, As = [], [], [], []
+        facts, fast_dbs = self.make_dbs_batch(nbatch, **kwargs)
+        return self.ask_batch(facts, fast_dbs, nqs)
+
+    #fresh questions about environments from make_dbs_batch, and their answers
+    def ask_batch(self, facts, fast_dbs, nqs=None):
+        if nqs is None: nqs = facts.shape[1]
+        Qs = self.make_qs_batch(nqs, fast_dbs)
+        As = np.array([self.answers(Q, fast_db) for Q, fast_db in zip(Qs, fast_dbs)])
+        dtype = self.token_dtype
+        return facts.astype(dtype), fast_dbs, Qs.astype(dtype), As.astype(dtype)
+
+    #Tasks that can generate a whole batch of environments at once override
+    #make_dbs_batch and make_qs_batch; these defaults just loop.
+    def make_dbs_batch(self, nbatch, **kwargs):
+        facts, fast_dbs = [], []
         for batchn in range(nbatch):
             fact, fast_db = self.make_dbs(**kwargs)
             if batchn == 0: nfacts = len(fact)
             assert nfacts == len(fact)
-            if nqs is None: nqs = nfacts
             facts.append(fact)
             fast_dbs.append(fast_db)
-            Q = self.make_qs(nqs, fast_db)
-            A = self.answers(Q, fast_db)
-            Qs.append(Q)
-            As.append(A)
+        return np.array(facts), fast_dbs
 
-        return (np.array(facts), fast_dbs, np.array(Qs), np.array(As))
+    def make_qs_batch(self, nqs, fast_dbs):
+        return np.array([self.make_qs(nqs, fast_db) for fast_db in fast_dbs])
 
     def allocate(self, n):
         result = np.arange(self.nvocab, self.nvocab + n)
         self.nvocab += n
         return result
 
+    #tasks compute in int32, but hand out facts, questions and answers in this
+    @property
+    def token_dtype(self):
+        return smallest_dtype(self.nvocab)
+
     @property
     def transcript_length(self):
         #each round has length = question_length + answer_length
@@ -122,8 +175,15 @@ class Task():
     def one_hot(self, x):
         return np.eye(self.nvocab)[np.asarray(x)]
 
-    def classify_question(self, fast_db, Q):
-        return "all"
+    #the names of the classes that classify_questions sorts questions into
+    question_classes = ["all"]
+
+    #the index in question_classes of the class of each of Qs
+    def classify_questions(self, Qs, fast_db):
+        return np.zeros(len(Qs), dtype=np.int32)
+
+    def classify_question(self, Q, fast_db):
+        return self.question_classes[self.classify_questions(np.stack([Q], axis=0), fast_db)[0]]
 
     def are_simple(self, Qs):
         return np.isin(Qs[:, 0], self.simple_question_tokens)
@@ -167,9 +227,8 @@ def test_task(task, nbatch=10, nqs=300):
         answerer = lambda Qs: task.answers(Qs, fast_db)
         Qs = task.make_qs(nqs, fast_db)
 
-        for Q in Qs:
-            # Apparently just make sure that the call doesn't cause an exception.
-            task.classify_question(Q, fast_db)
+        # Apparently just make sure that the call doesn't cause an exception.
+        task.classify_questions(Qs, fast_db)
 
         direct_A = task.answers(Qs, fast_db)
         recursive_A, subQs, subAs = recursive_run(task, Qs, answerer)
@@ -178,10 +237,10 @@ def test_task(task, nbatch=10, nqs=300):
     print("Answer one question: {:.1E}".format(t))
 
 
-def test_all_tasks(**kwargs):
+def all_tasks():
     from amplification.tasks import EqualsTask, GraphTask, MidpointTask, SatTask
     from amplification.tasks import SumTask, EvalTask, IterTask, EvalSumTask
-    for task in [
+    return [
             GraphTask(),
             EqualsTask(),
             IterTask(),
@@ -192,7 +251,11 @@ def test_all_tasks(**kwargs):
             EvalTask(),
             SatTask(),
             #MidpointTask(),
-    ]:
+    ]
+
+
+def test_all_tasks(**kwargs):
+    for task in all_tasks():
         print("Testing {}".format(type(task).__name__))
         test_task(task, **kwargs)
 
@@ -229,6 +292,16 @@ def recursive_run(task, Qs, answerer):
 
 #list of Qs
 def recursive_run_list(task, Qs, answerer):
+    Qs = np.asarray(Qs, dtype=np.int32)
+    if hasattr(task, "recursive_step"):
+        results = recursive_run_steps(task, Qs, answerer)
+    else:
+        results = recursive_run_generators(task, Qs, answerer)
+    return tuple(x.astype(task.token_dtype) for x in results)
+
+
+#runs one task.recursive_answer generator per question
+def recursive_run_generators(task, Qs, answerer):
     nqs = len(Qs)
     As = -np.ones((nqs, task.answer_length), dtype=np.int32)
     subQs = np.zeros(
@@ -249,6 +322,182 @@ def recursive_run_list(task, Qs, answerer):
     return As, subQs, subAs
 
 
+#the same as recursive_run_generators, but advances all questions in lock-step
+#through the task's vectorized protocol:
+#  state, subQs, done, As = task.recursive_step(state, subAs)
+#state is a dict of arrays, {"Qs": Qs} on the first call, when subAs is None.
+#subQs are the next sub-questions of the questions that aren't done;
+#As are the answers of the questions that are.
+#Once a question is done, it has to stay done.
+def recursive_run_steps(task, Qs, answerer):
+    nqs = len(Qs)
+    As = -np.ones((nqs, task.answer_length), dtype=np.int32)
+    subQs = np.zeros(
+        (nqs, task.interaction_length, task.question_length), dtype=np.int32)
+    subAs = np.zeros(
+        (nqs, task.interaction_length, task.answer_length), dtype=np.int32)
+    finished = np.zeros(nqs, dtype=np.bool_)
+    state, step_subQs, done, step_As = task.recursive_step({"Qs": np.asarray(Qs)}, None)
+    for j in range(task.interaction_length):
+        As[done & ~finished] = step_As[done & ~finished]
+        finished = np.copy(done)
+        subQs[~done, j] = step_subQs[~done]
+        subAs[:, j] = answerer(subQs[:, j])
+        state, step_subQs, done, step_As = task.recursive_step(state, subAs[:, j])
+    As[done & ~finished] = step_As[done & ~finished]
+    assert np.all(As >= 0)
+    return As, subQs, subAs
+
+
+#recursive_step shared by SumTask and SatTask: questions without wildcards are
+#passed on unchanged, otherwise the first wildcard is replaced by each letter
+#of the alphabet in turn and the answers are summed
+def wildcard_sum_step(task, state, subAs, alphabet, alphabet_plus):
+    if subAs is None:
+        Qs = state["Qs"]
+        is_wild = Qs == task.wild
+        state = {
+            "Qs": Qs,
+            "has_wild": np.any(is_wild, axis=-1),
+            "wild_index": np.argmax(is_wild, axis=-1),
+            "k": np.zeros(len(Qs), dtype=np.int32),
+            "result": np.zeros(len(Qs), dtype=np.int32),
+            "done": ~np.all(np.isin(Qs, alphabet_plus), axis=-1),
+            "As": task.zero * np.ones((len(Qs), task.answer_length), dtype=np.int32),
+        }
+    else:
+        state = dict(state)
+        active = ~state["done"]
+        done = np.copy(state["done"])
+        As = np.copy(state["As"])
+        passed_on = active & ~state["has_wild"]
+        As[passed_on] = subAs[passed_on]
+        done |= passed_on
+        summing = active & state["has_wild"]
+        failed = summing & ~np.isin(subAs[:, 0], task.differences)
+        As[failed] = idk
+        done |= failed
+        summing &= ~failed
+        result = np.where(summing, state["result"] + subAs[:, 0] - task.zero, state["result"])
+        k = state["k"] + summing
+        finished = summing & (k == len(alphabet))
+        As[finished, 0] = task.encode_n(result[finished])
+        done |= finished
+        state.update(k=k, result=result, done=done, As=As)
+    subQs = np.copy(state["Qs"])
+    rows = np.arange(len(subQs))
+    subQs[rows, state["wild_index"]] = np.where(
+        state["has_wild"], alphabet[np.minimum(state["k"], len(alphabet) - 1)],
+        subQs[rows, state["wild_index"]])
+    return state, subQs, state["done"], state["As"]
+
+
+#the part of recursive_step shared by GraphTask's step queries and
+#EqualsTask's parent queries, which pick the best of up to three candidates:
+#in phases 1-4 the questions in mask twice ask propose for a vertex and then
+#check(vertex) whether to keep it, which they do if passed; in phase 5 they
+#ask neighbor for one more, and in phase 6 they ask score(candidate) for each
+#candidate in turn and answer with the best one, by is_better(candidate,
+#score, best_score). ask, finish and new_phase belong to the caller.
+#returns: the search's part of the state, see candidate_search_state
+def candidate_search_step(task, state, subAs, mask, passed, propose, check, neighbor,
+                          score, is_better, ask, finish, new_phase):
+    phase = state["phase"]
+    rows = np.arange(len(phase))
+    candidates = np.copy(state["candidates"])
+    ncandidates = np.copy(state["ncandidates"])
+    candidate_index = np.copy(state["candidate_index"])
+    best = np.copy(state["best"])
+    best_score = np.copy(state["best_score"])
+    def add_candidate(mask, vertices):
+        candidates[rows[mask], ncandidates[mask]] = vertices[mask]
+        ncandidates[mask] += 1
+    vertices = subAs[:, :task.length]
+    is_vertex = task.are_chars(vertices)
+
+    #first and second proposed vertex
+    for p in [1, 3]:
+        ask(mask & (phase == p) & is_vertex, check(vertices))
+        ask(mask & (phase == p) & ~is_vertex, propose if p == 1 else neighbor)
+        new_phase[mask & (phase == p) & ~is_vertex] = p + 2
+        add_candidate(mask & (phase == p + 1) & passed, state["proposal"])
+        ask(mask & (phase == p + 1), propose if p == 1 else neighbor)
+    proposing = mask & ((phase == 1) | (phase == 3))
+    proposal = np.where(proposing[:, np.newaxis], vertices, state["proposal"])
+
+    #the neighbor
+    add_candidate(mask & (phase == 5) & is_vertex, vertices)
+
+    #scores of the candidates
+    evaluate = mask & (phase == 6)
+    evaluated = candidates[rows, np.minimum(candidate_index, 2)]
+    s = subAs[:, 0]
+    better = evaluate & is_better(evaluated, s, best_score)
+    best[better, :task.length] = evaluated[better]
+    best[better, task.length:] = idk
+    best_score[better] = s[better]
+    candidate_index[evaluate] += 1
+    new_phase[evaluate] = 6
+    scoring = (mask & (phase == 5)) | evaluate
+    ask_score = scoring & (candidate_index < ncandidates)
+    ask(ask_score, score(candidates[rows, np.minimum(candidate_index, 2)]))
+    finish(scoring & ~ask_score, best)
+    return {"proposal": proposal, "candidates": candidates, "ncandidates": ncandidates,
+            "candidate_index": candidate_index, "best": best, "best_score": best_score}
+
+
+#the initial state for candidate_search_step: best is the answer if there are
+#no candidates, best_score what a candidate has to beat
+def candidate_search_state(task, nqs, best, best_score):
+    return {
+        "proposal": np.zeros((nqs, task.length), dtype=np.int32),
+        "candidates": np.zeros((nqs, 3, task.length), dtype=np.int32),
+        "ncandidates": np.zeros(nqs, dtype=np.int32),
+        "candidate_index": np.zeros(nqs, dtype=np.int32),
+        "best": best * np.ones((nqs, task.answer_length), dtype=np.int32),
+        "best_score": best_score * np.ones(nqs, dtype=np.int32),
+    }
+
+
+#Tasks whose simple questions can be answered by looking them up in a small
+#table per environment (which the model can then do in-graph) define
+#  simple_token_mask(): Q is simple iff mask[i, Q[i]] for every position i
+#  simple_key_ranges(): (lo, hi); the simple questions with lo <= Q <= hi
+#      get their own row in the table, all others share the last one
+#  simple_default_answer(): the answer in that last row
+def has_simple_answer_table(task):
+    return hasattr(task, "simple_key_ranges")
+
+
+#returns: digits, strides, nkeys
+#a question's key is sum(digits[i, Q[i]] * strides[i]) if all its digits are
+#non-negative, nkeys otherwise
+def simple_key_encoding(task):
+    lo, hi = (np.asarray(x) for x in task.simple_key_ranges())
+    radices = hi - lo + 1
+    strides = np.concatenate([np.cumprod(radices[:0:-1])[::-1], [1]])
+    tokens = np.arange(task.nvocab)
+    in_range = (tokens >= lo[:, np.newaxis]) & (tokens <= hi[:, np.newaxis])
+    digits = np.where(in_range, tokens - lo[:, np.newaxis], -1)
+    return digits.astype(np.int32), strides.astype(np.int32), int(np.prod(radices))
+
+
+def simple_keys(task, Qs):
+    digits, strides, nkeys = simple_key_encoding(task)
+    Q_digits = digits[np.arange(task.question_length), Qs]
+    return np.where(np.all(Q_digits >= 0, axis=-1), np.sum(Q_digits * strides, axis=-1), nkeys)
+
+
+#returns: (nkeys + 1, answer_length) array, the answers to the simple
+#questions of fast_db by key
+def simple_answer_table(task, fast_db):
+    lo, hi = (np.asarray(x) for x in task.simple_key_ranges())
+    nkeys = np.prod(hi - lo + 1)
+    questions = lo + np.stack(np.unravel_index(np.arange(nkeys), hi - lo + 1), axis=-1)
+    return np.concatenate([task.answers(questions, fast_db),
+                           [task.simple_default_answer()]]).astype(task.token_dtype)
+
+
 def print_interaction(task, Q, subQs, subAs, A, fast_db):
     print("{} ({})".format(
         task.repr_question(Q), task.classify_question(Q, fast_db)))
@@ -1,46 +1,22 @@
-from collections import defaultdict
 import numpy as np
 import random
 
-from amplification.tasks.core import idk, Task, sequences
-
-#yields edges of a random tree on [a, b)
-#if b = a+1, yields nothing
-#if point to is not none, all edges (x, y) have y closer to point_to
-def random_tree(a, b, point_to=None):
-    if a + 1 < b:
-        split = np.random.randint(a+1, b)
-        l = np.random.randint(a, split)
-        r = np.random.randint(split, b)
-        if point_to is None:
-            yield (l, r)
-            yield from random_tree(a, split)
-            yield from random_tree(split, b)
-        else:
-            point_left = point_to < split
-            yield (r, l) if point_left else (l, r)
-            yield from random_tree(a, split, point_to if point_left else l)
-            yield from random_tree(split, b, r if point_left else point_to)
-    elif a >= b:
-        raise ValueError()
-
-def dfs(neighbors_dict, start_node):
-    depths = {start_node: 0}
-    parents = {start_node: start_node}
-
-    stack = [start_node]
-
-    while stack:
-        node = stack.pop()
+from amplification.tasks.core import idk, Task, sequences, random_subsets
+from amplification.tasks.core import candidate_search_state, candidate_search_step
 
-        children = neighbors_dict[node]
-        for child in children:
-            if child not in depths:
-                stack.append(child)
-                depths[child] = depths[node] + 1
-                parents[child] = node
-
-    return parents, depths
+#edges of random trees on each of the ranges [a, b) of positions: ranges of
+#two or more positions are split in two at random, an edge joins a random
+#position left of the split to one right of it, and the halves are split in turn
+def random_trees(a, b):
+    edges = []
+    while True:
+        large = a + 1 < b
+        a, b = a[large], b[large]
+        if len(a) == 0: break
+        split = np.random.randint(a + 1, b)
+        edges.append(np.stack([np.random.randint(a, split), np.random.randint(split, b)], axis=-1))
+        a, b = np.concatenate([a, split]), np.concatenate([split, b])
+    return np.concatenate(edges) if edges else np.zeros((0, 2), dtype=np.int64)
 
 
 class EqualsTask(Task):
@@ -75,6 +51,8 @@ class EqualsTask(Task):
         self.min_char = self.chars[0]
         self.max_char = self.chars[-1]
         self.vars = list(sequences(self.chars, self.length))
+        self.all_vars = np.array(self.vars)
+        self.char_powers = nchars ** np.flip(np.arange(self.length), axis=0)
         self.vals = self.allocate(self.num_vals)
         self.max_d = self.num_vars - self.num_vals
         self.depths = self.allocate(self.max_d + 1)
@@ -84,6 +62,12 @@ class EqualsTask(Task):
         self.fact_length = 2 * length
         self.answer_length = length
         self.question_length = 2 * length
+        # Questions are classified by their kind and the depth of their
+        # variable; questions of no kind are "?"
+        self.question_classes = ["?"] + [self.repr_symbol(q) for q in self.simple_question_tokens] + [
+            "{}{}".format(self.repr_symbol(q), d)
+            for q in [self.value_query, self.parent_query, self.depth_query]
+            for d in range(-1, self.num_vars)]
 
     def encode_n(self, n):
         return np.minimum(self.zero + n, self.largest_d)
@@ -187,83 +171,237 @@ class EqualsTask(Task):
         else:
             yield self.pad(idk), None
 
+    def recursive_step(self, state, subAs):
+        """Vectorized recursive_answer. See core.recursive_run_steps.
+
+        All queries start by asking for a given value (phase 0). Value and
+        depth queries then ask for the parent (1) and its value or depth (2).
+        Parent queries ask twice for a parent and whether it is a neighbor
+        (1-4), then for a neighbor (5) and finally for the depth of each
+        candidate (6).
+        """
+        if subAs is None:
+            Qs = state["Qs"]
+            nqs = len(Qs)
+            qs = Qs[:, 0]
+            x = Qs[:, 1:1+self.length]
+            valid = (np.isin(qs, [self.value_query, self.depth_query, self.parent_query]) &
+                     self.are_chars(x))
+            state = {
+                "qs": qs, "x": x,
+                "phase": np.zeros(nqs, dtype=np.int32),
+                "done": ~valid,
+                "As": idk * np.ones((nqs, self.answer_length), dtype=np.int32),
+            }
+            state.update(candidate_search_state(self, nqs, best=idk, best_score=self.largest_d))
+            state["subQs"] = self.queries(self.simple_value_query, x)
+            return state, state["subQs"], state["done"], state["As"]
+
+        state = dict(state)
+        x, phase = state["x"], state["phase"]
+        nqs = len(phase)
+        active = ~state["done"]
+        is_value = active & (state["qs"] == self.value_query)
+        is_depth = active & (state["qs"] == self.depth_query)
+        is_parent = active & (state["qs"] == self.parent_query)
+        done = np.copy(state["done"])
+        As = np.copy(state["As"])
+        subQs = np.copy(state["subQs"])
+        new_phase = phase + 1
+        def ask(mask, questions):
+            subQs[mask] = questions[mask]
+        def finish(mask, answers):
+            As[mask] = answers[mask]
+            done[mask] = True
+        def pad_rows(a):
+            padding = idk * np.ones((nqs, self.answer_length - 1), dtype=np.int32)
+            return np.concatenate([a[:, np.newaxis], padding], axis=1)
+        y = subAs[:, :self.length]
+        is_var = self.are_chars(y)
+        a = subAs[:, 0]
+        is_val = np.isin(a, self.vals)
+        is_depth_token = np.isin(a, self.depths)
+        parent = self.queries(self.parent_query, x)
+
+        #all queries: is there a given value?
+        given = active & (phase == 0)
+        finish(given & is_val & is_value, pad_rows(a))
+        finish(given & is_val & is_depth, pad_rows(self.zero * np.ones(nqs, dtype=np.int32)))
+        finish(given & is_val & is_parent, x)
+        ask(given & ~is_val, parent)
+
+        #value and depth queries: the parent's value or depth
+        follow = (is_value | is_depth) & (phase == 1)
+        finish(follow & ~is_var, As)
+        ask(follow & is_var & is_value, self.queries(self.value_query, y))
+        ask(follow & is_var & is_depth, self.queries(self.depth_query, y))
+        finish(is_value & (phase == 2), pad_rows(np.where(is_val, a, idk)))
+        finish(is_depth & (phase == 2),
+               pad_rows(np.where(is_depth_token, self.encode_n(a - self.zero + 1), idk)))
+
+        #parent queries: the shallowest of two proposed parents and a neighbor
+        state.update(candidate_search_step(
+            self, state, subAs, is_parent, passed=a == self.zero, propose=parent,
+            check=lambda y: self.make_edge_queries(x, y),
+            neighbor=self.queries(self.neighbor_query, x),
+            score=lambda y: self.queries(self.depth_query, y),
+            is_better=lambda y, d, best_d: is_depth_token & (d <= best_d),
+            ask=ask, finish=finish, new_phase=new_phase))
+
+        state.update(phase=new_phase, done=done, As=As, subQs=subQs)
+        return state, subQs, done, As
+
+    #vectorized make_value_query, make_parent_query etc.
+    def queries(self, symbol, x):
+        padding = idk * np.ones((len(x), self.question_length - 1 - self.length), dtype=np.int32)
+        return np.concatenate([symbol * np.ones((len(x), 1), dtype=np.int32), x, padding], axis=1)
+
+    def make_edge_queries(self, x, y):
+        return np.concatenate([x, y], axis=1)
+
+    #1 + the position of each variable in self.vars, 0 for non-variables
+    def indices(self, xs):
+        return np.where(self.are_chars(xs),
+                        1 + np.sum((xs - self.min_char) * self.char_powers, axis=-1), 0)
+
     def make_dbs(self, difficulty=float('inf')):
+        facts, fast_dbs = self.make_dbs_batch(1, difficulty)
+        return facts[0], fast_dbs[0]
+
+    def make_dbs_batch(self, nbatch, difficulty=float('inf')):
         difficulty = min(self.num_vars, difficulty)
         num_used_vars = min(difficulty + 10, self.num_vars)
         num_used_vals = min(int(np.sqrt(difficulty+10)), self.num_vals)
-        used_vars = random.sample(self.vars, num_used_vars)
-        used_vals = np.random.choice(self.vals, num_used_vals, replace=False)
-        value_list = np.random.choice(used_vals, num_used_vars, replace=True)
-        state = {}
-        given_values = {}
-        given_equivalences = []
-        neighbors = defaultdict(list)
-        equivalence_classes = defaultdict(list)
-        for var, val in zip(used_vars, value_list):
-            equivalence_classes[val].append(var)
-            state[var] = val
-        for val, vs in equivalence_classes.items():
-            root = random.choice(vs)
-            given_values[root] = val
-            tree = random_tree(0, len(vs), point_to=root if self.easy else None)
-            given_equivalences.extend([(vs[i], vs[j]) for i, j in tree])
-        for x, y in given_equivalences:
-            neighbors[x].append(y)
-            neighbors[y].append(x)
-        facts = np.array(
-            [self.pad(tuple(var) + (val,), self.fact_length) for var, val in given_values.items()] +
-            [self.pad(tuple(var1) + tuple(var2), self.fact_length) for var1, var2 in given_equivalences])
-
-        parents = {}
-        depths = {}
-        for y in given_values:
-            new_parents, new_depths = dfs(neighbors, y)
-            parents.update(new_parents)
-            depths.update(new_depths)
-
-        fast_db = {"givens": given_values, "neighbors": neighbors, "values": state, "inverse": equivalence_classes,
-                   'depths': depths, 'parents':parents,
-                   "used_vars":used_vars}
-
-        return facts, fast_db
-
-    def classify_question(self, Q, fast_db):
-        Q = tuple(Q)
-        t = self.repr_symbol(Q[0])
-        if Q[0] in self.simple_question_tokens:
-            return t
-        return "{}{}".format(t, fast_db['depths'][Q[1:1+self.length]])
+        nrows = num_used_vars + 1
+        batch_indices = np.arange(nbatch)[:, np.newaxis]
+        used_indices = random_subsets(nbatch, self.num_vars, num_used_vars)
+        used_vars = self.all_vars[used_indices]
+        used_vals = self.vals[random_subsets(nbatch, self.num_vals, num_used_vals)]
+        classes = np.random.randint(num_used_vals, size=(nbatch, num_used_vars))
+        values = used_vals[batch_indices, classes]
+
+        #the variables of each environment are rows 1 to num_used_vars of its
+        #arrays, and row 0 stands for idk and unused variables; here they are
+        #numbered across the batch and grouped by equivalence class
+        rows = (nrows * batch_indices + np.arange(1, nrows)).ravel()
+        classes = (num_used_vals * batch_indices + classes).ravel()
+        members = rows[np.argsort(classes, kind="stable")]
+        sizes = np.bincount(classes, minlength=nbatch * num_used_vals)
+        ends = np.cumsum(sizes)[sizes > 0]
+        starts = ends - sizes[sizes > 0]
+        roots = members[np.random.randint(starts, ends)]
+        edges = members[random_trees(starts, ends)]
+
+        #depths and parents, spreading out from the roots
+        depths = -np.ones(nbatch * nrows, dtype=np.int32)
+        parents = np.zeros(nbatch * nrows, dtype=np.int32)
+        depths[roots] = 0
+        parents[roots] = roots
+        sources = np.concatenate([edges[:, 0], edges[:, 1]])
+        targets = np.concatenate([edges[:, 1], edges[:, 0]])
+        while True:
+            reached = (depths[sources] >= 0) & (depths[targets] < 0)
+            if not np.any(reached): break
+            depths[targets[reached]] = depths[sources[reached]] + 1
+            parents[targets[reached]] = sources[reached]
+        if self.easy:
+            #point every edge to the root
+            edges = np.where((depths[edges[:, 0]] < depths[edges[:, 1]])[:, np.newaxis],
+                             edges[:, ::-1], edges)
+
+        #the given values, then the given equivalences, of each environment
+        unindex = np.concatenate([idk * np.ones((nbatch, 1, self.length), dtype=used_vars.dtype),
+                                  used_vars], axis=1).reshape(nbatch * nrows, self.length)
+        values = np.concatenate([idk * np.ones((nbatch, 1), dtype=values.dtype), values],
+                                axis=1).ravel()
+        given_facts = np.concatenate([unindex[roots], values[roots, np.newaxis],
+                                      idk * np.ones((len(roots), self.length - 1),
+                                                    dtype=values.dtype)], axis=1)
+        equivalence_facts = np.concatenate([unindex[edges[:, 0]], unindex[edges[:, 1]]], axis=1)
+        facts = np.concatenate([given_facts, equivalence_facts])
+        order = np.argsort(np.concatenate([roots, edges[:, 0]]) // nrows, kind="stable")
+        facts = facts[order].reshape(nbatch, num_used_vars, self.fact_length)
+
+        givens = idk * np.ones(nbatch * nrows, dtype=values.dtype)
+        givens[roots] = values[roots]
+        #the neighbors of row r are neighbors[neighbor_starts[r]:neighbor_starts[r+1]]
+        order = np.argsort(sources, kind="stable")
+        neighbors = targets[order] % nrows
+        neighbor_starts = np.concatenate([[0], np.cumsum(np.bincount(sources, minlength=nbatch * nrows))])
+        #index[b, i] is the row of the variable with index i (see indices)
+        index = np.zeros((nbatch, self.num_vars + 1), dtype=np.int32)
+        index[batch_indices, 1 + used_indices] = np.arange(1, nrows)
+
+        fast_dbs = []
+        for b in range(nbatch):
+            environment = slice(b * nrows, (b + 1) * nrows)
+            starts = neighbor_starts[b * nrows:(b + 1) * nrows + 1]
+            fast_dbs.append({
+                "used_vars": used_vars[b], "unindex": unindex[environment], "index": index[b],
+                "givens": givens[environment], "values": values[environment],
+                "depths": depths[environment], "parents": parents[environment] % nrows,
+                "neighbor_starts": starts - starts[0], "neighbors": neighbors[starts[0]:starts[-1]]})
+        return facts, fast_dbs
+
+    def classify_questions(self, Qs, fast_db):
+        qs = Qs[:, 0]
+        #depth -1 is the variables that aren't in the environment
+        depths = fast_db["depths"][fast_db["index"][self.indices(Qs[:, 1:1+self.length])]]
+        classes = np.zeros(len(Qs), dtype=np.int32)
+        for i, q in enumerate(self.simple_question_tokens):
+            classes[qs == q] = 1 + i
+        for i, q in enumerate([self.value_query, self.parent_query, self.depth_query]):
+            is_q = qs == q
+            classes[is_q] = 3 + i * (self.num_vars + 1) + 1 + depths[is_q]
+        return classes
 
     def make_q(self, fast_db):
         q = random.choice([self.value_query, self.parent_query, self.depth_query])
         v = random.choice(fast_db["used_vars"])
-        return self.pad((q,) + v, self.question_length)
+        return self.pad((q,) + tuple(v), self.question_length)
 
-    def answer(self, Q, fast_db):
-        Q = tuple(Q)
-        x = Q[1:1+self.length]
-        if Q[0] == self.simple_value_query:
-            return self.pad(fast_db["givens"].get(x, idk))
-        elif Q[0] == self.neighbor_query:
-            neighbors = fast_db["neighbors"].get(x, [])
-            if neighbors:
-                return self.pad(random.choice(neighbors))
-            else:
-                return self.pad(idk)
-        elif Q[0] == self.depth_query:
-            if x in fast_db["depths"]:
-                return self.pad(self.encode_n(fast_db["depths"][x]))
-            else:
-                return self.pad(idk)
-        elif Q[0] == self.parent_query:
-            return self.pad(fast_db["parents"].get(x, idk))
-        elif Q[0] == self.value_query:
-            return self.pad(fast_db["values"].get(x, idk))
-        else:
-            if Q[:self.length] in fast_db["neighbors"]:
-                if Q[self.length:2*self.length] in fast_db["neighbors"][Q[:self.length]]:
-                    return self.pad(self.zero)
-            return self.pad(idk)
+    def make_qs_batch(self, nqs, fast_dbs):
+        used_vars = np.array([fast_db["used_vars"] for fast_db in fast_dbs])
+        nbatch = len(fast_dbs)
+        qs = np.random.choice([self.value_query, self.parent_query, self.depth_query],
+                              (nbatch, nqs, 1))
+        vs = used_vars[np.arange(nbatch)[:, np.newaxis],
+                       np.random.randint(used_vars.shape[1], size=(nbatch, nqs))]
+        padding = idk * np.ones((nbatch, nqs, self.question_length - 1 - self.length),
+                                dtype=vs.dtype)
+        return np.concatenate([qs, vs, padding], axis=2)
+
+    def answers(self, Qs, fast_db):
+        qs = Qs[:, 0]
+        x = fast_db["index"][self.indices(Qs[:, 1:1+self.length])]
+        As = idk * np.ones((len(Qs), self.answer_length), dtype=np.int32)
+        b = qs == self.simple_value_query
+        As[b, 0] = fast_db["givens"][x[b]]
+        b = qs == self.neighbor_query
+        if np.any(b):
+            #a random one of the neighbors, if there are any
+            starts = fast_db["neighbor_starts"][x[b]]
+            counts = fast_db["neighbor_starts"][x[b] + 1] - starts
+            choices = starts + np.floor(np.random.random(len(starts)) * counts).astype(np.int32)
+            neighbors = np.concatenate([[0], fast_db["neighbors"]])
+            As[b] = fast_db["unindex"][neighbors[np.where(counts > 0, 1 + choices, 0)]]
+        b = qs == self.depth_query
+        As[b, 0] = np.where(x[b] > 0, self.encode_n(fast_db["depths"][x[b]]), idk)
+        b = qs == self.parent_query
+        As[b] = fast_db["unindex"][fast_db["parents"][x[b]]]
+        b = qs == self.value_query
+        As[b, 0] = fast_db["values"][x[b]]
+        #anything else asks whether its first two variables are neighbors
+        b = (qs < self.value_query) | (qs > self.depth_query)
+        if np.any(b):
+            x = fast_db["index"][self.indices(Qs[b, :self.length])]
+            y = fast_db["index"][self.indices(Qs[b, self.length:2*self.length])]
+            starts = fast_db["neighbor_starts"]
+            nrows = len(starts) - 1
+            sources = np.repeat(np.arange(nrows), np.diff(starts))
+            is_edge = (x > 0) & np.isin(nrows * x + y, nrows * sources + fast_db["neighbors"])
+            As[b, 0] = np.where(is_edge, self.zero, idk)
+        return As
 
     def all_questions(self, fast_db):
         for var in self.vars:
@@ -1,9 +1,8 @@
-import random
 from collections import defaultdict
 
 import numpy as np
 
-from amplification.tasks.core import idk, is_known, uniform, Task, sequences
+from amplification.tasks.core import idk, is_known, uniform, Task, sequences, random_subsets
 
 class BaseEvalTask(Task):
     fact_length = 3
@@ -51,45 +50,86 @@ class BaseEvalTask(Task):
         self.min_char = self.chars[0]
         self.max_char = self.chars[-1]
         self.vars = list(sequences(self.chars, length))
+        self.all_vars = np.array(self.vars)
+        self.char_powers = nchars ** np.flip(np.arange(self.length), axis=0)
         self.make_values(**f_args)
+        # Questions about variables not in the environment are "?"
+        self.question_classes = ["?", "simple", "f"] + [str(d) for d in range(self.size)]
 
     def are_chars(self, x):
         return np.logical_and(np.all(x >= self.min_char, axis=-1), np.all(x <= self.max_char, axis=-1))
 
+    #1 + the position of each variable in self.vars, 0 for non-variables
+    def indices(self, xs):
+        return np.where(self.are_chars(xs),
+                        1 + np.sum((xs - self.min_char) * self.char_powers, axis=-1), 0)
+
     def make_dbs(self, difficulty=float('inf')):
+        facts, fast_dbs = self.make_dbs_batch(1, difficulty)
+        return facts[0], fast_dbs[0]
+
+    def make_dbs_batch(self, nbatch, difficulty=float('inf')):
         instance_size = min(difficulty+8, self.size)
-        unused_vars = set(self.vars)
-        values = {}
-        depths = {}
-        assignments = {}
-        facts = []
-        f_db, f_facts = self.make_f_db()
-        facts.extend(f_facts)
-        def choice(S): return random.choice(tuple(S))
-        for _ in range(instance_size):
-            x = choice(unused_vars)
-            if len(values) < int(np.sqrt(instance_size)):
-                val = self.sample_val(f_db)
-                assignments[x] = [val]
-                depths[x] = 0
-                facts.append(x + (val,))
-            else:
-                y = choice(values)
-                z = choice(values)
-                assignments[x] = [y, z]
-                depths[x] = max(depths[y], depths[z]) + 1
-                facts.append(x + y + z)
-                val, f_facts = self.apply_f(values[y], values[z], f_db)
-                facts.extend(f_facts)
-            values[x] = val
-            unused_vars.remove(x)
-        fast_db = {}
-        fast_db["values"] = values
-        fast_db["assignments"] = assignments
-        fast_db["depths"] = depths
-        fast_db["used_vars"] = np.array(list(values))
-        fast_db["f"] = f_db
-        return np.asarray([self.pad(fact, self.fact_length) for fact in facts]), fast_db
+        num_given = int(np.sqrt(instance_size))
+        nrows = instance_size + 1
+        batch_indices = np.arange(nbatch)[:, np.newaxis]
+        used_indices = random_subsets(nbatch, self.size, instance_size)
+        used_vars = self.all_vars[used_indices]
+        #the variables of each environment are rows 1 to instance_size of its
+        #arrays, in the order they are defined, and row 0 stands for idk and
+        #unused variables. The first num_given are given values, the others
+        #apply f to the values of two earlier ones, operands[b, row].
+        rows = np.arange(1, nrows)
+        operands = np.zeros((nbatch, nrows, 2), dtype=np.int32)
+        operands[:, 1 + num_given:] = 1 + np.floor(
+            np.random.random((nbatch, instance_size - num_given, 2)) *
+            np.arange(num_given, instance_size)[:, np.newaxis]).astype(np.int32)
+        compound = np.arange(nrows) > num_given
+        depths = np.zeros((nbatch, nrows), dtype=np.int32)
+        while True:
+            new_depths = np.where(compound, 1 + np.max(
+                depths[batch_indices[:, :, np.newaxis], operands], axis=-1), 0)
+            if np.all(new_depths == depths): break
+            depths = new_depths
+        #values, one depth at a time
+        f_tables = self.make_f_tables(nbatch)
+        values = idk * np.ones((nbatch, nrows), dtype=np.int32)
+        values[:, 1:1 + num_given] = self.sample_vals((nbatch, num_given))
+        for depth in range(1, np.max(depths) + 1):
+            b, row = np.nonzero(depths == depth)
+            values[b, row] = self.apply_fs(values[b, operands[b, row, 0]],
+                                           values[b, operands[b, row, 1]], b, f_tables)
+
+        unindex = np.concatenate([idk * np.ones((nbatch, 1, self.length), dtype=used_vars.dtype),
+                                  used_vars], axis=1)
+        given_facts = np.concatenate([used_vars[:, :num_given],
+                                      values[:, 1:1 + num_given, np.newaxis]], axis=2)
+        compound_facts = np.concatenate(
+            [used_vars[:, num_given:], unindex[batch_indices, operands[:, 1 + num_given:, 0]],
+             unindex[batch_indices, operands[:, 1 + num_given:, 1]]], axis=2)
+        f_facts, f_dbs = self.make_f_facts(values[batch_indices, operands[:, 1 + num_given:, 0]],
+                                           values[batch_indices, operands[:, 1 + num_given:, 1]],
+                                           f_tables)
+        if f_facts is not None:
+            #each compound variable is followed by its f fact
+            compound_facts = np.reshape(np.stack([
+                self.pad_facts(compound_facts), self.pad_facts(f_facts)], axis=2),
+                (nbatch, -1, self.fact_length))
+        facts = np.concatenate([self.pad_facts(given_facts), self.pad_facts(compound_facts)],
+                               axis=1)
+        #index[b, i] is the row of the variable with index i (see indices)
+        index = np.zeros((nbatch, self.size + 1), dtype=np.int32)
+        index[batch_indices, 1 + used_indices] = rows
+        fast_dbs = [{"used_vars": v, "unindex": u, "index": i, "operands": o, "values": x,
+                     "depths": d, "f": f}
+                    for v, u, i, o, x, d, f in zip(used_vars, unindex, index, operands, values,
+                                                   depths, f_dbs)]
+        return facts, fast_dbs
+
+    def pad_facts(self, facts):
+        padding = idk * np.ones(facts.shape[:-1] + (self.fact_length - facts.shape[-1], ),
+                                dtype=facts.dtype)
+        return np.concatenate([facts, padding], axis=-1)
 
     def make_qs(self, nqs, fast_db):
         indices = np.random.randint(len(fast_db["used_vars"]), size=nqs)
@@ -97,7 +137,16 @@ class BaseEvalTask(Task):
         queries = self.compound_query * np.ones((nqs, 1))
         padding = idk * np.ones((nqs, self.question_length - 1 - self.length))
         return np.concatenate([queries, vs, padding], axis=1).astype(np.int32)
-    
+
+    def make_qs_batch(self, nqs, fast_dbs):
+        used_vars = np.stack([fast_db["used_vars"] for fast_db in fast_dbs])
+        nbatch = len(fast_dbs)
+        indices = np.random.randint(used_vars.shape[1], size=(nbatch, nqs))
+        vs = used_vars[np.arange(nbatch)[:, np.newaxis], indices]
+        queries = self.compound_query * np.ones((nbatch, nqs, 1))
+        padding = idk * np.ones((nbatch, nqs, self.question_length - 1 - self.length))
+        return np.concatenate([queries, vs, padding], axis=2).astype(np.int32)
+
     def recursive_answer(self, Q):
         Q = tuple(Q)
         if Q[0] == self.compound_query:
@@ -113,31 +162,79 @@ class BaseEvalTask(Task):
         else:
             yield self.pad(idk), None
 
-    def answer(self, Q, fast_db):
-        #TODO: This is very slow, should vectorize
-        Q = tuple(Q)
-        f_A = self.answer_f_question(Q, fast_db['f'])
-        if f_A is not None: return f_A
-        x = Q[1:1+self.length]
-        if Q[0] in self.simple_question_tokens:
-            if x not in fast_db["assignments"]:
-                return self.pad(idk)
-            result = fast_db["assignments"][x]
-            if fast_db["depths"][x] == 0:
-                return self.pad(result)
-            else:
-                if Q[0] == self.simple_query_a:
-                    return self.pad(result[0])
-                elif Q[0] == self.simple_query_b:
-                    return self.pad(result[1])
-                assert False
-        elif Q[0] == self.compound_query and x in fast_db["values"]:
-            return self.pad(fast_db["values"][x])
-        else:
-            return self.pad(idk)
+    def recursive_step(self, state, subAs):
+        """Vectorized recursive_answer. See core.recursive_run_steps.
+
+        Phases 0 and 2 ask for the operands of the queried variable, phases 1
+        and 3 for the operands' values. Then recursive_apply_f_step takes over.
+        """
+        Qs = state["Qs"]
+        nqs = len(Qs)
+        def query(q, xs):
+            padding = idk * np.ones((nqs, self.question_length - 1 - xs.shape[1]), dtype=np.int32)
+            return np.concatenate([q * np.ones((nqs, 1), dtype=np.int32), xs, padding], axis=1)
+        if subAs is None:
+            state = {
+                "Qs": Qs,
+                "phase": np.zeros(nqs, dtype=np.int32),
+                "vals": np.zeros((nqs, 2), dtype=np.int32),
+                "done": Qs[:, 0] != self.compound_query,
+                "As": idk * np.ones((nqs, self.answer_length), dtype=np.int32),
+                "subQs": query(self.simple_query_a, Qs[:, 1:]),
+            }
+            return state, state["subQs"], state["done"], state["As"]
+
+        state = dict(state)
+        phase = state["phase"]
+        active = ~state["done"]
+        done = np.copy(state["done"])
+        As = np.copy(state["As"])
+        vals = np.copy(state["vals"])
+        subQs = np.copy(state["subQs"])
+
+        asked_var = active & ((phase == 0) | (phase == 2))
+        not_var = asked_var & ~self.are_chars(subAs[:, :self.length])
+        As[not_var] = subAs[not_var]
+        done |= not_var
+        asked_var &= ~not_var
+        subQs[asked_var] = query(self.compound_query, subAs[:, :self.length])[asked_var]
+
+        for i, p in enumerate([1, 3]):
+            vals[active & (phase == p), i] = subAs[active & (phase == p), 0]
+        subQs[active & (phase == 1)] = query(self.simple_query_b, Qs[:, 1:])[active & (phase == 1)]
+
+        in_f = active & (phase >= 3)
+        f_subQs, f_done, f_results = self.recursive_apply_f_step(
+            vals[:, 0], vals[:, 1], phase - 3, subAs)
+        finished = in_f & f_done
+        As[finished, 0] = f_results[finished]
+        done |= finished
+        subQs[in_f & ~f_done] = f_subQs[in_f & ~f_done]
+
+        phase = np.where(done, phase, phase + 1)
+        state.update(phase=phase, done=done, As=As, vals=vals, subQs=subQs)
+        return state, subQs, done, As
+
+    def answers(self, Qs, fast_db):
+        qs = Qs[:, 0]
+        x = fast_db["index"][self.indices(Qs[:, 1:1+self.length])]
+        As = idk * np.ones((len(Qs), self.answer_length), dtype=np.int32)
+        #the operands of compound variables, the value of given ones
+        simple = np.isin(qs, self.simple_question_tokens) & (x > 0)
+        given = simple & (fast_db["depths"][x] == 0)
+        for i, q in enumerate(self.simple_question_tokens):
+            b = simple & ~given & (qs == q)
+            As[b, :self.length] = fast_db["unindex"][fast_db["operands"][x[b], i]]
+        As[given, 0] = fast_db["values"][x[given]]
+        b = qs == self.compound_query
+        As[b, 0] = fast_db["values"][x[b]]
+        f_questions, f_As = self.answer_f_questions(Qs, fast_db["f"])
+        if np.any(f_questions):
+            As[f_questions] = f_As[f_questions]
+        return As
 
     def all_questions(self, fast_db):
-        for x in fast_db["values"]: yield [self.compound_query, x]
+        for x in fast_db["used_vars"]: yield [self.compound_query, tuple(x)]
 
     def is_f_simple(self, Q):
         return self.are_f_simple(np.stack([Q], axis=0))[0]
@@ -145,13 +242,13 @@ class BaseEvalTask(Task):
     def are_simple(self, Qs):
         return np.logical_or(super().are_simple(Qs), self.are_f_simple(Qs))
 
-    def classify_question(self, Q, fast_db):
-        Q = tuple(Q)
-        if Q[0] in self.simple_question_tokens:
-            return "simple"
-        if self.is_f_simple(Q):
-            return "f"
-        return fast_db["depths"][Q[1:1+self.length]]
+    def classify_questions(self, Qs, fast_db):
+        x = fast_db["index"][self.indices(Qs[:, 1:1+self.length])]
+        #other questions are classified by the depth of their variable
+        classes = np.where(x > 0, 3 + fast_db["depths"][x], 0)
+        classes[self.are_f_simple(Qs)] = 2
+        classes[np.isin(Qs[:, 0], self.simple_question_tokens)] = 1
+        return classes
 
 class EvalSumTask(BaseEvalTask):
     f_interaction_length = 0
@@ -169,8 +266,8 @@ class EvalSumTask(BaseEvalTask):
             self.numbers = self.allocate(self.modulus)
             self.zero = self.numbers[0]
 
-    def apply_f(self, a, b, f_db):
-        return self.encode_n(a + b - 2 * self.zero), []
+    def apply_fs(self, a, b, batch_indices, f_tables):
+        return self.encode_n(a + b - 2 * self.zero)
 
     def encode_n(self, x):
         if self.modulus is None:
@@ -178,11 +275,11 @@ class EvalSumTask(BaseEvalTask):
         else:
             return self.zero + np.mod(x, self.modulus)
 
-    def sample_val(self, f_db):
-        return self.encode_n(random.choice([-1, +1]))
+    def sample_vals(self, shape):
+        return self.encode_n(np.random.choice([-1, +1], shape))
 
-    def answer_f_question(self, Q, f_db):
-        return None
+    def answer_f_questions(self, Qs, f_db):
+        return np.zeros(len(Qs), dtype=np.bool_), None
     
     def repr_f_symbol(self, x):
         if x in self.numbers:
@@ -196,8 +293,17 @@ class EvalSumTask(BaseEvalTask):
             return idk
         return self.encode_n((a - self.zero) + (b - self.zero))
 
-    def make_f_db(self):
-        return {}, []
+    def recursive_apply_f_step(self, a, b, f_phase, subAs):
+        valid = np.isin(a, self.numbers) & np.isin(b, self.numbers)
+        results = np.where(valid, self.encode_n((a - self.zero) + (b - self.zero)), idk)
+        subQs = np.zeros((len(a), self.question_length), dtype=np.int32)
+        return subQs, np.ones(len(a), dtype=np.bool_), results
+
+    def make_f_tables(self, nbatch):
+        return None
+
+    def make_f_facts(self, a, b, f_tables):
+        return None, [None] * len(a)
 
     def are_f_simple(self, Qs):
         nq = Qs.shape[0]
@@ -213,19 +319,41 @@ class EvalTask(BaseEvalTask):
         self.num_vals = int(np.sqrt(self.size))
         self.vals = self.allocate(self.num_vals)
 
-    def apply_f(self, a, b, f_db):
-        if (a, b) not in f_db:
-            c = np.random.choice(self.vals)
-            f_db[(a, b)] = c
-            return c, [(a, b, c)]
-        return f_db[(a, b)], [()]
-
-    def sample_val(self, f_db):
-        return np.random.choice(self.vals)
-
-    def answer_f_question(self, Q, f_db):
-        Q = (Q[0], Q[1])
-        if Q in f_db: return self.pad(f_db[Q])
+    #f_tables[b, a, c] is f(vals[a], vals[c]) in environment b, drawn up
+    #front for every pair of values
+    def make_f_tables(self, nbatch):
+        return np.random.choice(self.vals, (nbatch, self.num_vals, self.num_vals))
+
+    def apply_fs(self, a, b, batch_indices, f_tables):
+        return f_tables[batch_indices, a - self.vals[0], b - self.vals[0]]
+
+    #a fact for the first application of f to each pair of values and an
+    #empty one for the others; fast_db["f"] only has the pairs with facts
+    def make_f_facts(self, a, b, f_tables):
+        nbatch = len(a)
+        batch_indices = np.arange(nbatch)[:, np.newaxis]
+        a, b = a - self.vals[0], b - self.vals[0]
+        c = f_tables[batch_indices, a, b]
+        pairs = (batch_indices * self.num_vals + a) * self.num_vals + b
+        first = np.zeros(pairs.size, dtype=np.bool_)
+        first[np.unique(pairs, return_index=True)[1]] = True
+        first = np.reshape(first, pairs.shape)
+        f_facts = np.where(first[:, :, np.newaxis],
+                           np.stack([a + self.vals[0], b + self.vals[0], c], axis=-1), idk)
+        f_dbs = idk * np.ones_like(f_tables)
+        f_dbs[batch_indices, a, b] = c
+        return f_facts, f_dbs
+
+    def sample_vals(self, shape):
+        return np.random.choice(self.vals, shape)
+
+    def answer_f_questions(self, Qs, f_db):
+        a, b = Qs[:, 0] - self.vals[0], Qs[:, 1] - self.vals[0]
+        f_questions = np.isin(Qs[:, 0], self.vals)
+        known = f_questions & np.isin(Qs[:, 1], self.vals)
+        As = idk * np.ones((len(Qs), self.answer_length), dtype=np.int32)
+        As[known, 0] = f_db[a[known], b[known]]
+        return f_questions, As
 
     def repr_f_symbol(self, x):
         if x in self.vals: return "x{}".format(x)
@@ -240,8 +368,17 @@ class EvalTask(BaseEvalTask):
             return idk
         return result
 
-    def make_f_db(self):
-        return {}, []
+    #f_phase is 0 when the operands' values have just been found and 1 when
+    #the answer to the f question comes back
+    def recursive_apply_f_step(self, a, b, f_phase, subAs):
+        valid = np.isin(a, self.vals) & np.isin(b, self.vals)
+        padding = idk * np.ones((len(a), self.question_length - 2), dtype=np.int32)
+        subQs = np.concatenate([a[:, np.newaxis], b[:, np.newaxis], padding], axis=1)
+        done = (f_phase > 0) | ~valid
+        result = subAs[:, 0]
+        results = np.where((f_phase > 0) & np.isin(result, self.vals), result, idk)
+        return subQs, done, results
 
     def are_f_simple(self, Qs):
         return np.logical_and(np.isin(Qs[:,0], self.vals), np.isin(Qs[:,1], self.vals))
+
@@ -1,9 +1,9 @@
 import random
-from collections import defaultdict
 
 import numpy as np
 
-from amplification.tasks.core import idk, uniform, Task, sequences, lexless
+from amplification.tasks.core import idk, uniform, Task, sequences, lexless, random_subsets
+from amplification.tasks.core import candidate_search_state, candidate_search_step
 
 #2**log(x) >= x
 def log(x):
@@ -13,6 +13,53 @@ def add_logs(l1, l2, powers):
     if l1 not in powers or l2 not in powers: return powers[-1]
     return min(max(l1, l2) + 1, powers[-1])
 
+#edges: (nbatch, nedges, 2) array of vertex numbers in [1, n]
+#returns: (nbatch, n + 1, n + 1) array of shortest path lengths, far for
+#unreachable pairs, the length of the shortest cycle through a vertex on the
+#diagonal; vertex 0 has no edges
+#Expands the frontiers of all sources at once, as bitsets over the sources:
+#bit s of frontier[b, v] says that v is the given distance away from s.
+def shortest_paths(edges, n, far):
+    nbatch = len(edges)
+    n1 = n + 1
+    #one row of frontier per vertex of each environment, edges by target
+    sources = (n1 * np.arange(nbatch)[:, np.newaxis] + edges[:, :, 0]).ravel()
+    targets = (n1 * np.arange(nbatch)[:, np.newaxis] + edges[:, :, 1]).ravel()
+    order = np.argsort(targets, kind="stable")
+    sources, targets = sources[order], targets[order]
+    starts = np.flatnonzero(np.concatenate([[True], targets[1:] != targets[:-1]]))
+    def expand(frontier):
+        result = np.zeros_like(frontier)
+        result[targets[starts]] = np.bitwise_or.reduceat(frontier[sources], starts, axis=0)
+        return result
+    def unpack(bits):
+        return np.unpackbits(bits.view(np.uint8), axis=1, count=n1)
+    #in words of 64 bits, since the work is per word
+    identity = np.packbits(np.eye(n1, dtype=np.bool_), axis=1)
+    identity = np.pad(identity, [(0, 0), (0, -identity.shape[1] % 8)]).view(np.uint64)
+    frontier = expand(np.tile(identity, (nbatch, 1)))
+    reached = frontier
+    #a pair's distance is 1 + the number of expansions it wasn't reached before
+    distances = np.ones((nbatch * n1, n1), dtype=np.int32)
+    while np.any(frontier):
+        distances += unpack(~reached)
+        frontier = expand(frontier) & ~reached
+        reached = reached | frontier
+    distances[unpack(reached) == 0] = far
+    #distances[b, v, s] is the distance from s to v
+    return np.transpose(np.reshape(distances, (nbatch, n1, n1)), (0, 2, 1))
+
+#the same, by Floyd–Warshall
+def floyd_warshall(edges, n, far):
+    nbatch = len(edges)
+    batch_indices = np.arange(nbatch)[:, np.newaxis]
+    distances = far * np.ones((nbatch, n + 1, n + 1), dtype=np.int32)
+    distances[batch_indices, edges[:, :, 0], edges[:, :, 1]] = 1
+    for k in range(1, n + 1):
+        np.minimum(distances, distances[:, :, k, np.newaxis] + distances[:, np.newaxis, k, :],
+                   out=distances)
+    return distances
+
 class GraphTask(Task):
     distance_query_symbol = 1
     step_query_symbol = 2
@@ -159,53 +206,135 @@ class GraphTask(Task):
         else:
             yield self.pad(idk), None
 
+    def recursive_step(self, state, subAs):
+        """Vectorized recursive_answer. See core.recursive_run_steps.
+
+        Distance queries go through phases 0 (is there an edge?), 1 (which
+        step?) and 2 (distance from there). Step queries ask whether there is
+        an edge (0), then twice for a step and whether it is an edge (1-4),
+        then for a neighbor (5) and finally for the distance from each
+        candidate (6).
+        """
+        if subAs is None:
+            Qs = state["Qs"]
+            nqs = len(Qs)
+            qs, a, b = self.split_questions(Qs)
+            state = {
+                "qs": qs, "a": a, "b": b,
+                "phase": np.zeros(nqs, dtype=np.int32),
+                "done": ~np.isin(qs, [self.distance_query_symbol, self.step_query_symbol]),
+                "As": idk * np.ones((nqs, self.answer_length), dtype=np.int32),
+            }
+            state.update(candidate_search_state(self, nqs, best=self.inf, best_score=self.inf))
+            state["subQs"] = self.queries(self.edge_query_symbol, a, b)
+            return state, state["subQs"], state["done"], state["As"]
+
+        state = dict(state)
+        a, b, phase = state["a"], state["b"], state["phase"]
+        nqs = len(phase)
+        active = ~state["done"]
+        is_distance = active & (state["qs"] == self.distance_query_symbol)
+        is_step = active & (state["qs"] == self.step_query_symbol)
+        done = np.copy(state["done"])
+        As = np.copy(state["As"])
+        subQs = np.copy(state["subQs"])
+        new_phase = phase + 1
+        is_edge = subAs[:, 0] == self.one
+        is_vertex = self.are_chars(subAs)
+        def ask(mask, questions):
+            subQs[mask] = questions[mask]
+        def finish(mask, answers):
+            As[mask] = answers[mask]
+            done[mask] = True
+        step = self.queries(self.step_query_symbol, a, b)
+
+        #both kinds of query: was there an edge?
+        edge = (is_distance | is_step) & (phase == 0)
+        finish(edge & is_distance & is_edge,
+               self.pad_rows(self.one * np.ones((nqs, 1), dtype=np.int32)))
+        finish(edge & is_step & is_edge, self.pad_rows(b))
+        ask(edge & ~is_edge, step)
+
+        #distance queries
+        ask(is_distance & (phase == 1) & is_vertex,
+            self.queries(self.distance_query_symbol, subAs, b))
+        finish(is_distance & (phase == 1) & ~is_vertex,
+               self.pad_rows(self.inf * np.ones((nqs, 1), dtype=np.int32)))
+        d = subAs[:, 0]
+        finish(is_distance & (phase == 2),
+               self.pad_rows(np.where(np.isin(d, self.distances), np.minimum(d + 1, self.inf), idk)[:, np.newaxis]))
+
+        #step queries: the best of two proposed steps and a neighbor
+        def is_better(x, d, best_d):
+            return (np.isin(d, self.distances) & (d < self.inf) &
+                    ((d < best_d) | ((d == best_d) & lexless(x, subAs))))
+        state.update(candidate_search_step(
+            self, state, subAs, is_step, passed=is_edge, propose=step,
+            check=lambda x: self.queries(self.edge_query_symbol, a, x),
+            neighbor=self.queries(self.neighbor_query_symbol, a, idk * np.ones_like(a)),
+            score=lambda x: self.queries(self.distance_query_symbol, x, b),
+            is_better=is_better, ask=ask, finish=finish, new_phase=new_phase))
+
+        state.update(phase=new_phase, done=done, As=As, subQs=subQs)
+        return state, subQs, done, As
+
+    #vectorized distance_query, step_query, edge_query and neighbor_query
+    def queries(self, symbol, a, b):
+        return np.concatenate([symbol * np.ones((len(a), 1), dtype=np.int32), a, b], axis=1)
+
+    def pad_rows(self, As):
+        padding = idk * np.ones((len(As), self.answer_length - As.shape[1]), dtype=np.int32)
+        return np.concatenate([As, padding], axis=1)
+
     def make_dbs(self, difficulty=float('inf')):
+        facts, fast_dbs = self.make_dbs_batch(1, difficulty)
+        return facts[0], fast_dbs[0]
+
+    def make_dbs_batch(self, nbatch, difficulty=float('inf')):
         num_used_vars = min(8 + difficulty, self.size)
-        used_indices = np.random.choice(len(self.vertices), num_used_vars, replace=False)
+        #sorted, so that the compact rows are in the same order as the vertices
+        used_indices = np.sort(random_subsets(nbatch, len(self.vertices), num_used_vars), axis=-1)
         used_vars = self.vertices[used_indices]
         num_edges = 2 * num_used_vars
-        neighbors = defaultdict(list)
-        edges = used_vars[np.random.choice(num_used_vars, (num_edges, 2))]
-        edge_indices = self.indices(edges)
-        facts = np.concatenate([edges[:,0], edges[:,1]], axis=-1)
-        distances = np.ones((self.size + 1, self.size + 1), dtype=np.int32) * 2 * self.size
-        #the 0, 0 entry is a placeholder, so that indexing with idk doesn't cause trouble
-        distances[edge_indices[:,0], edge_indices[:,1]] = 1
-        for k in range(1, self.size + 1):
-            np.minimum(distances, distances[:,k, np.newaxis] + distances[np.newaxis, k,:],
-                       out=distances)
-        fast_db = {"vertices":np.array(used_vars), "distances":distances}
-        return facts, fast_db
+        batch_indices = np.arange(nbatch)[:, np.newaxis]
+        #rows of the compact distance matrices; row 0 stands for idk and unused
+        #vertices, which have no edges
+        edge_rows = 1 + np.random.choice(num_used_vars, (nbatch, num_edges, 2))
+        edges = used_vars[batch_indices[:, :, np.newaxis], edge_rows - 1]
+        facts = np.concatenate([edges[:,:,0], edges[:,:,1]], axis=-1)
+        distances = shortest_paths(edge_rows, num_used_vars, 2 * self.size)
+        #index[b, i] is the row of the vertex with index i (see indices)
+        index = np.zeros((nbatch, self.size + 1), dtype=np.int32)
+        index[batch_indices, 1 + used_indices] = np.arange(1, num_used_vars + 1)
+        unindex = np.concatenate([idk * np.ones((nbatch, 1, self.length), dtype=used_vars.dtype),
+                                  used_vars], axis=1)
+        fast_dbs = [{"vertices":u[1:], "unindex":u, "index":i, "distances":d}
+                    for u, i, d in zip(unindex, index, distances)]
+        return facts, fast_dbs
 
     def compute_distances(self, distances):
         return distances
 
-    def classify_question(self, Q, fast_db):
-        q, a, b = self.split_question(Q)
-        t = self.repr_symbol(q)
-        if q in self.simple_question_tokens and q != self.edge_query_symbol:
-            return t
-        a = self.indices(a)
-        b = self.indices(b)
+    #distances are bucketed by magnitude; invalid questions are "?"
+    distance_buckets = ["0", "1", "2", "3-4", "5-8", "9-16", "long", "inf"]
+    question_classes = (["?", "N", "edge", "no-edge"] +
+                        ["D" + d for d in distance_buckets] +
+                        ["S" + d for d in distance_buckets])
+
+    def classify_questions(self, Qs, fast_db):
+        qs, a, b = self.split_questions(Qs)
+        a = fast_db["index"][self.indices(a)]
+        b = fast_db["index"][self.indices(b)]
         d = fast_db["distances"][a, b]
-        if q == self.edge_query_symbol:
-            if d == 1:
-                return "edge"
-            else:
-                return "no-edge"
-        if d > self.size:
-            d = "inf"
-        elif d <= 2:
-            d = str(d)
-        elif d <= 4:
-            d = "3-4"
-        elif d <= 8:
-            d = "5-8"
-        elif d <= 16:
-            d = "9-16"
-        else:
-            d = "long"
-        return "{}{}".format(t, d)
+        buckets = np.where(d > self.size, 7, np.digitize(d, [1, 2, 3, 5, 9, 17]))
+        classes = np.zeros(len(Qs), dtype=np.int32)
+        classes[qs == self.neighbor_query_symbol] = 1
+        is_edge = qs == self.edge_query_symbol
+        classes[is_edge] = np.where(d[is_edge] == 1, 2, 3)
+        for i, q in enumerate([self.distance_query_symbol, self.step_query_symbol]):
+            is_q = qs == q
+            classes[is_q] = 4 + i * len(self.distance_buckets) + buckets[is_q]
+        return classes
 
     def make_qs(self, nqs, fast_db):
         indices = [np.random.randint(len(fast_db["vertices"]), size=(nqs,), dtype=np.int32)
@@ -213,7 +342,15 @@ class GraphTask(Task):
         vertices = [fast_db["vertices"][index] for index in indices]
         Qs = np.random.choice([self.step_query_symbol, self.distance_query_symbol], (nqs, 1))
         return np.concatenate([Qs] + vertices, axis=-1).astype(np.int32)
-        
+
+    def make_qs_batch(self, nqs, fast_dbs):
+        used_vars = np.stack([fast_db["vertices"] for fast_db in fast_dbs])
+        nbatch, num_used_vars = used_vars.shape[:2]
+        batch_indices = np.arange(nbatch)[:, np.newaxis]
+        vertices = [used_vars[batch_indices, np.random.randint(num_used_vars, size=(nbatch, nqs))]
+                    for _ in range(2)]
+        Qs = np.random.choice([self.step_query_symbol, self.distance_query_symbol], (nbatch, nqs, 1))
+        return np.concatenate([Qs] + vertices, axis=-1).astype(np.int32)
 
     def indices(self, vs):
         return np.where(self.are_chars(vs),
@@ -239,13 +376,13 @@ class GraphTask(Task):
             edges = (distances[xs] == 1).astype(np.float32)
             edges[:,0] += 0.1
             noise = 0.01 * np.random.random(edges.shape)
-            return self.unindices(np.argmax(noise + edges, axis=1))
+            return fast_db["unindex"][np.argmax(noise + edges, axis=1)]
         def answer_step_queries(xs, ys):
             is_neighbor = distances[xs, :] <= 1
             is_closer = distances[:, ys].transpose() < np.expand_dims(distances[xs, ys], 1)
             is_closer[np.arange(len(ys)),ys] = 1
             result_indices = np.argmax(np.logical_and(is_neighbor, is_closer), axis=-1)
-            result = self.unindices(result_indices)
+            result = fast_db["unindex"][result_indices]
             return np.where(np.expand_dims(distances[xs, ys], -1) <= self.max_d + 1,
                             result, self.inf)
         def answer_distance_queries(xs, ys):
@@ -254,8 +391,8 @@ class GraphTask(Task):
 
         qs, xs, ys = self.split_questions(Qs)
         distances = fast_db["distances"]
-        xs = self.indices(xs)
-        ys = self.indices(ys)
+        xs = fast_db["index"][self.indices(xs)]
+        ys = fast_db["index"][self.indices(ys)]
         As = np.zeros((Qs.shape[0], self.answer_length), dtype=np.int32)
         b = (qs == self.edge_query_symbol)
         As[b] = answer_edge_queries(xs[b], ys[b])
@@ -1,9 +1,8 @@
-import random
 from collections import defaultdict
 
 import numpy as np
 
-from amplification.tasks.core import idk, uniform, Task, sequences
+from amplification.tasks.core import idk, uniform, Task, sequences, random_subsets
 
 class IterTask(Task):
     interaction_length = 3
@@ -48,50 +47,53 @@ class IterTask(Task):
         self.fact_length = 2 * length
         # Eg. 2 → ab (length 2)
         self.answer_length = length
+        # Questions are classified by the magnitude of the power. Eg. 2/0010
+        # → class 2, 5/0101 → 3, 15/1111 → 4
+        self.question_classes = [str(n) for n in range(log_iters + 1)]
 
     def make_dbs(self, difficulty=float('inf')):
+        facts, fast_dbs = self.make_dbs_batch(1, difficulty)
+        return facts[0], fast_dbs[0]
+
+    def make_dbs_batch(self, nbatch, difficulty=float('inf')):
         # Optionally limit the number of symbols in the permutation.
         size = min(difficulty+8, self.size)
-        used_vars = random.sample(self.vars, size)
+        # used_vars[b] is a random sample of size symbols for environment b.
+        used_vars = np.array(self.vars)[random_subsets(nbatch, self.size, size)]
 
-        # Permutation mapping symbol index to symbol index.
+        # Permutations mapping symbol index to symbol index.
         # 'raw' indicates something returning symbol indices.
-        vals_raw = np.random.permutation(size)
-        # Permutation mapping symbol index to symbol.
-        vals = np.array(used_vars)[vals_raw]
-
-        # 'squares' might better be called 'power_of_2_th_permutations'.
-        # No it might not. Permuting permuted values is a squared permutation.
-        # Which is clever, but is it necessary? The largest case is batch size *
-        # 64 permutations of 64 values. In a compact representation
-        # that's a lookup table of batch_size * 4096 bytes. Not mutch.
-        # Maybe because the lookup is going to be sparse, it takes more time to
-        # precompute all of them than to compute just a few on the fly.
-        # squares_raw[k][i] is the 2**k-th permutation of the i-th symbol.
-        square_raw = vals_raw
-        squares_raw = [square_raw]
-        # Would be better to set up the arrays first and then work with indices
-        # instead of appending.
-        for i in range(self.log_iters):
-            square_raw = square_raw[square_raw]
-            squares_raw.append(square_raw)
-        # Same here.
-        # squares[k][x] = σᵏ⁺¹(x)
-        squares = [{val: used_vars[squares_raw[i][index]] for index, val in enumerate(used_vars)}
-                   for i in range(self.log_iters)]
-        fast_db = {
-            # Permutation mapping symbol to symbol.
-            "vals": {v: val for v, val in zip(used_vars, vals)},
-            "vars":  used_vars,
-            "squares_raw": squares_raw,
-            "squares": squares
-        }
-        # Permutation mapping symbol to symbol in array form.
-        facts = np.concatenate([np.array(used_vars), vals], axis=1)
-        return facts, fast_db
+        vals_raw = random_subsets(nbatch, size, size)
+        # Permutations mapping symbol index to symbol.
+        vals = np.take_along_axis(used_vars, vals_raw[:, :, np.newaxis], axis=1)
+
+        # squares_raw[b, k, i] is the 2**k-th permutation of the i-th symbol in
+        # environment b. Permuting a permutation with itself squares it.
+        squares_raw = np.zeros((nbatch, self.log_iters + 1, size), dtype=np.int32)
+        squares_raw[:, 0] = vals_raw
+        for k in range(self.log_iters):
+            squares_raw[:, k+1] = np.take_along_axis(squares_raw[:, k], squares_raw[:, k], axis=1)
+
+        # index[b, c] is the row of the symbol with code c (see symbol_codes)
+        # in used_vars[b] and squares_raw[b], or -1 if the symbol is unused.
+        index = -np.ones((nbatch, self.size), dtype=np.int32)
+        np.put_along_axis(index, self.symbol_codes(used_vars),
+                          np.arange(size, dtype=np.int32)[np.newaxis], axis=1)
+
+        fast_dbs = [{"vars": v, "squares_raw": s, "index": i}
+                    for v, s, i in zip(used_vars.astype(np.int32), squares_raw, index)]
+        # Permutations mapping symbol to symbol in array form.
+        facts = np.concatenate([used_vars, vals], axis=2)
+        return facts, fast_dbs
+
+    # Maps symbols to integers in [0, size). Symbols made of something other
+    # than chars get an arbitrary code, so check are_chars first.
+    def symbol_codes(self, x):
+        char_powers = self.nchars ** np.arange(self.length - 1, -1, -1)
+        return np.sum((x - self.min_char) * char_powers, axis=-1)
 
     def are_chars(self, x):
-        return np.logical_and(np.all(x >= self.min_char), np.all(x <= self.max_char))
+        return np.logical_and(np.all(x >= self.min_char, axis=-1), np.all(x <= self.max_char, axis=-1))
 
     def recursive_answer(self, Q):
         """
@@ -142,9 +144,50 @@ class IterTask(Task):
                 return
         yield self.pad(x), None
 
+    def recursive_step(self, state, subAs):
+        """Vectorized recursive_answer. See core.recursive_run_steps."""
+        if subAs is None:
+            Qs = state["Qs"]
+            x = Qs[:, :self.length]
+            n = Qs[:, self.length:]
+            valid = self.are_chars(x) & np.all((n == self.zero) | (n == self.one), axis=-1)
+            shifted = self.zero * np.ones_like(n)
+            shifted[:, 1:] = n[:, :-1]
+            parity = self.zero * np.ones_like(n)
+            parity[:, -1] = self.one
+            state = {
+                "x": x,
+                "shifted": shifted,
+                "parity": parity,
+                "nqueries": np.where(n[:, -1] == self.one, 3, 2),
+                "k": np.zeros(len(Qs), dtype=np.int32),
+                "done": ~valid,
+                "As": idk * np.ones((len(Qs), self.answer_length), dtype=np.int32),
+            }
+            # No base case: in recursive_answer, n is a tuple, so the check
+            # for n < 2 never succeeds and those questions get decomposed too.
+            subQs = np.concatenate([x, shifted], axis=1)
+            return state, subQs, state["done"], state["As"]
+
+        state = dict(state)
+        active = ~state["done"]
+        done = np.copy(state["done"])
+        As = np.copy(state["As"])
+        failed = active & ~self.are_chars(subAs)
+        done |= failed
+        succeeded = active & ~failed
+        x = np.where(succeeded[:, np.newaxis], subAs, state["x"])
+        k = state["k"] + succeeded
+        finished = succeeded & (k == state["nqueries"])
+        As[finished] = x[finished]
+        done |= finished
+        state.update(x=x, k=k, done=done, As=As)
+        m = np.where((k >= 2)[:, np.newaxis], state["parity"], state["shifted"])
+        return state, np.concatenate([x, m], axis=1), done, As
+
     def make_q(self, fast_db):
         # Could be made the last line before then return.
-        x = random.choice(fast_db["vars"])
+        x = fast_db["vars"][np.random.randint(len(fast_db["vars"]))]
 
         # Might be better to work with actual binary numbers and only convert to
         # the target format in the end.
@@ -157,43 +200,68 @@ class IterTask(Task):
         n[leading_bit+1:] = np.random.choice([self.zero, self.one], remainder)
         return np.concatenate([x, n])
 
-    def answer(self, Q, fast_db):
-        Q = tuple(Q)
-        x = Q[:self.length]
-        n = Q[self.length:]
-        if x in fast_db["vals"]:
-            # Compute the n-th permutation in log(n, 2) time by using the
-            # precomputed power-of-2-th permutations.
-            for i in range(self.log_iters):
-                if n[i] == self.one:
-                    x = fast_db["squares"][self.log_iters - i - 1][x]
-                elif n[i] == self.zero:
-                    x = x
-                else:
-                    return self.pad(idk)
-            return self.pad(x)
-        else:
-            return self.pad(idk)
+    def make_qs_batch(self, nqs, fast_dbs):
+        nbatch = len(fast_dbs)
+        used_vars = np.array([fast_db["vars"] for fast_db in fast_dbs])
+        x = used_vars[np.arange(nbatch)[:, np.newaxis],
+                      np.random.randint(used_vars.shape[1], size=(nbatch, nqs))]
+        # Same distribution as make_q: zeros before a random leading 1, random
+        # bits after it.
+        leading_bit = np.random.randint(0, self.log_iters-1, size=(nbatch, nqs, 1))
+        positions = np.arange(self.log_iters)
+        random_bits = np.random.choice([self.zero, self.one], (nbatch, nqs, self.log_iters))
+        n = np.where(positions < leading_bit, self.zero,
+                     np.where(positions == leading_bit, self.one, random_bits))
+        return np.concatenate([x, n], axis=2)
+
+    def answers(self, Qs, fast_db):
+        xs = Qs[:, :self.length]
+        ns = Qs[:, self.length:]
+        is_char = self.are_chars(xs)
+        rows = fast_db["index"][np.where(is_char, self.symbol_codes(xs), 0)]
+        valid = is_char & (rows >= 0) & np.all((ns == self.zero) | (ns == self.one), axis=-1)
+        rows = np.where(valid, rows, 0)
+        # Compute the n-th permutation in log(n, 2) steps by using the
+        # precomputed power-of-2-th permutations, for all questions at once.
+        squares_raw = fast_db["squares_raw"]
+        for i in range(self.log_iters):
+            rows = np.where(ns[:, i] == self.one,
+                            squares_raw[self.log_iters - i - 1][rows], rows)
+        return np.where(valid[:, np.newaxis], fast_db["vars"][rows], idk).astype(np.int32)
 
     # Note: It might be possible to make this generic.
     def inject_errors(self, As: np.ndarray, fast_db, probability):
         error_spots = np.random.choice([True, False],
                                        p=[probability, 1 - probability],
                                        size=As.shape[0])
-        errors = random.choices(fast_db["vars"] + [self.pad(idk)], k=As.shape[0])
+        candidates = np.concatenate([fast_db["vars"], [self.pad(idk)]]).astype(As.dtype)
+        errors = candidates[np.random.randint(len(candidates), size=As.shape[0])]
         np.copyto(As, errors, where=error_spots[:, np.newaxis])
 
     def all_questions(self, fast_db):
         for x in fast_db["vars"]:
             for n in sequences([self.zero, self.one], self.log_iters):
-                yield np.asarray([x] + n)
+                yield np.concatenate([x, n])
 
     def are_simple(self, Q):
         return np.all(Q[:,self.length:-1] == self.zero, axis=-1)
 
-    def classify_question(self, Q, fast_db):
-        n = Q[self.length:]
-        if np.all(n == self.zero):
-            return 0
-        leading_bit = np.argmax(n)
-        return self.log_iters - leading_bit
+    # See core.simple_answer_table.
+    def simple_token_mask(self):
+        mask = np.ones((self.question_length, self.nvocab), dtype=np.bool_)
+        mask[self.length:-1] = False
+        mask[self.length:-1, self.zero] = True
+        return mask
+
+    def simple_key_ranges(self):
+        lo = [self.min_char] * self.length + [self.zero] * self.log_iters
+        hi = [self.max_char] * self.length + [self.zero] * (self.log_iters - 1) + [self.one]
+        return lo, hi
+
+    def simple_default_answer(self):
+        return self.pad(idk)
+
+    def classify_questions(self, Qs, fast_db):
+        ns = Qs[:, self.length:]
+        leading_bits = np.argmax(ns, axis=-1)
+        return np.where(np.all(ns == self.zero, axis=-1), 0, self.log_iters - leading_bits)
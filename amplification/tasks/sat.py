@@ -11,30 +11,30 @@ Answer:
 Number of satisfying assignments of facts+assignment?
 """
 
-import random
 from collections import defaultdict
 
 import numpy as np
 
-from amplification.tasks.core import idk, uniform, Task, sequences, test_task, recursive_run
+from amplification.tasks.core import idk, uniform, Task, sequences, test_task, recursive_run, random_subsets, random_wildcards, wildcard_sum_step
 
 
-def matches(patterns, xs):
-    # assert len(patterns.shape) == 2
-    # assert len(xs.shape) == 2
-    if len(xs.shape) < 2:
-        return np.zeros((patterns.shape[0], 1))
-    try:
-        return np.all(
-            (patterns[:, np.newaxis, :] == SatTask.wild) |
-            (patterns[:, np.newaxis, :] == xs[np.newaxis, :, :]),
-            axis=2)
-    except IndexError:
-        print(patterns)
-        print(xs)
-        print(patterns.shape, xs.shape)
-        import pdb
-        pdb.set_trace()
+#assignments are sets of bits, packed along the last axis into 64 bit words
+def pack(bits):
+    packed = np.packbits(bits, axis=-1, bitorder="little")
+    padding = [(0, 0)] * (packed.ndim - 1) + [(0, -packed.shape[-1] % 8)]
+    return np.ascontiguousarray(np.pad(packed, padding)).view(np.uint64)
+
+
+def unpack(words, n):
+    return np.unpackbits(words.view(np.uint8), axis=-1, count=n, bitorder="little").astype(np.bool_)
+
+
+byte_counts = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1).sum(axis=1)
+
+
+#number of bits set in each set of bits
+def popcount(words):
+    return np.sum(byte_counts[np.ascontiguousarray(words).view(np.uint8)], axis=-1)
 
 
 def alternating_sequences(alphabet1, alphabet2, length):
@@ -86,49 +86,59 @@ class SatTask(Task):
         self.differences = self.allocate(2 * self.max_d + 1)
         self.zero = self.differences[self.max_d]
 
-        self.all_clauses = [
-            np.array(x) for x in alternating_sequences(
-                self.variable_names, self.variable_values, length)
-        ]
+        self.all_clauses = np.array(alternating_sequences(
+            self.variable_names, self.variable_values, length))
         # Number of variables per clause
         self.length = length
         self.question_length = nvars
         self.fact_length = length * 2
 
-    def satisfying_assignments(self, clauses, assignment=None):
-        if assignment is None:
-            assignment = []
-        if len(assignment) == self.nvars:
-            for c in clauses:
-                satisfied = False
-                for i in range(len(c) // 2):
-                    var = c[2 * i] - self.variable_names[0]
-                    value = c[2 * i + 1]
-                    if assignment[var] == value:
-                        satisfied = True
-                        break
-                if not satisfied:
-                    return []
-            return [assignment]
-        assignments = []
-        for value in range(self.nvalues):
-            assignments.extend(
-                self.satisfying_assignments(
-                    clauses, assignment + [value + self.variable_values[0]]))
-        return assignments
+        # Every assignment, first variable slowest
+        self.all_assignments = self.variable_values[
+            np.indices((nvalues, ) * nvars).reshape(nvars, -1).T]
+        # pattern_bits[var, code] is the set of assignments that match a
+        # question with the token coded as code at var: one code per value,
+        # then one for the wildcard and one for tokens that match nothing
+        values = self.all_assignments.T[:, np.newaxis, :] == self.variable_values[:, np.newaxis]
+        self.pattern_bits = pack(np.concatenate([
+            values,
+            np.ones((nvars, 1, len(self.all_assignments)), dtype=np.bool_),
+            np.zeros((nvars, 1, len(self.all_assignments)), dtype=np.bool_)], axis=1))
+        self.all_bits = self.pattern_bits[0, nvalues]
+        self.pattern_codes = np.full(self.nvocab, nvalues + 1)
+        self.pattern_codes[self.variable_values] = np.arange(nvalues)
+        self.pattern_codes[self.wild] = nvalues
+        # Questions are classified by their number of wildcards
+        self.question_classes = ["sat{}".format(n) for n in range(nvars + 1)]
+
+    # The set of assignments that satisfy all of the clauses along the
+    # second to last axis
+    def satisfying_bits(self, clauses):
+        variables = clauses[..., ::2] - self.variable_names[0]
+        values = self.pattern_codes[clauses[..., 1::2]]
+        clause_bits = np.bitwise_or.reduce(self.pattern_bits[variables, values], axis=-2)
+        return self.all_bits & np.bitwise_and.reduce(clause_bits, axis=-2)
+
+    def satisfying_assignments(self, clauses):
+        return self.all_assignments[unpack(self.satisfying_bits(clauses),
+                                           len(self.all_assignments))]
 
     def make_dbs(self, difficulty=float('inf')):
+        facts, fast_dbs = self.make_dbs_batch(1, difficulty)
+        return facts[0], fast_dbs[0]
+
+    def make_dbs_batch(self, nbatch, difficulty=float('inf')):
         num_clauses = min(self.size, difficulty + self.min_clauses)
-        strings = np.stack(random.sample(self.all_clauses, num_clauses))
-        assignments = np.array(self.satisfying_assignments(strings))
-        fast_db = {"strings": strings, "assignments": assignments}
-        facts = np.concatenate(strings[:, np.newaxis])
-        return facts, fast_db
+        strings = self.all_clauses[random_subsets(nbatch, len(self.all_clauses), num_clauses)]
+        satisfying = self.satisfying_bits(strings)
+        fast_dbs = [{"strings": s, "satisfying": b} for s, b in zip(strings, satisfying)]
+        return strings, fast_dbs
 
     def answers(self, Qs, fast_db):
-        all_assignments = matches(Qs, fast_db["assignments"])
-        raw_As = np.sum(all_assignments, axis=1)
-        As = self.encode_n(raw_As)
+        # The assignments that each question matches
+        patterns = self.pattern_bits[np.arange(self.nvars), self.pattern_codes[Qs]]
+        matching = np.bitwise_and.reduce(patterns, axis=-2) & fast_db["satisfying"]
+        As = self.encode_n(popcount(matching))
         return As[:, np.newaxis]
 
     def make_q(self, fast_db):
@@ -140,12 +150,30 @@ class SatTask(Task):
         Q[indices] = self.wild
         return Q
 
+    def make_qs_batch(self, nqs, fast_dbs):
+        return random_wildcards(self.variable_values,
+                                (len(fast_dbs), nqs, self.question_length), self.wild)
+
     def encode_n(self, x):
         return self.zero + np.maximum(-self.max_d, np.minimum(self.max_d, x))
 
     def are_simple(self, Qs):
         return np.all(Qs != self.wild, axis=-1)
 
+    # See core.simple_answer_table.
+    def simple_token_mask(self):
+        mask = np.ones((self.question_length, self.nvocab), dtype=np.bool_)
+        mask[:, self.wild] = False
+        return mask
+
+    def simple_key_ranges(self):
+        return ([self.variable_values[0]] * self.question_length,
+                [self.variable_values[-1]] * self.question_length)
+
+    def simple_default_answer(self):
+        # Tokens outside the alphabet don't match anything.
+        return self.pad(self.encode_n(0))
+
     def recursive_answer(self, Q):
         Q = np.asarray(Q)
         if not np.all(np.isin(Q, self.variable_values_plus)):
@@ -167,15 +195,18 @@ class SatTask(Task):
         result = self.encode_n(result)
         yield self.pad(result), None
 
+    def recursive_step(self, state, subAs):
+        return wildcard_sum_step(self, state, subAs, self.variable_values, self.variable_values_plus)
+
     def all_questions(self, fast_db):
         yield from sequences(self.variable_values_plus, self.nvars)
 
-    def classify_question(self, Q, fast_db):
-        n = len([x for x in Q if x == self.wild])
-        return "sat{}".format(n)
+    def classify_questions(self, Qs, fast_db):
+        return np.sum(Qs == self.wild, axis=-1)
 
 
 if __name__ == "__main__":
+    import time
     task = SatTask()
     instances=1000
     nqs=50
@@ -184,11 +215,13 @@ if __name__ == "__main__":
     difficulty_counts = [1] + ([1/(max_difficulty - min_difficulty)] * (max_difficulty - min_difficulty - 1)) + [1]
     difficulty_sum = sum(difficulty_counts)
     difficulty_counts = [int(d * instances / difficulty_sum) for d in difficulty_counts]
+    t0 = time.time()
     for i, n in enumerate(difficulty_counts):
         difficulty = i + min_difficulty
         facts, fast_dbs, Qs, ground_truth = task.get_batch(n, nqs=nqs, difficulty=difficulty)
         print(ground_truth.shape)
         print(i, task.repr_answer(ground_truth[0]))
+    print("{:.1E}s per environment".format((time.time() - t0) / sum(difficulty_counts)))
     exit(0)
 
 
@@ -1,9 +1,8 @@
-import random
 from collections import defaultdict
 
 import numpy as np
 
-from amplification.tasks.core import idk, uniform, Task, sequences
+from amplification.tasks.core import idk, uniform, Task, sequences, random_subsets, random_wildcards, wildcard_sum_step
 
 def matches(patterns, xs):
     return np.all((patterns[:,np.newaxis,:] == SumTask.wild) |
@@ -37,22 +36,63 @@ class SumTask(Task):
         else:
             self.differences = self.allocate(self.modulus)
             self.zero = self.differences[0]
-        self.all_strings = [np.array(x) for x in sequences(self.alphabet, length)]
+        self.nchars = nchars
         self.length = length
         self.question_length = length
         self.fact_length = length + 1
+        # Patterns are numbers in base nchars + 1, most significant position
+        # first, with a digit per character and nchars for the wildcard.
+        # Tokens outside alphabet_plus get the digit nchars + 1.
+        self.pattern_codes = np.full(self.nvocab, nchars + 1)
+        self.pattern_codes[self.alphabet] = np.arange(nchars)
+        self.pattern_codes[self.wild] = nchars
+        self.pattern_strides = (nchars + 1) ** np.arange(length)[::-1]
+        self.string_strides = nchars ** np.arange(length)[::-1]
+        # Questions are classified by their number of wildcards
+        self.question_classes = ["wilds{}".format(n) for n in range(length + 1)]
 
     def make_dbs(self, difficulty=float('inf')):
+        facts, fast_dbs = self.make_dbs_batch(1, difficulty)
+        return facts[0], fast_dbs[0]
+
+    def make_dbs_batch(self, nbatch, difficulty=float('inf')):
         used_strings = min(self.size, difficulty+8)
-        strings = np.stack(random.sample(self.all_strings, used_strings))
-        values = np.random.choice([-1, 1], used_strings)
-        fast_db = {"strings": strings, "values": values}
-        facts = np.concatenate([strings, self.encode_n(values[:,np.newaxis])], axis=1)
-        return facts, fast_db
+        indices = random_subsets(nbatch, self.nchars ** self.length, used_strings)
+        digits = indices[:, :, np.newaxis] // self.string_strides % self.nchars
+        strings = self.alphabet[digits]
+        values = np.random.choice([-1, 1], (nbatch, used_strings))
+        # A table of every pattern has (nchars + 1)**length entries, and takes
+        # as long to fill as enumerating the used_strings * 2**length patterns
+        # that match some string. Past that size, match strings at answer time.
+        if (self.nchars + 1) ** self.length <= used_strings * 2 ** self.length:
+            patterns = np.dot(self.pattern_codes[strings], self.pattern_strides)
+            fast_dbs = [{"strings": s, "values": v, "sums": t}
+                        for s, v, t in zip(strings, values, self.dense_sums(patterns, values))]
+        else:
+            fast_dbs = [{"strings": s, "values": v} for s, v in zip(strings, values)]
+        facts = np.concatenate([strings, self.encode_n(values[:,:,np.newaxis])], axis=2)
+        return facts, fast_dbs
+
+    # sums[b, pattern] is the sum of the values of the strings that match
+    # the pattern. One position at a time, the entries with a wildcard
+    # there become the sums of the entries with each character there.
+    def dense_sums(self, patterns, values):
+        sums = np.zeros((len(patterns), (self.nchars + 1) ** self.length), dtype=np.int32)
+        sums[np.arange(len(patterns))[:, np.newaxis], patterns] = values
+        for stride in self.pattern_strides:
+            position = np.reshape(sums, (-1, self.nchars + 1, stride))
+            for c in range(self.nchars):
+                position[:, self.nchars] += position[:, c]
+        return sums
 
     def answers(self, Qs, fast_db):
-        all_matches = matches(Qs, fast_db["strings"])
-        raw_As = np.dot(all_matches, fast_db["values"])
+        if "sums" in fast_db:
+            digits = self.pattern_codes[Qs]
+            patterns = np.dot(np.minimum(digits, self.nchars), self.pattern_strides)
+            raw_As = np.where(np.all(digits <= self.nchars, axis=-1),
+                              fast_db["sums"][patterns], 0)
+        else:
+            raw_As = np.dot(matches(Qs, fast_db["strings"]), fast_db["values"])
         As = self.encode_n(raw_As)
         return As[:, np.newaxis]
 
@@ -63,6 +103,9 @@ class SumTask(Task):
         Q[indices] = self.wild
         return Q
 
+    def make_qs_batch(self, nqs, fast_dbs):
+        return random_wildcards(self.alphabet, (len(fast_dbs), nqs, self.length), self.wild)
+
     def encode_n(self, x):
         if self.modulus is None:
             return self.zero + np.maximum(-self.max_d, np.minimum(self.max_d, x))
@@ -72,6 +115,20 @@ class SumTask(Task):
     def are_simple(self, Qs):
         return np.all(Qs != self.wild, axis=-1)
 
+    # See core.simple_answer_table.
+    def simple_token_mask(self):
+        mask = np.ones((self.question_length, self.nvocab), dtype=np.bool_)
+        mask[:, self.wild] = False
+        return mask
+
+    def simple_key_ranges(self):
+        return ([self.alphabet[0]] * self.question_length,
+                [self.alphabet[-1]] * self.question_length)
+
+    def simple_default_answer(self):
+        # Tokens outside the alphabet don't match anything.
+        return self.pad(self.encode_n(0))
+
     def recursive_answer(self, Q):
         Q = np.asarray(Q)
         if not np.all(np.isin(Q, self.alphabet_plus)):
@@ -93,9 +150,11 @@ class SumTask(Task):
         result = self.encode_n(result)
         yield self.pad(result), None
 
+    def recursive_step(self, state, subAs):
+        return wildcard_sum_step(self, state, subAs, self.alphabet, self.alphabet_plus)
+
     def all_questions(self, fast_db):
         yield from sequences(self.alphabet_plus, self.length)
 
-    def classify_question(self, Q, fast_db):
-        n = len([x for x in Q if x == self.wild])
-        return "wilds{}".format(n)
+    def classify_questions(self, Qs, fast_db):
+        return np.sum(Qs == self.wild, axis=-1)
@@ -7,7 +7,7 @@ import re
 import os
 
 import tensorflow as tf
-from tensorflow.python.ops import array_ops, tensor_array_ops, control_flow_ops
+from tensorflow.python.ops import array_ops, tensor_array_ops, control_flow_ops, data_flow_ops
 import numpy as np
 import scipy
 from decorator import decorator
@@ -196,6 +196,7 @@ def to_tags(tags):
             result[tag] = True
     return result
 
+#variables are float32 even when a model computes in less, see Model.compute_dtype
 def get_variable(name, value):
     def dtype(x):
         if isinstance(x, tf.Tensor):
@@ -312,7 +313,13 @@ concat = register(tf.concat)
 softmax = register(tf.nn.softmax)
 softplus = register(tf.nn.softplus)
 
+#float16 and bfloat16 -> float32, for normalizing and for the 1e9 masks
+#which float16 can't hold
+def widen(x):
+    return tf.cast(x, tf.float32) if x.dtype in (tf.float16, tf.bfloat16) else x
+
 def log_partition(x, keep_dims=False, axis=-1):
+    x = widen(x)
     m = tf.reduce_max(x, axis=axis, keep_dims=True)
     log_sum_exp = tf.log(tf.reduce_sum(tf.exp(x-m), axis=axis, keep_dims=True))
     result = log_sum_exp + m
@@ -327,8 +334,8 @@ def normalize_logits(logits):
 # w : ... x components
 # logits: ... x components x elements
 def mix_logits(w, logits):
-    log_ps = normalize_logits(logits)
-    expanded_w = tf.expand_dims(w, -1)
+    log_ps = normalize_logits(widen(logits))
+    expanded_w = tf.expand_dims(widen(w), -1)
     return log_partition(expanded_w + log_ps, axis=-2) - log_partition(expanded_w, axis=-2)
 
 def softsum(x, y):
@@ -339,6 +346,7 @@ def softsum(x, y):
 # x: ... x elements
 # y: ... x elements
 def soft_combine(x, y, s):
+    x, y, s = widen(x), widen(y), widen(s)
     w = tf.stack([s, tf.zeros_like(s)], axis=-1)
     logits = tf.stack([x, y], axis=-2)
     return mix_logits(w, logits)
@@ -378,7 +386,8 @@ def fully_connected(x, outshape, l2loss=0.0, context=None, init_relative_reg=Tru
     init = weight_factor * normal_init(inshape + outshape) if not context.frozen else None
     W = context.variable("W", init, tags=['trainable'])
     b = context.variable("b", np.zeros(outshape), tags=['trainable', 'bias'])
-    xW = scale / weight_factor * tensordot(x, W, in_axes)
+    #computes in the dtype of x
+    xW = scale / weight_factor * tensordot(x, tf.cast(W, x.dtype), in_axes)
     random_W = weight_factor * tf.random_normal(inshape + outshape)
     context.set("drift", lambda eps : W.assign_add(eps * (random_W - W)), tags=["drift", "nosave"])
     if l2loss > 0 and not context.frozen:
@@ -386,7 +395,7 @@ def fully_connected(x, outshape, l2loss=0.0, context=None, init_relative_reg=Tru
         weights_to_penalize = (W-init_W) if init_relative_reg else W
         context.set("l2_penalty", l2loss * tf.reduce_mean(weights_to_penalize**2), tags=['regularizer', 'nosave'])
     assert xW.shape.dims is not None
-    return xW+b
+    return xW+tf.cast(b, x.dtype)
 
 def ortho_init(shape, insize=None, outsize=None, get_scale=False):
     if insize is None:
@@ -587,7 +596,7 @@ except ImportError: #fall back to a slow layer norm
 def trainable_layer_norm(x, size, axis=1, context=None):
     gain = context.variable("gain", np.ones((size,), dtype=np.float32), tags=["trainable"])
     bias = context.variable("bias", np.zeros((size,), dtype=np.float32), tags=["trainable"])
-    return layer_norm(x, gain, bias, axis=axis, relu=False)
+    return tf.cast(layer_norm(widen(x), gain, bias, axis=axis, relu=False), x.dtype)
 
 def sample_logits(logits, axis=1):
     noise = tf.random_uniform(tf.shape(logits))
@@ -603,7 +612,8 @@ def mask_past(w, mask_offset=0):
 #(last dim of v are logits if logits=True)
 @register
 def attention(q, k, v, mask=False, mask_offset=0, logits=False):
-    w = tf.matmul(q, k, transpose_b=True)
+    #the products are in the dtype of q, the weights in float32
+    w = widen(tf.matmul(q, k, transpose_b=True))
     nh = tf.cast(q.get_shape()[-1], tf.float32)
     w = w / tf.sqrt(nh)
     if mask: w = mask_past(w, mask_offset)
@@ -614,7 +624,7 @@ def attention(q, k, v, mask=False, mask_offset=0, logits=False):
         return mix_logits(w, tf.expand_dims(v, axis=-3)) 
     else:
         w = tf.nn.softmax(w)
-        return tf.matmul(w, v)
+        return tf.matmul(tf.cast(w, v.dtype), v)
 
 #in: batch x cells x size
 #out: batch x heads x cells x size
@@ -633,9 +643,79 @@ def merge_heads(split_x, size, context=None, scale_weights=True):
             scale_weights=scale_weights)
     return x
 
+class AttentionCache(object):
+    """
+    The keys and values an attention layer has seen, for decoding a few cells
+    at a time without recomputing the ones before
+
+    keys and values: max cells x batch x ... x size, preallocated, with the
+    cells first so that writing them touches only the new ones
+    position: how many cells are filled
+    write stores the keys and values of the next cells, and returns those of
+    all of the filled cells, as batch x ... x cells x size
+    """
+    def __init__(self, keys, values, position):
+        self.keys = keys
+        self.values = values
+        self.position = position
+
+    #the shapes are batch x ... x max cells x size
+    @classmethod
+    def empty(cls, keys_shape, values_shape, values_dtype=tf.float32, keys_dtype=tf.float32):
+        keys = tf.zeros(cells_first(keys_shape), dtype=keys_dtype)
+        values = tf.zeros(cells_first(values_shape), dtype=values_dtype)
+        keys.set_shape(cells_first([None] + list(keys_shape[1:])))
+        values.set_shape(cells_first([None] + list(values_shape[1:])))
+        return cls(keys, values, tf.constant(0))
+
+    def tensors(self):
+        return [self.keys, self.values, self.position]
+
+    def write(self, keys, values):
+        n = tf.shape(keys)[-2]
+        self.keys = write_cells(self.keys, keys, self.position)
+        self.values = write_cells(self.values, values, self.position)
+        self.position = self.position + n
+        return (cells_last(self.keys[:self.position]),
+                cells_last(self.values[:self.position]))
+
+#a shape of ... x cells x size, as cells x ... x size
+def cells_first(shape):
+    shape = list(shape)
+    return [shape[-2]] + shape[:-2] + [shape[-1]]
+
+#in: cells x ... x size
+#out: ... x cells x size
+def cells_last(x):
+    rank = len(x.shape)
+    return tf.transpose(x, list(range(1, rank - 1)) + [0, rank - 1])
+
+#cells (max cells x ... x size) with the cells from position on replaced by x
+#(... x new cells x size), updating only those
+def write_cells(cells, x, position):
+    rank = len(x.shape)
+    x = tf.transpose(x, [rank - 2] + list(range(rank - 2)) + [rank - 1])
+    indices = tf.expand_dims(tf.range(position, position + tf.shape(x)[0]), 1)
+    result = tf.tensor_scatter_nd_update(cells, indices, x)
+    result.set_shape(cells.shape)
+    return result
+
+#keeps tensors in the session between runs, under key (an int64 scalar)
+#returns the op that stores them, the tensors read back under key, and the op
+#that removes them; everything stored must be removed
+def session_store(key, tensors):
+    store = data_flow_ops.MapStagingArea([x.dtype for x in tensors], ordered=False)
+    put = store.put(key, tensors, indices=list(range(len(tensors))))
+    stored = store.peek(key)
+    for x, y in zip(stored, tensors):
+        x.set_shape(y.shape)
+    _, removed = store.get(key)
+    return put, stored, tf.group(*removed)
+
+#with an AttentionCache, k and v are only the new cells, which get added to the cache
 @register
 @contextual
-def multi_attention(q, k, v, nheads, context=None, attention_args=None,
+def multi_attention(q, k, v, nheads, context=None, attention_args=None, cache=None,
         **kwargs):
     if attention_args is None:
         attention_args = {}
@@ -646,6 +726,8 @@ def multi_attention(q, k, v, nheads, context=None, attention_args=None,
     split_q = split_heads(q, nheads, head_size, context=context["Q"], **kwargs)
     split_k = split_heads(k, nheads, head_size, context=context["K"], **kwargs)
     split_v = split_heads(v, nheads, head_size, context=context["V"], **kwargs)
+    if cache is not None:
+        split_k, split_v = cache.write(split_k, split_v)
     split_result = attention(split_q, split_k, split_v, **attention_args)
     return merge_heads(split_result, size, context=context["result"], **kwargs)
 
@@ -720,11 +802,12 @@ def dropout(x, p_drop=0.5, do_dropout=True, shared_axes=()):
     #replace shared_axes with 1
     #so we broadcast in that dimension, sharing dropout mask
     mask_shape = masked_shape(x, shared_axes, as_tensor=True)
-    mask = tf.floor(tf.random_uniform(mask_shape) + p)
+    #the mask is scaled in float32: there is no bfloat16 division on the CPU
+    mask = tf.cast(tf.floor(tf.random_uniform(mask_shape) + p) / p, x.dtype)
     if isinstance(do_dropout, bool):
-        return mask*x/p if do_dropout else x
+        return mask*x if do_dropout else x
     else:
-        return tf.cond(do_dropout, lambda : mask*x / p, lambda : x)
+        return tf.cond(do_dropout, lambda : mask*x, lambda : x)
 
 @register
 def cnn_dropout(*args, **kwargs):
@@ -742,6 +825,9 @@ def add_gaussian_noise(x, std, add_noise=tf.constant(True)):
 def batch_norm(x, training=True, scale=False, horizon=300, variance_epsilon=0.001, axes=(0,), context=None):
     if type(training) is bool:
         training = tf.constant(training)
+    #the statistics are float32, like the running ones
+    dtype = x.dtype
+    x = widen(x)
     stat_dims = masked_shape(x, axes, as_tensor=False)
     m, v = tf.nn.moments(x, axes=axes, keep_dims=True)
     running_m = context.variable("running_m", np.zeros(stat_dims), tags=["stats"])
@@ -759,7 +845,7 @@ def batch_norm(x, training=True, scale=False, horizon=300, variance_epsilon=0.00
             return normalize(x, m, v)
     def test_val():
         return normalize(x, running_m, running_v)
-    return tf.cond(training, training_val, test_val)
+    return tf.cast(tf.cond(training, training_val, test_val), dtype)
 
 @register
 @contextual
@@ -787,7 +873,10 @@ def drift_ops(context, epsilon):
 @contextual
 def minimize(loss, variables, optimizer_factory=tf.train.AdamOptimizer, context=None,
          clip_grads=None, filter=None, optimizer_args=None, print_everything=False,
-         **kwargs):
+         loss_scale=None, **kwargs):
+    """loss_scale multiplies the loss before differentiating and divides the
+    gradients after, so that the gradients of layers that compute in float16
+    don't underflow; see Model.loss_scale"""
     if optimizer_args is None:
         optimizer_args = {}
 
@@ -797,7 +886,11 @@ def minimize(loss, variables, optimizer_factory=tf.train.AdamOptimizer, context=
     with store_variables_in(context):
         if not context.frozen:
             context["optimizer"] = optimizer_factory(**optimizer_args)
-        grads = tf.gradients(loss, var_list)
+        if loss_scale is None:
+            grads = tf.gradients(loss, var_list)
+        else:
+            grads = [unscale_gradient(g, loss_scale)
+                     for g in tf.gradients(loss * loss_scale, var_list)]
         if clip_grads is not None:
             grads, grad_norm = tf.clip_by_global_norm(grads, clip_grads)
         grads = list(zip(grads, var_list))
@@ -815,6 +908,13 @@ def minimize(loss, variables, optimizer_factory=tf.train.AdamOptimizer, context=
         else:
             return context["optimizer"].apply_gradients(grads, **kwargs)
 
+def unscale_gradient(g, loss_scale):
+    if g is None:
+        return None
+    if isinstance(g, tf.IndexedSlices):
+        return tf.IndexedSlices(g.values / loss_scale, g.indices, g.dense_shape)
+    return g / loss_scale
+
 def moving_averages(variables, horizon, store_averages_in):
     """computes moving averages
 
@@ -842,6 +942,22 @@ class Model(object):
         self.initial_values = initial_values
         self.initialized = False
 
+    # The dtype the layers compute in. The variables, and so their moving
+    # averages, stay float32: fully_connected casts them, and normalizing and
+    # logits are float32, see widen.
+    compute_dtype = tf.float32
+
+    def set_compute_dtype(self, dtype):
+        self.compute_dtype = tf.as_dtype(dtype)
+
+    def compute(self, x):
+        """x in compute_dtype, to go into the layers"""
+        return tf.cast(x, self.compute_dtype)
+
+    def loss_scale(self):
+        """for minimize: float16 gradients underflow unless the loss is scaled"""
+        return 2.0 ** 10 if self.compute_dtype == tf.float16 else None
+
     def set_params(self, **kwargs):
         raise NotImplementedError()
 
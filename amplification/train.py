@@ -1,21 +1,33 @@
+import os
 import time
 import threading
 from typing import Sequence
 import sys
 import itertools
+import contextlib
 from collections import defaultdict
 
 import tensorflow as tf
 import numpy as np
 
 import amplification.models as models
+import amplification.tf_utils as tf_utils
+from amplification.models.core import lookup_simple_answers
 from amplification.tasks.core import idk, print_interaction, recursive_run, Task
+from amplification.tasks.core import has_simple_answer_table, simple_answer_table, simple_key_encoding
+from amplification.tasks.core import smallest_dtype
 from amplification.buffer import Buffer
+from amplification.environments import EnvironmentPool
 from amplification.logger import Logger
+from amplification.profiler import Profiler
+from amplification.validation import make_validation_set
+from amplification.workers import GenerationPool
 
 from tensorflow.contrib.memory_stats.python.ops.memory_stats_ops import BytesInUse, MaxBytesInUse, BytesLimit
 
 print_lock = threading.Lock()
+# Where the threads of train spend their time. See make_log.
+profiler = Profiler()
 
 # Credits: https://stackoverflow.com/a/48304328/5091738
 def recursive_map(f, o):
@@ -58,26 +70,67 @@ class Averager():
         self.sum = defaultdict(lambda:0)
         self.locks = defaultdict(threading.Lock)
 
+# Keys of what answer_server keeps in the session.
+facts_keys = itertools.count()
+
+@contextlib.contextmanager
+def answer_server(run, facts, fast_dbs):
+    # Keeps facts, the teacher's encoding of them and what the simple answerer
+    # needs of fast_dbs in the session, for the runs within. They feed the key
+    # this yields as facts_key, and only their questions.
+    facts_key = next(facts_keys)
+    run(["answer_server/store"], facts=facts, fast_dbs=fast_dbs, facts_key=facts_key)
+    try:
+        yield facts_key
+    finally:
+        run(["answer_server/remove"], facts_key=facts_key)
+
 def get_interactions(run, task, facts, fast_dbs, Qs,
-        use_real_answers=False, use_real_questions=True):
+        use_real_answers=False, use_real_questions=True, teacher_As=False,
+        stats_averager=None):
+    # With teacher_As, also returns the teacher's answers to Qs. Either way the
+    # teacher runs over facts at most once. With a stats_averager, logs the
+    # seconds per round of answers.
 
     if not use_real_questions:
         assert not use_real_answers
         # Pass questions to Amplify^H'(X). "targets" are the answers to Qs
         # according to H' after interacting with X.
-        # Does this also run the whole interaction between H' and X? Yes, I
-        # think so, based on asker.py. But as an unrolled loop.
-        return  run(["targets", "subQs", "subAs"], facts=facts, Qs=Qs, fast_dbs=fast_dbs)
+        # Does this also run the whole interaction between H' and X? Yes:
+        # asker.sample runs it in a tf.while_loop in the graph.
+        fetches = ["targets", "subQs", "subAs"]
+        if teacher_As:
+            fetches.append("answerer/teacher/As")
+        return run(fetches, facts=facts, Qs=Qs, fast_dbs=fast_dbs, is_training=False)
 
     if use_real_answers:
         answerer = lambda Qss: np.array([task.answers(Qs, fast_db)
                                          for Qs, fast_db in zip(Qss, fast_dbs)])
-    else:
-        answerer = lambda Qss: run(['teacher_or_simple'],
-                                   facts=facts, Qs=Qss, fast_dbs=fast_dbs,
-                                   is_training=False)[0]
-
-    return recursive_run(task, Qs, answerer)
+        with profiler.section("recursive_run"):
+            interactions = recursive_run(task, Qs, answerer)
+        if teacher_As:
+            interactions += tuple(run(["answerer/teacher/As"], facts=facts, Qs=Qs,
+                                      is_training=False))
+        return interactions
+
+    # Every round asks about the same facts, so they stay in the session.
+    rounds = []
+    with answer_server(run, facts, fast_dbs) as facts_key:
+        def answerer(Qss):
+            t0 = time.time()
+            with profiler.section("answer_round"):
+                As, = run(['cached/teacher_or_simple'], Qs=Qss, facts_key=facts_key,
+                          is_training=False)
+            rounds.append(time.time() - t0)
+            return As
+        with profiler.section("recursive_run"):
+            interactions = recursive_run(task, Qs, answerer)
+        if teacher_As:
+            interactions += tuple(run(["cached/teacher_As"], Qs=Qs, facts_key=facts_key,
+                                      is_training=False))
+    if stats_averager is not None and rounds:
+        stats_averager.add("latency/answer_round", np.mean(rounds))
+    return interactions
 
 def print_batch(task, Qs, subQs, subAs, As, facts, fast_dbs, **other_As):
     with print_lock:
@@ -93,29 +146,45 @@ def print_batch(task, Qs, subQs, subAs, As, facts, fast_dbs, **other_As):
                 print("{}: {}".format(k, task.repr_answer(v[0,i])))
 
 def log_accuracy(task, Qs, ground_truth, fast_dbs, stats_averager, stepper, **As_by_name):
-    classification = np.asarray([[task.classify_question(Q, fast_db) for Q in Q_list]
-                                 for fast_db, Q_list in zip(fast_dbs, Qs)])
-    total = np.size(classification)
+    # This gives the accuracy on the various classes. In the case of
+    # permutation powering, the classes are the magnitudes of the
+    # powers. Eg. 2/0010 → class 2, 5/0101 → 3, 15/1111 → 4
+    classes = task.question_classes
+    classification = np.concatenate([task.classify_questions(Q_list, fast_db)
+                                     for fast_db, Q_list in zip(fast_dbs, Qs)])
+    counts = np.bincount(classification, minlength=len(classes))
+    seen = np.flatnonzero(counts)
+    total = len(classification)
+    lines = []
+    for name, As in As_by_name.items():
+        accuracies = np.all(As == ground_truth, axis=-1).reshape(-1)
+        correct_counts = np.bincount(classification, weights=accuracies, minlength=len(classes))
+        correct = np.sum(correct_counts)
+        stats = {"accuracy/{}".format(name): correct/total}
+        stats.update({"accuracy_on/{}/{}".format(classes[c], name): correct_counts[c]/counts[c]
+                      for c in seen})
+        stats_averager.add_all(stats)
+        lines.append((name, correct, [(classes[c], correct_counts[c], counts[c]) for c in seen]))
+    def repr_accuracy(k, N): return "{}% ({}/{})".format(int(100*k/N), int(k), int(N))
     with print_lock:
         print()
         for s in ["answerer_gen", "answerer_train"]:
             print(s, stepper[s])
-        for name, As in As_by_name.items():
-            accuracies = np.all(As == ground_truth, axis=-1)
-            correct = np.sum(accuracies)
-            classes = set(np.reshape(classification, [-1]))
-            counts = {c: np.sum(classification == c) for c in classes}
-            correct_counts = {c: np.sum((classification == c) * accuracies) for c in classes}
-            def repr_accuracy(k, N): return "{}% ({}/{})".format(int(100*k/N), int(k), int(N))
+        for name, correct, by_class in lines:
             print()
             print("{} accuracy: {}".format(name, repr_accuracy(correct, total)))
-            stats_averager.add("accuracy/{}".format(name), correct/total)
-            # This gives the accuracy on the various classes. In the case of
-            # permutation powering, the classes are the magnitudes of the
-            # powers. Eg. 2/0010 → class 2, 5/0101 → 3, 15/1111 → 4
-            for c in sorted(counts.keys()):
-                print("  {}: {}".format(c, repr_accuracy(correct_counts[c], counts[c])))
-                stats_averager.add("accuracy_on/{}/{}".format(c, name), correct_counts[c]/counts[c])
+            for c, k, N in by_class:
+                print("  {}: {}".format(c, repr_accuracy(k, N)))
+
+# What the simple_answerer of the models computes: which of Qs (batch x
+# questions x question length) are simple, and their answers.
+def answer_if_simple(task, fast_dbs, Qs):
+    As = np.zeros(Qs.shape[:-1] + (task.answer_length,), np.int32)
+    are_simple = np.zeros(Qs.shape[:-1], np.bool_)
+    for i, fast_db in enumerate(fast_dbs):
+        are_simple[i] = task.are_simple(Qs[i])
+        As[i, are_simple[i]] = task.answers(Qs[i, are_simple[i]], fast_db)
+    return are_simple, As
 
 def inject_errors(task: Task, As_batches: Sequence, fast_dbs, probability: float):
     if probability == 0.0:
@@ -128,18 +197,24 @@ def generate_answerer_data(run, task, get_batch, answerer_buffer, stats_averager
     averager = Averager()
     while True:
         # Sample questions.
-        facts, fast_dbs, Qs, ground_truth = get_batch()
+        if use_real_answers and hasattr(get_batch, "interactions"):
+            # A GenerationPool has already run the interactions.
+            with profiler.section("generation"):
+                facts, fast_dbs, Qs, ground_truth, (As, subQs, subAs) = get_batch.interactions()
+            teacher_As, = run(["answerer/teacher/As"], facts=facts, Qs=Qs, is_training=False)
+        else:
+            with profiler.section("generation"):
+                facts, fast_dbs, Qs, ground_truth = get_batch()
+            # What are As and teacher_As?
+            # ``As`` depends on the use_real_* parameters. But in the setting of
+            # CSASupAmp it's the answers Amplify^H'(X) gives.
+            # teacher_As must be the answers directly from X.
+            As, subQs, subAs, teacher_As = get_interactions(run, task, facts, fast_dbs, Qs,
+                    use_real_answers=use_real_answers,
+                    use_real_questions=use_real_questions,
+                    teacher_As=True, stats_averager=stats_averager)
         nqs = Qs.shape[1]
-        # What are As and teacher_As?
-        # ``As`` depends on the use_real_* parameters. But in the setting of
-        # CSASupAmp it's the answers Amplify^H'(X) gives.
-        As, subQs, subAs = get_interactions(run, task, facts, fast_dbs, Qs,
-                use_real_answers=use_real_answers,
-                use_real_questions=use_real_questions)
         inject_errors(task, As, fast_dbs, error_probability)
-        # This must be the answers directly from X.
-        teacher_As, = run(["answerer/teacher/As"],
-                                     facts=facts, Qs=Qs, is_training=False)
         # Calculates how close X is to Amplify^H'(X)?
         # The fraction of batches where there are some actual answers (not all
         # idk) and all of X's answers equal those of Amplify^H'(X).
@@ -152,7 +227,8 @@ def generate_answerer_data(run, task, get_batch, answerer_buffer, stats_averager
         print_batch(task, Qs, subQs, subAs, As, facts, fast_dbs,
                     teacher=teacher_As, truth=ground_truth)
         batch = {"facts":facts, "Qs":Qs, "targets":As, "truth":ground_truth}
-        answerer_buffer.extend(batch, extendible={x:[1] for x in answerer_buffer.keys()})
+        with profiler.section("buffer"):
+            answerer_buffer.extend(batch, extendible={x:[1] for x in answerer_buffer.keys()})
         averager.add("quality", teacher_quality, 100)
         stats_averager.add("quality/teacher", teacher_quality)
         if averager.get("quality") > 0.85 and averager.n["quality"] > 50:
@@ -160,47 +236,88 @@ def generate_answerer_data(run, task, get_batch, answerer_buffer, stats_averager
             averager.reset()
         stepper["answerer_gen"] += 1
 
-def make_validation_buffer(task, instances=1000, nqs=50, min_difficulty=0, max_difficulty=56):
-    difficulty_counts = [1] + ([1/(max_difficulty - min_difficulty)] * (max_difficulty - min_difficulty - 1)) + [1]
-    difficulty_sum = sum(difficulty_counts)
-    difficulty_counts = [int(d * instances / difficulty_sum) for d in difficulty_counts]
+def make_validation_buffer(task, instances=1000, nqs=50, min_difficulty=0, max_difficulty=56,
+        **kwargs):
+    # kwargs go to make_validation_set: the seed, nworkers and the cache.
+    with profiler.section("generation"):
+        batches = make_validation_set(task, instances=instances, nqs=nqs,
+                                      min_difficulty=min_difficulty,
+                                      max_difficulty=max_difficulty, **kwargs)
     result = Buffer(instances,
         {"facts": [0, task.fact_length],
          "Qs": [0, task.question_length],
          "truth": [0, task.answer_length]},
+        dtype=task.token_dtype,
     )
-    for i, n in enumerate(difficulty_counts):
-        difficulty = i + min_difficulty
-        facts, fast_dbs, Qs, ground_truth = task.get_batch(n, nqs=nqs, difficulty=difficulty)
-        batch = {"facts":facts, "Qs":Qs, "truth":ground_truth}
-        result.extend(batch, extendible={x:[1] for x in result.keys()})
+    for batch in batches:
+        with profiler.section("buffer"):
+            result.extend(batch, extendible={x:[1] for x in result.keys()})
     return result
 
-def train_answerer(run, answerer_buffer, stats_averager, make_log, stepper, nbatch, task, warmup_time=0):
-    validation_buffer = make_validation_buffer(task)
+def prefetched_batches(buffer, nbatch, depth, produced, name):
+    """Batches of nbatch items that tf.data samples from buffer in the background.
+
+    Returns a dict of tensors, one per key of buffer plus "indexes". Within a
+    sess.run they all belong to the same batch. produced[name] counts the
+    batches sampled so far.
+    """
+    keys = buffer.keys()
+    def batches():
+        while True:
+            while not buffer.has(nbatch):
+                time.sleep(0.1)
+            batch, indexes = buffer.sample(nbatch, return_indexes=True)
+            produced[name] += 1
+            yield tuple(batch[k] for k in keys) + (indexes,)
+    dtype = tf.as_dtype(buffer.dtype)
+    dataset = tf.data.Dataset.from_generator(
+        batches,
+        output_types=(dtype,) * len(keys) + (tf.int64,),
+        output_shapes=tuple(tf.TensorShape([None] * (len(buffer.shapes[k]) + 1)) for k in keys)
+                      + (tf.TensorShape([None]),))
+    values = dataset.prefetch(depth).make_one_shot_iterator().get_next()
+    return dict(zip(keys + ["indexes"], values))
+
+def train_answerer(run, answerer_buffer, stats_averager, make_log, stepper, nbatch, task, warmup_time=0,
+        prefetch=False, validation_kwargs=None):
+    validation_buffer = make_validation_buffer(task, **(validation_kwargs or {}))
     while not answerer_buffer.has(10*nbatch):
-        time.sleep(0.1)
+        profiler.sleep(0.1)
+    # Reused across steps, so sampling doesn't allocate.
+    out = answerer_buffer.empty_batch(nbatch)
+    validation_out = validation_buffer.empty_batch(nbatch)
     while True:
-        batch = answerer_buffer.sample(nbatch)
-        if stepper["answerer_train"] < warmup_time:
-            loss, As = run(["answerer/student/loss",
-                            "answerer/student/As"],
-                            batch, is_training=True)
+        if prefetch:
+            # The train ops read their batch from the input pipeline. We only
+            # need to know its truth and where it came from.
+            batch = None
+            batch_fetches = {"truth": "input/answerer/truth",
+                             "indexes": "input/answerer/indexes"}
         else:
-            _, loss, As = run(
-                [
-                    "answerer/train", "answerer/student/loss",
-                    "answerer/student/As"
-                ],
-                batch,
-                is_training=True)
-
+            with profiler.section("buffer"):
+                batch, indexes = answerer_buffer.sample(nbatch, out=out, return_indexes=True)
+            batch_fetches = {}
+        fetches = ["answerer/student/loss", "answerer/student/losses", "answerer/student/predictions"]
+        if stepper["answerer_train"] >= warmup_time:
+            fetches.append("answerer/train")
+        (loss, losses, As, *_), fetched = run([fetches, batch_fetches], batch,
+                                              prefetched=prefetch, is_training=True)
+        if prefetch:
+            batch, indexes = fetched, fetched["indexes"]
+        if answerer_buffer.prioritized:
+            # An environment is as important as its questions are on average.
+            answerer_buffer.update_priorities(indexes, np.mean(losses, axis=-1))
+
+        # The predictions are given the targets before them, so this isn't
+        # comparable with accuracy/validation, nor with the accuracy/train of
+        # runs that sampled the answers freely.
         accuracy = get_accuracy(As, batch["truth"])
-        stats_averager.add("accuracy/train", accuracy)
+        stats_averager.add("accuracy/train_forced", accuracy)
         stats_averager.add("loss/answerer", loss)
         stepper["answerer_train"] += 1
         if stepper["answerer_train"] % 5 == 0:
-            batch = validation_buffer.sample(nbatch)
+            with profiler.section("buffer"):
+                batch = validation_buffer.sample(nbatch, out=validation_out)
             As, = run(["answerer/student/As"], batch, is_training=False)
             accuracy = get_accuracy(As, batch["truth"])
             stats_averager.add("accuracy/validation", accuracy)
@@ -208,7 +325,9 @@ def train_answerer(run, answerer_buffer, stats_averager, make_log, stepper, nbat
             # This prints four main accuracies. As I understand them:
             # /target is the accuracy of Amplify^H'(Xpa).
             # /teacher is the accuracy of Xpa on root questions/answers.
-            # /train is the training accuracy of X on root questions/answers.
+            # /train_forced is the training accuracy of X on root
+            # questions/answers, each answer word given the target words
+            # before it.
             # /validation is the validation accuracy of X on root questions/answers.
             # Xpa is derived from X by Polyak averaging (see CSASupAmp, p. 14),
             # which must be why /teacher lags behind /train.
@@ -233,12 +352,13 @@ def generate_asker_data(run, task, get_batch, asker_buffer, stats_averager, step
         nbatch = int(min(max_nbatch, needed_labels))
         needed_labels -= nbatch
         if nbatch == 0:
-            time.sleep(0.1)
+            profiler.sleep(0.1)
         else:
-            facts, fast_dbs, Qs, ground_truth = get_batch(nbatch)
+            with profiler.section("generation"):
+                facts, fast_dbs, Qs, ground_truth = get_batch(nbatch)
             As, subQs, subAs = get_interactions(run, task, facts, fast_dbs, Qs,
                     use_real_answers=use_real_answers,
-                    use_real_questions=True)
+                    use_real_questions=True, stats_averager=stats_averager)
             all_transcripts = []
             all_tokens = []
             for batchn in range(nbatch):
@@ -254,9 +374,10 @@ def generate_asker_data(run, task, get_batch, asker_buffer, stats_averager, step
             # transcripts ends up being the ws argument to asker.build
             # (AttentionSequenceModel.build) via the placeholders dictionary in
             # ``train``.
-            batch = {"transcripts":np.array(all_transcripts),
-                     "token_types":np.array(all_tokens)}
-            asker_buffer.extend(batch)
+            batch = {"transcripts":np.array(all_transcripts, dtype=asker_buffer.dtype),
+                     "token_types":np.array(all_tokens, dtype=asker_buffer.dtype)}
+            with profiler.section("buffer"):
+                asker_buffer.extend(batch)
 
             metric2fetch = {"loss/asker/validation": "asker/loss"}
             # See the comment on similar code in train_asker.
@@ -274,12 +395,13 @@ def generate_asker_data(run, task, get_batch, asker_buffer, stats_averager, step
 
             stepper["asker_gen"] += nbatch
 
-def train_asker(run, asker_buffer, stats_averager, stepper, nbatch):
+def train_asker(run, asker_buffer, stats_averager, stepper, nbatch, prefetch=False):
     while not asker_buffer.has(5*nbatch):
-        time.sleep(1)
+        profiler.sleep(1)
+    out = asker_buffer.empty_batch(nbatch)
     while True:
         if stepper["asker_train"] > stepper["answerer_train"] + 10000:
-            time.sleep(0.1)
+            profiler.sleep(0.1)
         else:
             metric2fetch = {"loss/asker": "asker/loss"}
             # Unlike the other train_*/generate_* methods, this calculates the
@@ -291,9 +413,12 @@ def train_asker(run, asker_buffer, stats_averager, stepper, nbatch):
                                 "accuracy/asker/q/train": "asker/q_accuracy",
                                 "accuracy/asker/a/train": "asker/a_accuracy",}
             fetches = ["asker/train", metric2fetch]
-            batch = asker_buffer.sample(nbatch)
+            # With prefetching, the train op reads its batch from the input
+            # pipeline.
+            with profiler.section("buffer"):
+                batch = None if prefetch else asker_buffer.sample(nbatch, out=out)
 
-            _, metric2result = run(fetches, batch, is_training=True)
+            _, metric2result = run(fetches, batch, prefetched=prefetch, is_training=True)
             stats_averager.add_all(metric2result)
 
             stepper["asker_train"] += 1
@@ -303,35 +428,100 @@ def train(task, model, nbatch=50, num_steps=400000,
         stub=False, learn_human_model=True, supervised=False, curriculum=True,
         generation_frequency=10, log_frequency=10,
         buffer_size=10000, asker_data_limit=100000, loss_threshold=0.3,
-        warmup_time=0, error_probability=0.0):
+        warmup_time=0, error_probability=0.0, prioritized_replay=False,
+        asker_buffer_path=None, prefetch=0, trace=False, generation_workers=0,
+        environment_reuse=1, validation_cache=None):
     """
 
     ``stub`` == True means to pass a bunch of zeroes around and not actually do
     anything. See :py:func:`run` in particular.
+
+    ``asker_buffer_path`` is a directory to keep the asker's transcripts in,
+    instead of RAM. If it holds transcripts from an earlier run, they are
+    reused.
+
+    ``prefetch`` > 0 makes train_answerer and train_asker read their batches
+    from tf.data pipelines that keep that many batches sampled ahead, instead
+    of feeding them.
+
+    ``trace`` writes what the threads do to trace.json in ``path``, for
+    chrome://tracing. Either way, the fraction of time each thread spends on
+    what is logged as time/<thread>/<section>.
+
+    ``generation_workers`` > 0 generates the batches in that many worker
+    processes instead of the generating threads, along with the interactions
+    if ``supervised``. Only what needs the model stays in this process.
+
+    ``environment_reuse`` > 1 keeps the environments of each batch around and
+    asks new questions about each of them in about that many batches, see
+    EnvironmentPool. It is for tasks whose environments are slow to make.
+
+    ``validation_cache`` is a directory to keep the validation set in, so
+    that later runs on the same task load it instead of making it. It is made
+    from the same seed in every run, in ``generation_workers`` processes.
     """
     if supervised: learn_human_model = False
-    if not stub:
-        placeholders = {
-            "facts": tf.placeholder(tf.int32, [None, None, task.fact_length], name="facts"),
-            "Qs": tf.placeholder(tf.int32, [None, None, task.question_length], name="Qs"),
-            "targets": tf.placeholder(tf.int32, [None, None, task.answer_length],
-                                      name="targets"),
-            "transcripts": tf.placeholder(tf.int32, [None, None], name="transcripts"),
-            "token_types": tf.placeholder(tf.int32, [None, None], name="token_types"),
-            'is_training': tf.placeholder(tf.bool, [], name='is_training'),
-        }
+    # Tokens are fed and buffered in the smallest dtype that holds them.
+    token_dtype = task.token_dtype
+    transcript_dtype = smallest_dtype(max(task.nvocab, models.asker.TokenTypes.num))
     answerer_buffer = Buffer(buffer_size,
         {"facts": [0, task.fact_length],
          "Qs": [0, task.question_length],
          "targets": [0, task.answer_length],
          "truth": [0, task.answer_length]},
         validation_fraction=0.1,
+        prioritized=prioritized_replay,
+        dtype=token_dtype,
     )
     asker_buffer = Buffer(asker_data_limit,
         {"transcripts":[task.transcript_length],
          "token_types":[task.transcript_length]},
         validation_fraction=0.1,
+        dtype=transcript_dtype,
+        path=asker_buffer_path,
     )
+    if stub: prefetch = 0
+    # Batches sampled by the input pipelines, see make_log.
+    produced = defaultdict(int)
+    if not stub:
+        prefetched = {}
+        if prefetch:
+            prefetched["answerer"] = prefetched_batches(answerer_buffer, nbatch, prefetch,
+                                                        produced, "answerer")
+            prefetched["asker"] = prefetched_batches(asker_buffer, nbatch, prefetch,
+                                                     produced, "asker")
+        defaults = {**prefetched.get("answerer", {}), **prefetched.get("asker", {})}
+        def placeholder(dtype, shape, name):
+            if name in defaults:
+                # Reads the prefetched batch unless something is fed. So a run
+                # that forgets to feed facts, say, would quietly use up a
+                # training batch instead of failing; run refuses to do that
+                # unless it is told prefetched=True.
+                return tf.placeholder_with_default(defaults[name], shape, name=name)
+            return tf.placeholder(dtype, shape, name=name)
+        token_type = tf.as_dtype(token_dtype)
+        transcript_type = tf.as_dtype(transcript_dtype)
+        placeholders = {
+            "facts": placeholder(token_type, [None, None, task.fact_length], name="facts"),
+            "Qs": placeholder(token_type, [None, None, task.question_length], name="Qs"),
+            "targets": placeholder(token_type, [None, None, task.answer_length],
+                                   name="targets"),
+            "transcripts": placeholder(transcript_type, [None, None], name="transcripts"),
+            "token_types": placeholder(transcript_type, [None, None], name="token_types"),
+            'is_training': tf.placeholder(tf.bool, [], name='is_training'),
+            "facts_key": tf.placeholder(tf.int64, [], name="facts_key"),
+        }
+        if has_simple_answer_table(task):
+            placeholders["simple_answers"] = tf.placeholder(
+                token_type, [None, None, task.answer_length], name="simple_answers")
+        # The models compute with int32. This is the only place where tokens
+        # are widened.
+        inputs = {k: tf.cast(placeholders[k], tf.int32)
+                  for k in ["facts", "Qs", "targets", "transcripts", "token_types"]}
+        inputs["is_training"] = placeholders["is_training"]
+        inputs["facts_key"] = placeholders["facts_key"]
+        if has_simple_answer_table(task):
+            inputs["simple_answers"] = tf.cast(placeholders["simple_answers"], tf.int32)
     #keep track of how many times we've performed each kind of step
     stepper = {"answerer_train":0, "asker_train":0, "answerer_gen":0, "asker_gen":0}
 
@@ -342,24 +532,53 @@ def train(task, model, nbatch=50, num_steps=400000,
     fast_db_index = tf.placeholder(tf.int32, [], name="fast_db_index")
 
     def answer_if_simple_py(fast_db_index, Qs):
-        fast_dbs = fast_db_communicator[fast_db_index]
-        As = np.zeros(Qs.shape[:-1] + (task.answer_length,), np.int32)
-        are_simple = np.zeros(Qs.shape[:-1], np.bool)
-        for i, fast_db in enumerate(fast_dbs):
-            are_simple[i] = task.are_simple(Qs[i])
-            As[i, are_simple[i]] = task.answers(Qs[i, are_simple[i]], fast_db)
-        return are_simple, As
+        return answer_if_simple(task, fast_db_communicator[fast_db_index], Qs)
 
     def answer_if_simple_tf(Qs):
+        # Tasks that can export their simple answers as tables get them fed as
+        # a tensor and looked up in-graph. The others go through Python.
+        if has_simple_answer_table(task):
+            digits, strides, _ = simple_key_encoding(task)
+            return lookup_simple_answers(Qs, inputs["simple_answers"],
+                                         task.simple_token_mask(), digits, strides)
         return tf.py_func(answer_if_simple_py, [fast_db_index, Qs], (tf.bool, tf.int32))
 
+    # What answer_server keeps of fast_dbs under facts_key: the tables, or the
+    # fast_dbs themselves for answer_if_simple_stored_py.
+    stored_fast_dbs = {}
+
+    def store_fast_dbs_py(fast_db_index, facts_key):
+        stored_fast_dbs[facts_key] = fast_db_communicator[fast_db_index]
+        return facts_key
+
+    def remove_fast_dbs_py(facts_key):
+        del stored_fast_dbs[facts_key]
+        return facts_key
+
+    def answer_if_simple_stored_py(facts_key, Qs):
+        return answer_if_simple(task, stored_fast_dbs[facts_key], Qs)
+
+    def answer_if_simple_stored_tf(Qs):
+        # Like answer_if_simple_tf, about the fast_dbs stored under facts_key.
+        if has_simple_answer_table(task):
+            digits, strides, _ = simple_key_encoding(task)
+            # stored_tables is defined with the ops that store them, below.
+            return lookup_simple_answers(Qs, stored_tables,
+                                         task.simple_token_mask(), digits, strides)
+        return tf.py_func(answer_if_simple_stored_py, [inputs["facts_key"], Qs],
+                          (tf.bool, tf.int32))
+
     def make_feed(d):
         result = {}
         cleanup = lambda : None
         for k, v in d.items():
             if k in placeholders:
                 result[placeholders[k]] = v
-            if k == "fast_dbs":
+            if k == "fast_dbs" and has_simple_answer_table(task):
+                # Built once per batch by get_batch.
+                result[placeholders["simple_answers"]] = np.stack(
+                    [fast_db["simple_answers"] for fast_db in v])
+            elif k == "fast_dbs":
                 fast_db_communicator["next"] += 1
                 next_index = fast_db_communicator["next"]
                 result[fast_db_index] = next_index
@@ -367,7 +586,30 @@ def train(task, model, nbatch=50, num_steps=400000,
                 def cleanup(): del fast_db_communicator[next_index]
         return result, cleanup
 
-    def run(fetch_names, batch=None, **kwargs):
+    # Whether computing fetches with feed_dict pulls a batch from the input
+    # pipelines, by fetch names and fed placeholders.
+    reads_prefetched_cache = {}
+    def reads_prefetched(fetch_names, fetches, feed_dict):
+        key = (repr(fetch_names), frozenset(t.name for t in feed_dict))
+        if key not in reads_prefetched_cache:
+            pipeline_ops = {t.op for tensors in prefetched.values() for t in tensors.values()}
+            fed_ops = {t.op for t in feed_dict}
+            stack = [x.op if isinstance(x, tf.Tensor) else x
+                     for x in tf.contrib.framework.nest.flatten(fetches)]
+            seen = set()
+            result = False
+            while stack and not result:
+                op = stack.pop()
+                if op in seen or op in fed_ops:
+                    continue
+                seen.add(op)
+                result = op in pipeline_ops
+                stack.extend(t.op for t in op.inputs)
+                stack.extend(op.control_inputs)
+            reads_prefetched_cache[key] = result
+        return reads_prefetched_cache[key]
+
+    def run(fetch_names, batch=None, prefetched=False, **kwargs):
         if batch is None:
             batch = {}
 
@@ -377,9 +619,15 @@ def train(task, model, nbatch=50, num_steps=400000,
             # lexical variables that are defined after the closure.
             fetches = recursive_map(lambda fetch_name: multi_access(ops, fetch_name),
                                     fetch_names)
-            feed_dict, cleanup = make_feed(kwargs)
+            with profiler.section("feed"):
+                feed_dict, cleanup = make_feed(kwargs)
+            if prefetch and not prefetched and reads_prefetched(fetch_names, fetches, feed_dict):
+                cleanup()
+                raise ValueError("Running {} would consume a prefetched batch; feed its "
+                                 "inputs or pass prefetched=True".format(fetch_names))
             try:
-                return sess.run(fetches, feed_dict)
+                with profiler.section("sess_run"):
+                    return sess.run(fetches, feed_dict)
             finally:
                 cleanup()
         else:
@@ -392,6 +640,8 @@ def train(task, model, nbatch=50, num_steps=400000,
                 return np.zeros(batch["Qs"].shape[:2] +
                             (task.interaction_length, task.answer_length), dtype=np.int32)
             def loss(batch): return 0.17
+            def losses(batch):
+                return np.full(batch["Qs"].shape[:2], 0.17, dtype=np.float32)
             def accuracy(batch): return 0.85
             def train(batch): return None
 
@@ -400,10 +650,13 @@ def train(task, model, nbatch=50, num_steps=400000,
                 "subQs":subQs,
                 "subAs":subAs,
                 "teacher_or_simple": As,
+                "answer_server": {"store": train, "remove": train},
+                "cached": {"teacher_or_simple": As, "teacher_As": As},
                 "answerer":{
                     "train":train,
                     "teacher":{"As":As, "train":train, "loss":loss},
-                    "student":{"As":As, "train":train, "loss":loss}
+                    "student":{"As":As, "predictions":As, "train":train, "loss":loss,
+                               "losses":losses}
                 },
                 "asker":{"train":train, "loss":loss, "q_accuracy": accuracy,
                          "a_accuracy": accuracy}
@@ -417,30 +670,77 @@ def train(task, model, nbatch=50, num_steps=400000,
     # they're logged every tenth step.
     stats_averager = Averager()
 
+    environments = EnvironmentPool(task, reuse=environment_reuse)
     def get_batch(nbatch=nbatch):
-        return task.get_batch(nbatch, difficulty=get_batch.difficulty)
+        facts, fast_dbs, Qs, ground_truth = environments.get_batch(
+            nbatch, difficulty=get_batch.difficulty)
+        if has_simple_answer_table(task):
+            # Every run on this batch feeds the tables, so build them once
+            # per environment.
+            for fast_db in fast_dbs:
+                if "simple_answers" not in fast_db:
+                    fast_db["simple_answers"] = simple_answer_table(task, fast_db)
+        return facts, fast_dbs, Qs, ground_truth
     # Yes, you can set arbitrary attributes on a procedure. No, this is not a
     # good idea in most cases, I suspect.
     get_batch.difficulty = 0 if curriculum else float('inf')
+    if generation_workers > 0 and not stub:
+        # Called and given difficulties just like get_batch.
+        get_batch = GenerationPool(task, nbatch, generation_workers,
+                                   difficulty=get_batch.difficulty,
+                                   real_interactions=supervised,
+                                   simple_answer_tables=has_simple_answer_table(task),
+                                   environment_reuse=environment_reuse)
 
     start_time = time.time()
     logger = Logger(log_path=path, step_field="step/answerer_train")
+    if trace and path is not None:
+        profiler.trace_to(os.path.join(path, "trace.json"))
+    last_log = {"time": start_time, **stepper}
     def make_log():
         log = {}
-        log["time"] = time.time() - start_time
+        now = time.time()
+        log["time"] = now - start_time
         for k, v in stepper.items():
             log["step/{}".format(k)] = float(v)
+        for k in ["answerer_train", "asker_train"]:
+            log["steps_per_sec/{}".format(k)] = (stepper[k] - last_log[k]) / (now - last_log["time"])
+        last_log.update(stepper, time=now)
         if curriculum:
             log["difficulty"] = float(get_batch.difficulty)
         log.update(stats_averager.items())
         stats_averager.reset()
+        profiler.gauge("answerer_buffer", answerer_buffer.used / answerer_buffer.capacity)
+        profiler.gauge("asker_buffer", asker_buffer.used / asker_buffer.capacity)
+        if prefetch:
+            # Every training step takes one batch from its pipeline, so the
+            # pipeline holds what was sampled but not trained on yet.
+            for k in ["answerer", "asker"]:
+                ahead = produced[k] - stepper["{}_train".format(k)]
+                profiler.gauge("{}_prefetch".format(k), min(max(ahead, 0), prefetch) / prefetch)
+        log.update(profiler.items())
         with print_lock:
             logger.log(log)
 
     memory_usage = {}
     sess = None
     if not stub:
-        ops = model.build(**placeholders, simple_answerer=answer_if_simple_tf)
+        if has_simple_answer_table(task):
+            store_simple_answers, (stored_tables,), remove_simple_answers = \
+                tf_utils.session_store(inputs["facts_key"], [inputs["simple_answers"]])
+        else:
+            store_simple_answers = tf.py_func(
+                store_fast_dbs_py, [fast_db_index, inputs["facts_key"]], tf.int64)
+            remove_simple_answers = tf.py_func(
+                remove_fast_dbs_py, [inputs["facts_key"]], tf.int64)
+        ops = model.build(**{k: v for k, v in inputs.items() if k != "simple_answers"},
+                          simple_answerer=answer_if_simple_tf,
+                          stored_simple_answerer=answer_if_simple_stored_tf)
+        ops["input"] = prefetched
+        ops["answer_server"] = {
+            "store": tf.group(ops["teacher_state"]["store"], store_simple_answers),
+            "remove": tf.group(ops["teacher_state"]["remove"], remove_simple_answers),
+        }
         config = tf.ConfigProto()
         config.allow_soft_placement = True
         # Credits: https://software.intel.com/en-us/articles/maximize-tensorflow-performance-on-cpu-considerations-and-recommendations-for-inference
@@ -464,21 +764,31 @@ def train(task, model, nbatch=50, num_steps=400000,
         sess.graph.finalize()
 
 
+    asker_generation_kwargs = {}
+    if isinstance(get_batch, GenerationPool):
+        # The pool only cuts smaller batches from its own.
+        asker_generation_kwargs["max_nbatch"] = min(nbatch, 50)
+
     targets = [
         dict(target=train_answerer,
-             args=(run, answerer_buffer, stats_averager, make_log, stepper, nbatch, task, warmup_time)),
+             args=(run, answerer_buffer, stats_averager, make_log, stepper, nbatch, task, warmup_time),
+             kwargs=dict(prefetch=prefetch > 0,
+                         validation_kwargs=dict(nworkers=generation_workers,
+                                                cache=validation_cache))),
         dict(target=train_asker,
-             args=(run, asker_buffer, stats_averager, stepper, nbatch)),
+             args=(run, asker_buffer, stats_averager, stepper, nbatch),
+             kwargs=dict(prefetch=prefetch > 0)),
         dict(target=generate_answerer_data,
              args=(run, task, get_batch, answerer_buffer, stats_averager, stepper),
              kwargs=dict(use_real_questions=not learn_human_model,
                          use_real_answers=supervised,
                          error_probability=error_probability)),
         dict(target=generate_asker_data,
-             args=(run, task, get_batch, asker_buffer, stats_averager, stepper)),
+             args=(run, task, get_batch, asker_buffer, stats_averager, stepper),
+             kwargs=asker_generation_kwargs),
     ]
 
-    threads = [threading.Thread(**kwargs) for kwargs in targets]
+    threads = [threading.Thread(name=kwargs["target"].__name__, **kwargs) for kwargs in targets]
     for thread in threads:
         if not stub:
             thread.daemon = True
@@ -497,4 +807,6 @@ def train(task, model, nbatch=50, num_steps=400000,
                 with print_lock:
                     for name, op in memory_usage.items():
                         print(name, sess.run(op))
+            if isinstance(get_batch, GenerationPool):
+                get_batch.close()
             return
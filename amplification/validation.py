@@ -0,0 +1,86 @@
+"""The fixed set of environments and questions the answerer is validated on.
+
+It is made from a seed, so it is the same in every run, optionally in worker
+processes, and can be cached on disk. Like workers, this module mustn't
+import tensorflow.
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+
+import numpy as np
+
+KEYS = ["facts", "Qs", "truth"]
+
+
+#how many of the instances are at each difficulty, from min_difficulty up:
+#as many at each end as at all the difficulties in between
+def difficulty_counts(instances, min_difficulty, max_difficulty):
+    counts = [1] + ([1/(max_difficulty - min_difficulty)] * (max_difficulty - min_difficulty - 1)) + [1]
+    total = sum(counts)
+    return [int(d * instances / total) for d in counts]
+
+
+def task_key(task, **params):
+    """A file name for what is made from task with params.
+
+    Tasks don't keep their constructor parameters, so this uses the plain
+    attributes of the task, which include them.
+    """
+    attributes = {k: v for k, v in vars(task).items()
+                  if isinstance(v, (bool, int, float, str, type(None)))}
+    description = json.dumps([type(task).__name__, attributes, params], sort_keys=True)
+    return "{}-{}".format(type(task).__name__,
+                          hashlib.sha1(description.encode()).hexdigest()[:16])
+
+
+def make_batch(task, n, nqs, difficulty, seed):
+    np.random.seed([seed, difficulty])
+    random.seed("{} {}".format(seed, difficulty))
+    facts, fast_dbs, Qs, truth = task.get_batch(n, nqs=nqs, difficulty=difficulty)
+    return {"facts": facts, "Qs": Qs, "truth": truth}
+
+
+def make_validation_set(task, instances=1000, nqs=50, min_difficulty=0, max_difficulty=56,
+                        seed=0, nworkers=0, cache=None):
+    """The batches of the validation set, one per difficulty, as dicts of
+    facts, Qs and truth.
+
+    Each batch is made from seed and its difficulty alone, so the set doesn't
+    depend on nworkers. With nworkers > 0 they are made in that many worker
+    processes. If cache is a directory, the set is kept there in an .npz file
+    named by task_key, and later calls with the same task and parameters
+    load it from there.
+    """
+    counts = difficulty_counts(instances, min_difficulty, max_difficulty)
+    jobs = [(task, n, nqs, min_difficulty + i, seed) for i, n in enumerate(counts)]
+    if cache is not None:
+        path = os.path.join(cache, task_key(
+            task, instances=instances, nqs=nqs, min_difficulty=min_difficulty,
+            max_difficulty=max_difficulty, seed=seed) + ".npz")
+        if os.path.exists(path):
+            with np.load(path) as arrays:
+                return [{k: arrays["{}_{}".format(k, i)] for k in KEYS}
+                        for i in range(len(jobs))]
+    if nworkers > 0:
+        with multiprocessing.get_context("spawn").Pool(nworkers) as pool:
+            batches = pool.starmap(make_batch, jobs, chunksize=1)
+    else:
+        # Don't disturb the random numbers of the caller.
+        states = np.random.get_state(), random.getstate()
+        try:
+            batches = [make_batch(*job) for job in jobs]
+        finally:
+            np.random.set_state(states[0])
+            random.setstate(states[1])
+    if cache is not None:
+        os.makedirs(cache, exist_ok=True)
+        # Written aside and moved, so that a run never loads half a file.
+        partial = "{}.{}.partial".format(path, os.getpid())
+        with open(partial, "wb") as f:
+            np.savez(f, **{"{}_{}".format(k, i): batch[k]
+                           for i, batch in enumerate(batches) for k in KEYS})
+        os.replace(partial, path)
+    return batches
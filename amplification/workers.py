@@ -0,0 +1,165 @@
+"""Generation of batches in worker processes, out of reach of the GIL.
+
+This module mustn't import tensorflow: the workers are spawned, so they
+import it afresh.
+"""
+import multiprocessing
+import random
+import time
+import traceback
+
+import numpy as np
+
+from amplification.environments import EnvironmentPool
+from amplification.tasks.core import recursive_run, simple_answer_table
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Before Python 3.8 the arrays are pickled through the queue instead.
+    shared_memory = None
+
+
+def to_shared(arrays):
+    """Copy a dict of arrays into one new block of shared memory.
+
+    Returns what from_shared needs to get them back. The block belongs to
+    whoever calls from_shared. Without shared_memory, that is the arrays
+    themselves.
+    """
+    if shared_memory is None:
+        return None, arrays
+    size = max(1, sum(x.nbytes for x in arrays.values()))
+    block = shared_memory.SharedMemory(create=True, size=size)
+    layout = []
+    offset = 0
+    for k, x in arrays.items():
+        np.ndarray(x.shape, x.dtype, buffer=block.buf, offset=offset)[...] = x
+        layout.append((k, x.shape, x.dtype.str, offset))
+        offset += x.nbytes
+    block.close()
+    return block.name, layout
+
+
+def from_shared(shared):
+    name, layout = shared
+    if name is None:
+        return layout
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        return {k: np.ndarray(shape, dtype, buffer=block.buf, offset=offset).copy()
+                for k, shape, dtype, offset in layout}
+    finally:
+        block.close()
+        block.unlink()
+
+
+def generate(task, nbatch, difficulty, simple_answer_tables, environment_reuse, queue,
+             interactions_queue, seed):
+    np.random.seed(seed)
+    random.seed(seed)
+    environments = EnvironmentPool(task, reuse=environment_reuse)
+    try:
+        while True:
+            # Batches with interactions first, as long as they're wanted.
+            if interactions_queue is not None and not interactions_queue.full():
+                out = interactions_queue
+            elif not queue.full():
+                out = queue
+            else:
+                time.sleep(0.01)
+                continue
+            # The tasks expect an int, or inf for no curriculum.
+            d = difficulty.value
+            if d != float('inf'): d = int(d)
+            facts, fast_dbs, Qs, truth = environments.get_batch(nbatch, difficulty=d)
+            if simple_answer_tables:
+                for fast_db in fast_dbs:
+                    if "simple_answers" not in fast_db:
+                        fast_db["simple_answers"] = simple_answer_table(task, fast_db)
+            arrays = {"facts": facts, "Qs": Qs, "truth": truth}
+            if out is interactions_queue:
+                # The part of get_interactions that doesn't need the model.
+                answerer = lambda Qss: np.array([task.answers(Qs, fast_db)
+                                                 for Qs, fast_db in zip(Qss, fast_dbs)])
+                arrays["As"], arrays["subQs"], arrays["subAs"] = recursive_run(task, Qs, answerer)
+            out.put((to_shared(arrays), fast_dbs))
+    except Exception:
+        # Otherwise the trainer would wait for batches forever.
+        for out in [queue, interactions_queue]:
+            if out is not None:
+                out.put((None, traceback.format_exc()))
+        raise
+
+
+class GenerationPool():
+    """A stand-in for the get_batch of train, backed by worker processes.
+
+    nworkers processes generate batches of nbatch with task.get_batch at the
+    current difficulty and queue them up in shared memory. Like get_batch,
+    the pool is called with an optional batch size and has a difficulty that
+    can be changed; smaller batches are cut from full ones.
+
+    If real_interactions, the workers also make batches with the interactions
+    with the true answers, which interactions() returns. They are queued
+    apart from the others, so that calling the pool itself doesn't throw away
+    interactions. If simple_answer_tables, they put the simple_answer_table
+    of each environment in its fast_db as "simple_answers". Each worker reuses
+    its environments as an EnvironmentPool with environment_reuse.
+    """
+    def __init__(self, task, nbatch, nworkers, difficulty=0, real_interactions=False,
+                 simple_answer_tables=False, queue_size=None, environment_reuse=1):
+        context = multiprocessing.get_context("spawn")
+        self.nbatch = nbatch
+        self.real_interactions = real_interactions
+        self._difficulty = context.Value("d", difficulty, lock=False)
+        self.queue = context.Queue(maxsize=queue_size or 2 * nworkers)
+        self.interactions_queue = (context.Queue(maxsize=queue_size or 2 * nworkers)
+                                   if real_interactions else None)
+        self.workers = [
+            context.Process(target=generate,
+                            args=(task, nbatch, self._difficulty, simple_answer_tables,
+                                  environment_reuse, self.queue, self.interactions_queue,
+                                  np.random.randint(2**31)),
+                            daemon=True)
+            for _ in range(nworkers)]
+        for worker in self.workers:
+            worker.start()
+
+    @property
+    def difficulty(self):
+        return self._difficulty.value
+
+    @difficulty.setter
+    def difficulty(self, value):
+        self._difficulty.value = value
+
+    def _get(self, queue, nbatch):
+        shared, fast_dbs = queue.get()
+        if shared is None:
+            raise RuntimeError("A generation worker failed:\n" + fast_dbs)
+        arrays = from_shared(shared)
+        if nbatch is None: nbatch = self.nbatch
+        assert nbatch <= self.nbatch
+        return {k: x[:nbatch] for k, x in arrays.items()}, fast_dbs[:nbatch]
+
+    def __call__(self, nbatch=None):
+        arrays, fast_dbs = self._get(self.queue, nbatch)
+        return arrays["facts"], fast_dbs, arrays["Qs"], arrays["truth"]
+
+    def interactions(self, nbatch=None):
+        assert self.real_interactions
+        arrays, fast_dbs = self._get(self.interactions_queue, nbatch)
+        return (arrays["facts"], fast_dbs, arrays["Qs"], arrays["truth"],
+                (arrays["As"], arrays["subQs"], arrays["subAs"]))
+
+    def close(self):
+        for worker in self.workers:
+            worker.terminate()
+        for worker in self.workers:
+            worker.join()
+        for queue in [self.queue, self.interactions_queue]:
+            while queue is not None and not queue.empty():
+                shared, _ = queue.get()
+                if shared is not None:
+                    from_shared(shared)
@@ -367,6 +367,25 @@ iterate_fail_v1 = combos(
         repeat(3),
 )
 
+# Compare steps to reach a given accuracy with uniform and prioritized sampling
+# from the answerer buffer.
+iterate_prioritized_v1 = combos(
+        iterate_v1_proto,
+        options("train.prioritized_replay", [(False, "uniform"), (True, "prioritized")]),
+)
+
+# Compare steps/sec of the trainers when batches are fed and when they are
+# prefetched by tf.data. See steps_per_sec/* in the logs.
+iterate_prefetch = combos(
+        bind("task.name", "iterate"),
+        bind("task.nchars", 4),
+        bind("task.length", 1),
+        bind("task.log_iters", 3),
+        bind("train.num_steps", 1000),
+        bind("model.tiny", True),
+        options("train.prefetch", [(0, "feed"), (2, "prefetch")]),
+)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="run an experiment")
     parser.add_argument("-e", "--experiment")
@@ -0,0 +1,26 @@
+"""Tests for the benchmark suite"""
+
+import contextlib
+import io
+import json
+import unittest
+
+from amplification.benchmark import benchmark_buffer, benchmark_task, compare, key
+from amplification.tasks import GraphTask, SumTask
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_records(self):
+        results = benchmark_task(GraphTask(), "GraphTask()", difficulties=(0, float('inf')),
+                                 nbatch=2, nqs=3, repeats=1)
+        results += benchmark_buffer(SumTask(), nbatch=2, difficulties=(0,), repeats=1)
+        results = json.loads(json.dumps(results))
+        self.assertIn("recursive_run_steps", {r["benchmark"] for r in results})
+        self.assertEqual({r["difficulty"] for r in results}, {0, "inf"})
+        self.assertEqual(len({key(r) for r in results}), len(results))
+        for r in results:
+            self.assertGreater(r["value"], 0)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            compare(results, results)
+        self.assertEqual(len(output.getvalue().splitlines()), len(results))
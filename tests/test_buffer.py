@@ -0,0 +1,138 @@
+"""Tests for the replay buffer"""
+
+import os
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+
+from amplification.buffer import Buffer, SumTree
+
+
+def make_batch(nbatch, width, value):
+    # Every row of an item holds the same value, so we can tell torn items.
+    return {"xs": np.full((nbatch, width, 2), value, dtype=np.int32),
+            "ys": np.full((nbatch, 3), value, dtype=np.int32)}
+
+
+class TestBuffer(unittest.TestCase):
+    def test_grow_pads_with_zeros(self):
+        b = Buffer(10, {"xs": [0, 2], "ys": [3]})
+        b.extend(make_batch(4, 2, 1), extendible={"xs": [1]})
+        b.extend(make_batch(4, 5, 2), extendible={"xs": [1]})
+        batch = b.sample(8)
+        self.assertEqual(batch["xs"].shape, (8, 5, 2))
+        for xs, ys in zip(batch["xs"], batch["ys"]):
+            width = 2 if ys[0] == 1 else 5
+            np.testing.assert_array_equal(xs[:width], ys[0])
+            np.testing.assert_array_equal(xs[width:], 0)
+
+    def test_ring_overwrites_oldest(self):
+        b = Buffer(10, {"xs": [0, 2], "ys": [3]})
+        for value in range(1, 5):
+            b.extend(make_batch(4, 2, value), extendible={"xs": [1]})
+        self.assertTrue(b.has(10))
+        self.assertFalse(b.has(11))
+        values = np.concatenate([b.sample(10)["ys"][:, 0] for _ in range(20)])
+        self.assertEqual(set(values), {2, 3, 4})
+
+    def test_sample_into_out(self):
+        b = Buffer(10, {"xs": [0, 2], "ys": [3]})
+        b.extend(make_batch(4, 2, 1), extendible={"xs": [1]})
+        out = b.empty_batch(3)
+        batch = b.sample(3, out=out)
+        self.assertTrue(np.shares_memory(batch["xs"], out["xs"]))
+        b.extend(make_batch(4, 7, 2), extendible={"xs": [1]})
+        batch = b.sample(3, out=out)
+        self.assertEqual(batch["xs"].shape, (3, 7, 2))
+        self.assertTrue(np.shares_memory(batch["xs"], out["xs"]))
+
+    def test_concurrent_samples_are_consistent(self):
+        b = Buffer(50, {"xs": [0, 2], "ys": [3]}, validation_fraction=0.1)
+        b.extend(make_batch(50, 1, 1), extendible={"xs": [1]})
+        stop = threading.Event()
+        def write():
+            for value in range(2, 500):
+                b.extend(make_batch(7, 1 + value // 20, value), extendible={"xs": [1]})
+            stop.set()
+        writer = threading.Thread(target=write)
+        writer.start()
+        out = b.empty_batch(20)
+        while not stop.is_set():
+            batch = b.sample(20, out=out)
+            for xs, ys in zip(batch["xs"], batch["ys"]):
+                np.testing.assert_array_equal(ys, ys[0])
+                self.assertTrue(np.all((xs == ys[0]) | (xs == 0)))
+        writer.join()
+
+
+class TestPrioritized(unittest.TestCase):
+    def test_sum_tree(self):
+        tree = SumTree(5)
+        tree.update([0, 1, 2, 3, 4], [1.0, 0.0, 2.0, 0.0, 1.0])
+        self.assertEqual(tree.total(), 4.0)
+        counts = np.bincount(tree.sample(40000), minlength=5)
+        np.testing.assert_allclose(counts / 40000, [0.25, 0, 0.5, 0, 0.25], atol=0.02)
+        tree.update([2, 2], [3.0, 0.0])
+        self.assertEqual(tree.total(), 2.0)
+
+    def test_samples_follow_priorities(self):
+        b = Buffer(10, {"xs": [0, 2], "ys": [3]}, prioritized=True, alpha=1.0)
+        b.extend(make_batch(4, 2, 1), extendible={"xs": [1]})
+        b.extend(make_batch(4, 2, 2), extendible={"xs": [1]})
+        # Until their losses come in, new items are all equally likely.
+        batch, indexes = b.sample(8, return_indexes=True)
+        np.testing.assert_array_equal(batch["ys"][:, 0], np.where(indexes < 4, 1, 2))
+        b.update_priorities(np.arange(8), [0, 0, 0, 0, 1, 1, 1, 1])
+        for _ in range(20):
+            self.assertTrue(np.all(b.sample(8)["ys"] == 2))
+        # A new batch gets the largest priority seen.
+        b.extend(make_batch(2, 2, 3), extendible={"xs": [1]})
+        values = np.concatenate([b.sample(10)["ys"][:, 0] for _ in range(100)])
+        self.assertAlmostEqual(np.mean(values == 3), 2 / 6, delta=0.05)
+
+    def test_overwritten_items_keep_their_priority(self):
+        b = Buffer(4, {"xs": [0, 2], "ys": [3]}, prioritized=True, alpha=1.0)
+        b.extend(make_batch(4, 2, 1), extendible={"xs": [1]})
+        batch, indexes = b.sample(4, return_indexes=True)
+        self.assertLessEqual(set(indexes), {0, 1, 2, 3})
+        # Two slots are rewritten before the losses of the first items come in.
+        b.extend(make_batch(2, 2, 2), extendible={"xs": [1]})
+        b.update_priorities(np.arange(4), np.zeros(4))
+        batch, indexes = b.sample(4, return_indexes=True)
+        np.testing.assert_array_equal(batch["ys"][:, 0], 2)
+        # The numbers go on past the capacity.
+        self.assertLessEqual(set(indexes), {4, 5})
+
+
+class TestMemmap(unittest.TestCase):
+    def test_reopen(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, "buffer")
+            b = Buffer(10, {"xs": [0, 2], "ys": [3]}, validation_fraction=0.2,
+                       dtype=np.uint8, path=path)
+            self.assertIsInstance(b.buffer["xs"], np.memmap)
+            b.extend(make_batch(5, 2, 1), extendible={"xs": [1]})
+            b.extend(make_batch(5, 4, 2), extendible={"xs": [1]})
+            self.assertEqual(b.buffer["ys"].dtype, np.uint8)
+
+            b = Buffer(10, {"xs": [0, 2], "ys": [3]}, validation_fraction=0.2,
+                       dtype=np.uint8, path=path)
+            self.assertEqual((b.used, b.index), (8, 8))
+            self.assertEqual(b._validation_buffer.used, 2)
+            self.assertEqual(b.shapes["xs"], [4, 2])
+            batch = b.sample(8)
+            self.assertEqual(batch["xs"].shape, (8, 4, 2))
+            self.assertEqual(set(batch["ys"][:, 0]) | {1, 2}, {1, 2})
+            b.extend(make_batch(5, 4, 3), extendible={"xs": [1]})
+            self.assertEqual((b.used, b.index), (10, 2))
+
+            with self.assertRaises(ValueError):
+                Buffer(10, {"xs": [0, 2], "ys": [3]}, dtype=np.int32, path=path)
+            with self.assertRaises(ValueError):
+                Buffer(10, {"xs": [0, 2], "ys": [4]}, validation_fraction=0.2,
+                       dtype=np.uint8, path=path)
+            with self.assertRaises(ValueError):
+                Buffer(10, {"xs": [0, 3], "ys": [3]}, validation_fraction=0.2,
+                       dtype=np.uint8, path=path)
@@ -0,0 +1,44 @@
+"""Tests for the pools of reused environments"""
+
+import unittest
+
+import numpy as np
+
+from amplification.environments import EnvironmentPool
+from amplification.tasks import GraphTask, IterTask
+
+
+class TestEnvironmentPool(unittest.TestCase):
+    def test_environments_are_reused(self):
+        task = GraphTask()
+        environments = EnvironmentPool(task, reuse=4)
+        seen = {}
+        # Keeps them alive, so their ids aren't reused.
+        kept = []
+        for _ in range(12):
+            facts, fast_dbs, Qs, As = environments.get_batch(8, nqs=5, difficulty=3)
+            self.assertEqual(facts.shape[0], 8)
+            for fact, fast_db, Q, A in zip(facts, fast_dbs, Qs, As):
+                np.testing.assert_array_equal(task.answers(Q, fast_db), A)
+                seen[id(fast_db)] = seen.get(id(fast_db), 0) + 1
+                kept.append(fast_db)
+        # 8 at first, then 2 per batch.
+        self.assertEqual(environments.generated, 8 + 11 * 2)
+        self.assertEqual(max(seen.values()), 4)
+
+    def test_no_reuse(self):
+        environments = EnvironmentPool(IterTask())
+        first = environments.make_dbs_batch(5, difficulty=0)[1]
+        second = environments.make_dbs_batch(5, difficulty=0)[1]
+        self.assertFalse({id(x) for x in first} & {id(x) for x in second})
+
+    def test_smaller_batches_and_eviction(self):
+        environments = EnvironmentPool(IterTask(), reuse=2, max_levels=2)
+        environments.make_dbs_batch(10, difficulty=0)
+        facts, fast_dbs = environments.make_dbs_batch(3, difficulty=0)
+        self.assertEqual(len(fast_dbs), 3)
+        self.assertEqual(len(environments.levels[0][1]), 10)
+        environments.make_dbs_batch(4, difficulty=1)
+        environments.make_dbs_batch(4, difficulty=0)
+        environments.make_dbs_batch(4, difficulty=2)
+        self.assertEqual(list(environments.levels), [0, 2])
@@ -0,0 +1,279 @@
+"""Tests for the in-graph parts of the models"""
+
+import unittest
+from unittest import mock
+
+import numpy as np
+
+try:
+    import tensorflow as tf
+except ImportError:
+    raise unittest.SkipTest("TensorFlow isn't installed")
+
+import amplification.models.asker as asker_module
+from amplification.models.answerer import AttentionAnswerer
+from amplification.benchmark import build_asker_and_answerer
+from amplification.models.asker import AttentionSequenceModel, TokenTypes
+from amplification.models.core import lookup_simple_answers
+from amplification.tasks import IterTask, SumTask, SatTask
+from amplification.tasks.core import simple_answer_table, simple_key_encoding
+from amplification.train import answer_if_simple, get_interactions
+
+
+class TestLookupSimpleAnswers(unittest.TestCase):
+    def test_lookup_matches_answer_if_simple(self):
+        for task in [IterTask(), SumTask(), SumTask(modulus=None), SatTask()]:
+            with self.subTest(task=type(task).__name__):
+                facts, fast_dbs, Qs, As = task.get_batch(3, nqs=10)
+                # Simple questions, in and outside the key ranges, and others.
+                mask = task.simple_token_mask()
+                simple = np.stack([np.random.choice(np.flatnonzero(allowed), (3, 200))
+                                   for allowed in mask], axis=-1)
+                Qs = np.concatenate([Qs.astype(np.int32), simple], axis=1)
+                tables = np.stack([simple_answer_table(task, fast_db)
+                                   for fast_db in fast_dbs]).astype(np.int32)
+                digits, strides, _ = simple_key_encoding(task)
+                with tf.Graph().as_default():
+                    Qs_ph = tf.placeholder(tf.int32, [None, None, task.question_length])
+                    tables_ph = tf.placeholder(tf.int32, [None, None, task.answer_length])
+                    ops = lookup_simple_answers(Qs_ph, tables_ph, task.simple_token_mask(),
+                                                digits, strides)
+                    with tf.Session() as sess:
+                        are_simple, As = sess.run(ops, {Qs_ph: Qs, tables_ph: tables})
+                expected_simple, expected_As = answer_if_simple(task, fast_dbs, Qs)
+                np.testing.assert_array_equal(are_simple, expected_simple)
+                np.testing.assert_array_equal(As[are_simple], expected_As[are_simple])
+
+
+class TestAttentionSequenceModel(unittest.TestCase):
+    def test_cached_run_matches_run(self):
+        task = IterTask()
+        nbatch, length, prompt = 3, 12, 4
+        ws = np.random.randint(task.nvocab, size=(nbatch, length))
+        token_types = np.random.randint(TokenTypes.num, size=(nbatch, length))
+        with tf.Graph().as_default():
+            asker = AttentionSequenceModel(task=task, nh=32, depth=2)
+            ws_ph = tf.placeholder(tf.int32, [None, None])
+            types_ph = tf.placeholder(tf.int32, [None, None])
+            logits, next_logits, _ = asker.run(ws_ph, types_ph, is_training=False)
+            # The same transcripts, a prompt and then one word at a time.
+            cached_logits = []
+            start_ws, start_types = asker.with_start_token(ws_ph[:, :prompt], types_ph[:, :prompt])
+            _, cached_next_logits, caches = asker.run(
+                start_ws, start_types, caches=asker.empty_caches(tf.shape(ws_ph)[0]),
+                is_training=False)
+            for i in range(prompt, length):
+                cached_logits.append(cached_next_logits)
+                _, cached_next_logits, caches = asker.run(
+                    ws_ph[:, i:i + 1], types_ph[:, i:i + 1], caches=caches, is_training=False)
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                expected, expected_next, actual, actual_next = sess.run(
+                    [logits[:, prompt:], next_logits, tf.stack(cached_logits, axis=1),
+                     cached_next_logits],
+                    {ws_ph: ws, types_ph: token_types})
+        np.testing.assert_allclose(actual, expected, rtol=1e-4, atol=1e-4)
+        np.testing.assert_allclose(actual_next, expected_next, rtol=1e-4, atol=1e-4)
+
+    def test_sample_matches_uncached_decode(self):
+        task = IterTask()
+        rounds = 2
+        qlength, alength = task.question_length, task.answer_length
+        answerer = lambda subQs: subQs[:, :alength]
+        # Greedy, so that both decodes pick the same words from the same logits.
+        greedy = lambda logits: tf.argmax(logits, axis=-1, output_type=tf.int32)
+        with tf.Graph().as_default(), mock.patch.object(asker_module, "multinomial", greedy):
+            asker = AttentionSequenceModel(task=task, nh=32, depth=2)
+            Qs = tf.placeholder(tf.int32, [None, qlength])
+            cached = asker.sample(Qs, rounds, answerer)
+            # Without caches: the whole transcript runs again for every word.
+            ws, types = Qs, tf.fill(tf.shape(Qs), TokenTypes.mainQ)
+
+            def decode(ws, types, length, token_type):
+                for _ in range(length):
+                    _, next_logits, _ = asker.run(ws, types, is_training=False)
+                    w = tf.expand_dims(greedy(next_logits), -1)
+                    ws = tf.concat([ws, w], axis=1)
+                    types = tf.concat([types, tf.fill(tf.shape(w), token_type)], axis=1)
+                return ws, types
+
+            subQs, subAs = [], []
+            for _ in range(rounds):
+                ws, types = decode(ws, types, qlength, TokenTypes.subQ)
+                subQs.append(ws[:, -qlength:])
+                subAs.append(answerer(subQs[-1]))
+                ws = tf.concat([ws, subAs[-1]], axis=1)
+                types = tf.concat([types, tf.fill(tf.shape(subAs[-1]), TokenTypes.subA)], axis=1)
+            ws, types = decode(ws, types, alength, TokenTypes.mainA)
+            uncached = (tf.stack(subQs, axis=1), tf.stack(subAs, axis=1), ws[:, -alength:])
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                facts, fast_dbs, Q_batch, truth = task.get_batch(5, nqs=1)
+                actual, expected = sess.run([cached, uncached], {Qs: Q_batch[:, 0]})
+        for x, y in zip(actual, expected):
+            np.testing.assert_array_equal(x, y)
+
+    def test_sample_shapes(self):
+        task = IterTask()
+        rounds = 3
+        with tf.Graph().as_default():
+            asker = AttentionSequenceModel(task=task, nh=32, depth=2)
+            Qs = tf.placeholder(tf.int32, [None, task.question_length])
+            ops = asker.sample(Qs, rounds, lambda subQs: subQs[:, :task.answer_length])
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                facts, fast_dbs, Q_batch, truth = task.get_batch(5, nqs=1)
+                subQs, subAs, As = sess.run(ops, {Qs: Q_batch[:, 0]})
+        self.assertEqual(subQs.shape, (5, rounds, task.question_length))
+        self.assertEqual(subAs.shape, (5, rounds, task.answer_length))
+        self.assertEqual(As.shape, (5, task.answer_length))
+        np.testing.assert_array_equal(subAs, subQs[:, :, :task.answer_length])
+
+    def test_reduced_precision(self):
+        task = IterTask()
+        ws = np.random.randint(task.nvocab, size=(3, 12))
+        token_types = np.random.randint(TokenTypes.num, size=(3, 12))
+        for dtype in ["float16", "bfloat16"]:
+            with self.subTest(dtype=dtype), tf.Graph().as_default():
+                asker = AttentionSequenceModel(task=task, nh=32, depth=2, compute_dtype=dtype)
+                ws_ph = tf.placeholder(tf.int32, [None, None])
+                types_ph = tf.placeholder(tf.int32, [None, None])
+                ops = asker.build(ws_ph, types_ph, is_training=tf.constant(True))
+                # The weights stay float32, the logits and the loss too.
+                self.assertLessEqual({v.dtype.base_dtype for v in tf.global_variables()},
+                                     {tf.float32, tf.int32})
+                self.assertEqual(ops["losses"].dtype, tf.float32)
+                with tf.Session() as sess:
+                    sess.run(tf.global_variables_initializer())
+                    feed = {ws_ph: ws, types_ph: token_types}
+                    sess.run(ops["train"], feed)
+                    loss = sess.run(ops["loss"], feed)
+                self.assertTrue(np.isfinite(loss))
+
+
+class TestAttentionAnswerer(unittest.TestCase):
+    def test_answer_with_targets(self):
+        task = IterTask()
+        with tf.Graph().as_default():
+            answerer = AttentionAnswerer(task=task, nh=32, depth=2, answer_depth=1)
+            facts = tf.placeholder(tf.int32, [None, None, task.fact_length])
+            Qs = tf.placeholder(tf.int32, [None, None, task.question_length])
+            targets = tf.placeholder(tf.int32, [None, None, task.answer_length])
+            ops = answerer.build(facts, Qs, targets, is_training=tf.constant(False))
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                fact_batch, fast_dbs, Q_batch, truth = task.get_batch(4, nqs=6)
+                # The sampled answers don't need the targets.
+                As = sess.run(ops["As"], {facts: fact_batch, Qs: Q_batch})
+                feed = {facts: fact_batch, Qs: Q_batch, targets: truth}
+                losses, predictions = zip(*[sess.run([ops["losses"], ops["predictions"]], feed)
+                                            for _ in range(3)])
+        self.assertEqual(As.shape, truth.shape)
+        self.assertEqual(predictions[0].shape, truth.shape)
+        self.assertEqual(losses[0].shape, truth.shape[:2])
+        self.assertTrue(np.all(np.isfinite(losses[0])))
+        # The losses are of the targets, whatever answers are sampled.
+        for other in losses[1:]:
+            np.testing.assert_allclose(other, losses[0], rtol=1e-5)
+
+
+def counting_encodings(encodings):
+    """Patches AttentionAnswerer, so that every run of its encoding of facts
+    appends the number of environments to encodings."""
+    model_run = AttentionAnswerer.run
+
+    def counted_run(self, facts, is_training):
+        def count(state):
+            encodings.append(len(state))
+            return state
+        state = model_run(self, facts, is_training)
+        counted = tf.py_func(count, [state], state.dtype, stateful=True)
+        counted.set_shape(state.shape)
+        return counted
+
+    return mock.patch.object(AttentionAnswerer, "run", counted_run)
+
+
+class TestAskerAndAnswerer(unittest.TestCase):
+    def test_cached_teacher_state(self):
+        task = IterTask()
+        small = dict(nh=32, depth=2)
+        with tf.Graph().as_default():
+            inputs, ops = build_asker_and_answerer(
+                task, answerer=dict(small, answer_depth=1), asker=small)
+            facts, Qs, facts_key = inputs["facts"], inputs["Qs"], inputs["facts_key"]
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                batches = [task.get_batch(3, nqs=4) for _ in range(2)]
+                for key, (fact_batch, _, _, _) in enumerate(batches):
+                    sess.run(ops["teacher_state"]["store"], {facts: fact_batch, facts_key: key})
+                # Both are kept, and answered about with only the questions fed.
+                for key, (fact_batch, _, Q_batch, _) in enumerate(batches):
+                    expected = sess.run(ops["answerer"]["teacher"]["state"], {facts: fact_batch})
+                    feed = {Qs: Q_batch, facts_key: key}
+                    cached, As = sess.run([ops["teacher_state"]["cached"],
+                                           ops["cached"]["teacher_or_simple"]], feed)
+                    np.testing.assert_allclose(cached, expected, rtol=1e-5)
+                    self.assertEqual(As.shape, Q_batch.shape[:2] + (task.answer_length,))
+                    sess.run(ops["teacher_state"]["remove"], {facts_key: key})
+
+    def test_cached_rounds_dont_encode(self):
+        task = IterTask()
+        small = dict(nh=32, depth=2)
+        with tf.Graph().as_default():
+            encodings = []
+            with counting_encodings(encodings):
+                inputs, ops = build_asker_and_answerer(
+                    task, answerer=dict(small, answer_depth=1), asker=small)
+            facts, Qs, facts_key = inputs["facts"], inputs["Qs"], inputs["facts_key"]
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                fact_batch, _, Q_batch, _ = task.get_batch(3, nqs=4)
+                sess.run(ops["teacher_state"]["store"], {facts: fact_batch, facts_key: 0})
+                self.assertEqual(encodings, [3])
+                feed = {Qs: Q_batch, facts_key: 0}
+                for _ in range(3):
+                    sess.run(ops["cached"]["teacher_or_simple"], feed)
+                sess.run(ops["cached"]["teacher_As"], feed)
+                sess.run(ops["teacher_state"]["remove"], {facts_key: 0})
+                self.assertEqual(encodings, [3])
+                # Without the cache, every run encodes the facts again.
+                for _ in range(2):
+                    sess.run(ops["teacher_or_simple"], {facts: fact_batch, Qs: Q_batch})
+                self.assertEqual(encodings, [3, 3, 3])
+
+    def test_teacher_runs_once_per_batch(self):
+        task = IterTask()
+        small = dict(nh=32, depth=2)
+        with tf.Graph().as_default():
+            # Only the teacher's encodings are fetched below.
+            encodings = []
+            with counting_encodings(encodings):
+                inputs, ops = build_asker_and_answerer(
+                    task, answerer=dict(small, answer_depth=1), asker=small)
+            # What train's answer_server and cached fetches run here.
+            named_ops = {"answer_server/store": ops["teacher_state"]["store"],
+                         "answer_server/remove": ops["teacher_state"]["remove"],
+                         "cached/teacher_or_simple": ops["cached"]["teacher_or_simple"],
+                         "cached/teacher_As": ops["cached"]["teacher_As"]}
+            stats = {}
+
+            class Averager:
+                def add(self, k, v):
+                    stats.setdefault(k, []).append(v)
+
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+
+                def run(names, fast_dbs=None, is_training=None, **feeds):
+                    return sess.run([named_ops[name] for name in names],
+                                    {inputs[k]: v for k, v in feeds.items()})
+
+                for batches in range(1, 3):
+                    fact_batch, fast_dbs, Q_batch, _ = task.get_batch(3, nqs=4)
+                    As, subQs, subAs, teacher_As = get_interactions(
+                        run, task, fact_batch, fast_dbs, Q_batch,
+                        teacher_As=True, stats_averager=Averager())
+                    self.assertEqual(len(encodings), batches)
+                    self.assertEqual(As.shape, teacher_As.shape)
+            self.assertEqual(len(stats["latency/answer_round"]), 2)
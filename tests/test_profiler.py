@@ -0,0 +1,69 @@
+"""Tests for the thread profiler"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from amplification.profiler import Profiler
+
+
+class TestProfiler(unittest.TestCase):
+    def test_nested_sections(self):
+        profiler = Profiler()
+        def work():
+            with profiler.section("outer"):
+                time.sleep(0.05)
+                with profiler.section("inner"):
+                    time.sleep(0.1)
+            profiler.sleep(0.05)
+        thread = threading.Thread(target=work, name="worker")
+        thread.start()
+        thread.join()
+        profiler.gauge("buffer", 0.5)
+        items = profiler.items()
+        total = items["time/worker/outer"] + items["time/worker/inner"] + items["time/worker/sleep"]
+        self.assertAlmostEqual(items["time/worker/inner"] / total, 0.5, delta=0.1)
+        self.assertAlmostEqual(items["time/worker/outer"] / total, 0.25, delta=0.1)
+        self.assertAlmostEqual(total + items["time/worker/other"], 1.0)
+        self.assertEqual(items["fill/buffer"], 0.5)
+        self.assertNotIn("time/worker/outer", profiler.items())
+
+    def test_sections_split_at_items(self):
+        profiler = Profiler()
+        profiler.items()
+        started = threading.Event()
+        def work():
+            with profiler.section("outer"):
+                started.set()
+                profiler.sleep(0.2)
+        thread = threading.Thread(target=work, name="worker")
+        thread.start()
+        started.wait()
+        time.sleep(0.1)
+        first = profiler.items()
+        thread.join()
+        second = profiler.items()
+        for items in [first, second]:
+            self.assertLessEqual(items["time/worker/sleep"], 1.0)
+            self.assertGreaterEqual(items["time/worker/other"], -1e-9)
+        self.assertGreater(first["time/worker/sleep"], 0.8)
+        self.assertGreater(second["time/worker/sleep"], 0.8)
+
+    def test_trace(self):
+        with tempfile.TemporaryDirectory() as path:
+            profiler = Profiler()
+            profiler.trace_to(os.path.join(path, "trace.json"))
+            with profiler.section("a"):
+                with profiler.section("b"):
+                    pass
+            profiler.gauge("buffer", 3)
+            profiler.items()
+            with open(os.path.join(path, "trace.json")) as f:
+                text = f.read()
+            # The array is left open.
+            events = json.loads(text.rstrip().rstrip(",") + "]")
+            self.assertEqual([e["name"] for e in events], ["b", "a", "buffer"])
+            self.assertEqual(events[2]["ph"], "C")
@@ -0,0 +1,293 @@
+"""Tests for the environment generation of the tasks"""
+
+import itertools
+import random
+import unittest
+from collections import defaultdict
+
+import numpy as np
+
+from amplification.tasks import EqualsTask, EvalSumTask, EvalTask, GraphTask, IterTask, SatTask, SumTask
+from amplification.tasks.core import all_tasks, idk, recursive_run_generators, recursive_run_steps
+from amplification.tasks.core import simple_answer_table, simple_keys, smallest_dtype
+from amplification.tasks.graph import floyd_warshall, shortest_paths
+
+
+class TestGetBatch(unittest.TestCase):
+    def test_get_batch(self):
+        nbatch, nqs = 5, 7
+        for task in all_tasks():
+            with self.subTest(task=type(task).__name__):
+                facts, fast_dbs, Qs, As = task.get_batch(nbatch, nqs=nqs, difficulty=3)
+                self.assertEqual(len(fast_dbs), nbatch)
+                self.assertEqual(facts.shape[0], nbatch)
+                self.assertEqual(facts.shape[2], task.fact_length)
+                self.assertEqual(Qs.shape, (nbatch, nqs, task.question_length))
+                self.assertEqual(As.shape, (nbatch, nqs, task.answer_length))
+                for x in [facts, Qs, As]:
+                    self.assertEqual(x.dtype, task.token_dtype)
+                for Q, A, fast_db in zip(Qs, As, fast_dbs):
+                    np.testing.assert_array_equal(task.answers(Q, fast_db), A)
+
+
+class TestTokenDtype(unittest.TestCase):
+    def test_smallest_dtype(self):
+        self.assertEqual(smallest_dtype(256), np.uint8)
+        self.assertEqual(smallest_dtype(257), np.uint16)
+        self.assertEqual(smallest_dtype(70000), np.int32)
+
+
+class TestRecursiveRun(unittest.TestCase):
+    def test_steps_match_generators(self):
+        for task in all_tasks():
+            for seed, noisy in enumerate([False, True]):
+                with self.subTest(task=type(task).__name__, noisy=noisy):
+                    facts, fast_dbs, Qs, As = task.get_batch(1, nqs=100, difficulty=3)
+                    Qs, fast_db = Qs[0], fast_dbs[0]
+                    if noisy:
+                        # Also exercise the paths for malformed questions and answers.
+                        garbage = np.random.random(Qs.shape) < 0.1
+                        Qs[garbage] = np.random.randint(task.nvocab, size=np.sum(garbage))
+                    def answerer(subQs):
+                        subAs = task.answers(subQs, fast_db)
+                        if noisy:
+                            garbage = np.random.random(subAs.shape) < 0.2
+                            subAs[garbage] = np.random.randint(task.nvocab, size=np.sum(garbage))
+                        return subAs
+                    results = []
+                    for run in [recursive_run_generators, recursive_run_steps]:
+                        random.seed(seed)
+                        np.random.seed(seed)
+                        results.append(run(task, Qs, answerer))
+                    for expected, actual in zip(*results):
+                        np.testing.assert_array_equal(expected, actual)
+
+
+class TestSimpleAnswerTable(unittest.TestCase):
+    def test_table_matches_answers(self):
+        for task in [IterTask(), SumTask(), SumTask(modulus=None), SatTask()]:
+            with self.subTest(task=type(task).__name__):
+                facts, fast_dbs, Qs, As = task.get_batch(3, nqs=10)
+                mask = task.simple_token_mask()
+                # Random simple questions, including ones outside the key ranges.
+                Qs = np.stack([np.random.choice(np.flatnonzero(allowed), 500)
+                               for allowed in mask], axis=-1)
+                self.assertTrue(np.all(task.are_simple(Qs)))
+                for fast_db in fast_dbs:
+                    table = simple_answer_table(task, fast_db)
+                    np.testing.assert_array_equal(table[simple_keys(task, Qs)],
+                                                  task.answers(Qs, fast_db))
+
+
+class TestIterTask(unittest.TestCase):
+    def test_answers_follow_permutation(self):
+        task = IterTask(length=2, log_iters=5)
+        facts, fast_dbs, Qs, As = task.get_batch(10, nqs=50, difficulty=5)
+        for fact, Q, A in zip(facts, Qs, As):
+            permutation = {tuple(f[:task.length]): tuple(f[task.length:]) for f in fact}
+            for q, a in zip(Q, A):
+                n = int("".join("1" if b == task.one else "0" for b in q[task.length:]), 2)
+                x = tuple(q[:task.length])
+                for _ in range(n):
+                    x = permutation[x]
+                self.assertEqual(tuple(a), x)
+
+    def test_answers_invalid_questions(self):
+        task = IterTask()
+        facts, fast_dbs, Qs, As = task.get_batch(1, nqs=20)
+        Qs = Qs[0].copy()
+        Qs[:10, task.length] = idk
+        Qs[10:, 0] = task.zero
+        np.testing.assert_array_equal(task.answers(Qs, fast_dbs[0]), idk)
+
+    def test_inject_errors_keeps_token_dtype(self):
+        # Answers come out of recursive_run in task.token_dtype.
+        task = IterTask()
+        facts, fast_dbs, Qs, As = task.get_batch(5, nqs=100)
+        for A, fast_db in zip(As, fast_dbs):
+            injected = A.copy()
+            task.inject_errors(injected, fast_db, 1.0)
+            self.assertEqual(injected.dtype, task.token_dtype)
+            valid = np.concatenate([fast_db["vars"], [task.pad(idk)]])
+            self.assertTrue(all(np.any(np.all(a == valid, axis=-1)) for a in injected))
+
+
+class TestClassifyQuestions(unittest.TestCase):
+    def test_classes_are_valid(self):
+        for task in all_tasks():
+            with self.subTest(task=type(task).__name__):
+                facts, fast_dbs, Qs, As = task.get_batch(2, nqs=100, difficulty=3)
+                Qs, fast_db = Qs[0], fast_dbs[0]
+                # Malformed questions get a class too.
+                garbage = np.random.random(Qs.shape) < 0.1
+                Qs[garbage] = np.random.randint(task.nvocab, size=np.sum(garbage))
+                classes = task.classify_questions(Qs, fast_db)
+                self.assertEqual(classes.shape, (len(Qs),))
+                self.assertTrue(np.all((0 <= classes) & (classes < len(task.question_classes))))
+                for Q, c in zip(Qs[:10], classes):
+                    self.assertEqual(task.classify_question(Q, fast_db), task.question_classes[c])
+
+    def test_iter_task_classes(self):
+        task = IterTask()
+        x = task.vars[0]
+        Qs = np.array([list(x) + [task.zero] * (task.log_iters - len(n)) + [task.zero + int(b) for b in n]
+                       for n in ["0", "10", "101", "1111"]])
+        classes = task.classify_questions(Qs, task.make_dbs()[1])
+        self.assertEqual([task.question_classes[c] for c in classes], ["0", "2", "3", "4"])
+
+
+class TestGraphTask(unittest.TestCase):
+    def test_shortest_paths_match_floyd_warshall(self):
+        for n in [1, 2, 7, 40, 70]:
+            edges = np.random.randint(1, n + 1, size=(5, 2 * n, 2))
+            np.testing.assert_array_equal(shortest_paths(edges, n, 1000),
+                                          floyd_warshall(edges, n, 1000))
+
+    def test_distances_over_used_vertices(self):
+        task = GraphTask()
+        for difficulty in [0, 10, float('inf')]:
+            facts, fast_dbs = task.make_dbs_batch(5, difficulty)
+            for fact, fast_db in zip(facts, fast_dbs):
+                edges = task.indices(np.stack([fact[:, :task.length], fact[:, task.length:]], axis=1))
+                dense = floyd_warshall(edges[np.newaxis], task.size, 2 * task.size)[0]
+                rows = np.concatenate([[0], task.indices(fast_db["vertices"])])
+                np.testing.assert_array_equal(fast_db["distances"], dense[np.ix_(rows, rows)])
+                np.testing.assert_array_equal(fast_db["index"][rows], np.arange(len(rows)))
+
+
+class TestSumTask(unittest.TestCase):
+    def test_answers_sum_matching_strings(self):
+        for task in [SumTask(), SumTask(modulus=None), SumTask(length=4, nchars=3)]:
+            facts, fast_dbs = task.make_dbs_batch(5, difficulty=4)
+            for fast_db in fast_dbs:
+                Qs = task.make_qs_batch(100, [fast_db])[0]
+                Qs[0] = idk
+                expected = [task.encode_n(sum(value for string, value in
+                                              zip(fast_db["strings"], fast_db["values"])
+                                              if np.all((Q == task.wild) | (Q == string))))
+                            for Q in Qs]
+                np.testing.assert_array_equal(task.answers(Qs, fast_db)[:, 0], expected)
+
+    def test_long_strings_stay_cheap(self):
+        # No table of all (nchars + 1)**length patterns at low difficulty
+        for length in [12, 16]:
+            task = SumTask(length=length)
+            facts, fast_dbs = task.make_dbs_batch(50, difficulty=0)
+            self.assertEqual(facts.shape, (50, 8, length + 1))
+            for fast_db in fast_dbs:
+                self.assertLess(sum(x.nbytes for x in fast_db.values()), 10000)
+                self.assertEqual(len({tuple(s) for s in fast_db["strings"]}), 8)
+            Qs = task.make_qs_batch(20, fast_dbs[:1])[0]
+            expected = [task.encode_n(sum(value for string, value in
+                                          zip(fast_dbs[0]["strings"], fast_dbs[0]["values"])
+                                          if np.all((Q == task.wild) | (Q == string))))
+                        for Q in Qs]
+            np.testing.assert_array_equal(task.answers(Qs, fast_dbs[0])[:, 0], expected)
+
+
+class TestSatTask(unittest.TestCase):
+    def test_answers_count_satisfying_assignments(self):
+        for task in [SatTask(), SatTask(nvars=3, nvalues=3, length=2)]:
+            facts, fast_dbs = task.make_dbs_batch(5, difficulty=2)
+            for clauses, fast_db in zip(facts, fast_dbs):
+                satisfying = [
+                    assignment for assignment in
+                    itertools.product(task.variable_values, repeat=task.nvars)
+                    if all(any(assignment[var - task.variable_names[0]] == value
+                               for var, value in zip(clause[::2], clause[1::2]))
+                           for clause in clauses)]
+                np.testing.assert_array_equal(task.satisfying_assignments(clauses),
+                                              np.reshape(satisfying, (-1, task.nvars)))
+                Qs = task.make_qs_batch(100, [fast_db])[0]
+                Qs[0] = idk
+                expected = [task.encode_n(sum(all(q in (task.wild, x) for q, x in zip(Q, assignment))
+                                              for assignment in satisfying))
+                            for Q in Qs]
+                np.testing.assert_array_equal(task.answers(Qs, fast_db)[:, 0], expected)
+
+
+class TestEqualsTask(unittest.TestCase):
+    def test_answers_follow_facts(self):
+        for task in [EqualsTask(), EqualsTask(easy=True)]:
+            facts, fast_dbs = task.make_dbs_batch(5, difficulty=20)
+            L = task.length
+            for fact, fast_db in zip(facts, fast_dbs):
+                givens = {tuple(f[:L]): f[L] for f in fact if f[L] in task.vals}
+                equivalences = [(tuple(f[:L]), tuple(f[L:])) for f in fact if f[L] not in task.vals]
+                neighbors = defaultdict(set)
+                for x, y in equivalences:
+                    neighbors[x].add(y)
+                    neighbors[y].add(x)
+                xs = fast_db["used_vars"]
+                As = {q: task.answers(task.queries(q, xs), fast_db) for q in
+                      [task.simple_value_query, task.neighbor_query, task.parent_query,
+                       task.depth_query, task.value_query]}
+                depths = {tuple(x): d for x, d in zip(xs, As[task.depth_query][:, 0])}
+                values = {tuple(x): v for x, v in zip(xs, As[task.value_query][:, 0])}
+                if task.easy:
+                    #equivalences point to the given values
+                    for x, y in equivalences:
+                        self.assertEqual(depths[x], depths[y] + 1)
+                for i, x in enumerate(map(tuple, xs)):
+                    parent = tuple(As[task.parent_query][i])
+                    self.assertEqual(As[task.simple_value_query][i, 0], givens.get(x, idk))
+                    if x in givens:
+                        self.assertEqual(parent, x)
+                        self.assertEqual(depths[x], task.zero)
+                        self.assertEqual(values[x], givens[x])
+                    else:
+                        self.assertIn(parent, neighbors[x])
+                        self.assertEqual(depths[x], depths[parent] + 1)
+                        self.assertEqual(values[x], values[parent])
+                        edge = task.answers(task.make_edge_queries(xs[i:i+1], np.array([parent])),
+                                            fast_db)
+                        self.assertEqual(edge[0, 0], task.zero)
+                    if neighbors[x]:
+                        self.assertIn(tuple(As[task.neighbor_query][i]), neighbors[x])
+                    else:
+                        self.assertTrue(np.all(As[task.neighbor_query][i] == idk))
+                unused = [v for v in task.vars if v not in depths][:1]
+                if unused:
+                    self.assertTrue(np.all(task.answers(task.queries(task.value_query,
+                                                                     np.array(unused)),
+                                                        fast_db) == idk))
+
+
+class TestEvalTask(unittest.TestCase):
+    def test_answers_follow_facts(self):
+        for task in [EvalTask(), EvalSumTask(), EvalSumTask(modulus=None)]:
+            facts, fast_dbs = task.make_dbs_batch(5, difficulty=20)
+            L = task.length
+            for fact, fast_db in zip(facts, fast_dbs):
+                is_f = np.isin(fact[:, 0], getattr(task, "vals", []))
+                f = {(a, b): c for a, b, c in fact[is_f, :3]}
+                values, operands = {}, {}
+                for row in fact[~is_f & np.any(fact != idk, axis=1)]:
+                    x = tuple(row[:L])
+                    if row[L] in task.chars:
+                        y, z = tuple(row[L:2*L]), tuple(row[2*L:3*L])
+                        operands[x] = (y, z)
+                        if isinstance(task, EvalTask):
+                            values[x] = f[values[y], values[z]]
+                        else:
+                            values[x] = task.encode_n(values[y] + values[z] - 2 * task.zero)
+                    else:
+                        values[x] = row[L]
+                xs = fast_db["used_vars"]
+                self.assertEqual(set(map(tuple, xs)), set(values))
+                def answers(q):
+                    padding = idk * np.ones((len(xs), task.question_length - 1 - L), dtype=xs.dtype)
+                    Qs = np.concatenate([q * np.ones((len(xs), 1), dtype=xs.dtype), xs, padding], axis=1)
+                    return task.answers(Qs, fast_db)
+                As = [answers(q) for q in [task.compound_query, task.simple_query_a,
+                                           task.simple_query_b]]
+                for i, x in enumerate(map(tuple, xs)):
+                    self.assertEqual(As[0][i, 0], values[x])
+                    for j in range(2):
+                        if x in operands:
+                            self.assertEqual(tuple(As[j + 1][i, :L]), operands[x][j])
+                        else:
+                            self.assertEqual(tuple(As[j + 1][i]), task.pad(values[x]))
+                if f:
+                    Qs = np.array([task.pad((a, b), task.question_length) for a, b in f])
+                    np.testing.assert_array_equal(task.answers(Qs, fast_db)[:, 0], list(f.values()))
@@ -0,0 +1,44 @@
+"""Tests for the validation set of the answerer"""
+
+import tempfile
+import unittest
+
+import numpy as np
+
+from amplification.tasks import IterTask, SumTask
+from amplification.validation import make_validation_set, task_key
+
+
+class TestValidationSet(unittest.TestCase):
+    def assert_same(self, batches, other):
+        self.assertEqual(len(batches), len(other))
+        for batch, other_batch in zip(batches, other):
+            for k in batch:
+                self.assertEqual(batch[k].dtype, other_batch[k].dtype)
+                np.testing.assert_array_equal(batch[k], other_batch[k])
+
+    def test_same_in_every_run(self):
+        task = IterTask()
+        kwargs = dict(instances=40, nqs=5, max_difficulty=4)
+        state = np.random.get_state()
+        batches = make_validation_set(task, **kwargs)
+        # The random numbers of the caller aren't touched.
+        np.testing.assert_array_equal(np.random.get_state()[1], state[1])
+        self.assertEqual([len(batch["facts"]) for batch in batches], [14, 3, 3, 3, 14])
+        self.assert_same(batches, make_validation_set(task, nworkers=2, **kwargs))
+        other = make_validation_set(task, seed=1, **kwargs)
+        self.assertFalse(np.array_equal(batches[0]["Qs"], other[0]["Qs"]))
+
+    def test_cache(self):
+        task = SumTask()
+        kwargs = dict(instances=20, nqs=5, max_difficulty=3)
+        with tempfile.TemporaryDirectory() as cache:
+            batches = make_validation_set(task, cache=cache, **kwargs)
+            self.assert_same(batches, make_validation_set(task, cache=cache, **kwargs))
+            self.assert_same(batches, make_validation_set(task, **kwargs))
+
+    def test_task_key(self):
+        self.assertEqual(task_key(SumTask(), seed=0), task_key(SumTask(), seed=0))
+        self.assertNotEqual(task_key(SumTask(), seed=0), task_key(SumTask(), seed=1))
+        self.assertNotEqual(task_key(SumTask(), seed=0), task_key(SumTask(length=5), seed=0))
+        self.assertNotEqual(task_key(SumTask(), seed=0), task_key(IterTask(), seed=0))
@@ -0,0 +1,53 @@
+"""Tests for the generation worker processes"""
+
+import unittest
+
+import numpy as np
+
+from amplification.tasks import IterTask
+from amplification.tasks.core import recursive_run
+from amplification.workers import GenerationPool, from_shared, to_shared
+
+
+class BrokenTask(IterTask):
+    def get_batch(self, nbatch, **kwargs):
+        raise ValueError("broken")
+
+
+class TestWorkers(unittest.TestCase):
+    def test_shared_round_trip(self):
+        arrays = {"a": np.arange(12, dtype=np.uint8).reshape(3, 4),
+                  "b": np.ones((2, 5), dtype=np.int32)}
+        result = from_shared(to_shared(arrays))
+        for k, x in arrays.items():
+            self.assertEqual(result[k].dtype, x.dtype)
+            np.testing.assert_array_equal(result[k], x)
+
+    def test_pool(self):
+        task = IterTask()
+        pool = GenerationPool(task, 6, 1, difficulty=3, real_interactions=True,
+                              simple_answer_tables=True)
+        try:
+            facts, fast_dbs, Qs, truth = pool()
+            self.assertEqual(facts.shape, (6, 11, task.fact_length))
+            self.assertEqual(Qs.dtype, task.token_dtype)
+            self.assertIn("simple_answers", fast_dbs[0])
+            for Q, A, fast_db in zip(Qs, truth, fast_dbs):
+                np.testing.assert_array_equal(task.answers(Q, fast_db), A)
+            pool.difficulty = float('inf')
+            self.assertEqual(pool.difficulty, float('inf'))
+            facts, fast_dbs, Qs, truth, (As, subQs, subAs) = pool.interactions(4)
+            self.assertEqual(len(fast_dbs), 4)
+            answerer = lambda Qss: np.array([task.answers(Qs, fast_db)
+                                             for Qs, fast_db in zip(Qss, fast_dbs)])
+            np.testing.assert_array_equal(As, recursive_run(task, Qs, answerer)[0])
+        finally:
+            pool.close()
+
+    def test_failures_reach_the_caller(self):
+        pool = GenerationPool(BrokenTask(), 6, 1)
+        try:
+            with self.assertRaises(RuntimeError):
+                pool()
+        finally:
+            pool.close()